@@ -0,0 +1,99 @@
+"""
+Compares analyze_face_curvature with the former per-slice loop on synthetic volumes.
+The exit status is 1 when the batch is not at least --min-speedup times faster for every slice count.
+
+Usage: Slicer --no-main-window --python-script scripts/benchmarkFaceCurvature.py [--slices 500 --size 400]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'septum_analysis'))
+
+from septum_analysisLib.FaceCurvature import analyze_face_curvature, analyze_face_curvature_batch
+
+
+def analyze_face_curvature_per_slice(images):
+    result = []
+    result1 = []
+    for data in images:
+        data = cv2.bilateralFilter(data, 3, 75, 75)
+        _, thresh = cv2.threshold(data, data.mean(), 255, cv2.THRESH_TOZERO)
+        cont, _ = cv2.findContours(thresh, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
+        if len(cont) == 0:
+            result.append(0)
+            result1.append(0)
+            continue
+        maxc = max(enumerate(cont), key=lambda x: cv2.contourArea(x[1]))[0]
+        ch = cv2.convexHull(cont[maxc], returnPoints=False)
+        ch_ = cv2.convexHull(cont[maxc])
+        defects = cv2.convexityDefects(cont[maxc], ch)
+        result.append(0 if defects is None else sum(map(lambda x: x[-1], defects.reshape(-1, 4))))
+        result1.append(cv2.contourArea(ch_) - cv2.contourArea(cont[maxc]))
+    return result, result1
+
+
+def synthetic_face_volume(slices, size, seed=0):
+    """Elliptic head sections with a nose-like bump in the middle slices and noise."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:size, :size]
+    center = size / 2
+    images = np.empty((slices, size, size), dtype=np.uint8)
+    for k in range(slices):
+        radius = size * (0.3 + 0.05 * np.sin(k / slices * np.pi))
+        head = ((yy - center) / (1.2 * radius)) ** 2 + ((xx - center) / radius) ** 2 < 1
+        noseLength = 0.15 * size * np.exp(-((k - slices / 2) / (0.1 * slices)) ** 2)
+        nose = (np.abs(xx - center) < 0.03 * size) & (yy > center) & (yy < center + 1.2 * radius + noseLength)
+        noise = rng.normal(0, 20, (size, size))
+        images[k] = np.clip((head | nose) * 150 + noise, 0, 255)
+    return images
+
+
+def measure(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slices', type=int, nargs='+', default=[100, 500])
+    parser.add_argument('--size', type=int, default=400)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--min-speedup', type=float, default=1.0, help='required per-slice time / batch time')
+    args = parser.parse_args(argv)
+
+    tooSlow = []
+
+    print(f"{'slices':>8} {'per-slice, s':>14} {'batch, s':>10} {'speedup':>8} {'failed':>7}")
+    for slices in args.slices:
+        images = synthetic_face_volume(slices, args.size)
+
+        expected, expected1 = analyze_face_curvature_per_slice(images)
+        result, result1 = analyze_face_curvature(images, args.workers)
+        if not np.array_equal(expected, result) or not np.allclose(expected1, result1):
+            raise RuntimeError(f'Batched result differs from the per-slice loop for {slices} slices')
+
+        perSliceTime = measure(lambda: analyze_face_curvature_per_slice(images), args.repeat)
+        batchTime = measure(lambda: analyze_face_curvature_batch(images, args.workers), args.repeat)
+        failed = analyze_face_curvature_batch(images, args.workers).failed.sum()
+        speedup = perSliceTime / batchTime
+        print(f'{slices:>8} {perSliceTime:>14.3f} {batchTime:>10.3f} {speedup:>7.2f}x {failed:>7}')
+        if speedup < args.min_speedup:
+            tooSlow.append((slices, speedup))
+
+    for slices, speedup in tooSlow:
+        print(f'Too slow: {slices} slices {speedup:.2f}x, required {args.min_speedup:.2f}x')
+    sys.exit(1 if tooSlow else 0)
+
+
+if __name__ == '__main__':
+    main()
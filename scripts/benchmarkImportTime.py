@@ -0,0 +1,58 @@
+"""
+Measures the time of importing septum_analysisLib in fresh interpreters and checks that no heavy dependency
+is imported with it. Exits with status 1 when the median time is above --max-ms or a heavy module was imported.
+
+Usage: python scripts/benchmarkImportTime.py [--repeat 10 --max-ms 50 --python PythonSlicer]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'septum_analysis')
+
+HEAVY_MODULES = ['numpy', 'cv2', 'scipy', 'nibabel', 'SegmentEditorEffects']
+
+MEASURE_IMPORT = """
+import json, sys, time
+sys.path.insert(0, {path!r})
+start = time.perf_counter()
+import septum_analysisLib
+seconds = time.perf_counter() - start
+print(json.dumps({{'seconds': seconds, 'modules': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure_import(python: str) -> dict:
+    code = MEASURE_IMPORT.format(path=LIBRARY_PATH, heavy=HEAVY_MODULES)
+    output = subprocess.run([python, '-c', code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=50.0)
+    parser.add_argument('--python', default=sys.executable, help='interpreter to measure, e.g. PythonSlicer')
+    args = parser.parse_args(argv)
+
+    results = [measure_import(args.python) for _ in range(args.repeat)]
+    times = [result['seconds'] * 1000 for result in results]
+    heavyModules = sorted({name for result in results for name in result['modules']})
+    median = statistics.median(times)
+    print(f'import septum_analysisLib: median {median:.1f} ms, min {min(times):.1f} ms, max {max(times):.1f} ms')
+
+    failed = False
+    if heavyModules:
+        print(f'Imported with the package: {", ".join(heavyModules)}')
+        failed = True
+    if median > args.max_ms:
+        print(f'Median import time is above {args.max_ms:.1f} ms')
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
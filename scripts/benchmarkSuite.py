@@ -0,0 +1,234 @@
+"""
+Times the septum_analysisLib stages on synthetic head phantoms and checks them against the benchmark history.
+
+Every run appends a JSON line with the seconds, throughput and peak memory of every stage to the history file.
+peakTracedBytes is the tracemalloc peak of the NumPy and Python allocations of a stage, for the stages of
+the segmentation pipeline it is traced by PipelineProfiler action by action. The memory is traced in one more
+run after the timed ones, so tracing does not slow down the timed runs.
+A stage is reported as a regression when it is slower than the median of its previous runs on the same
+phantom size by more than --max-slowdown, or when its peak memory grows over the median by more than
+--max-memory-growth. The nose bounds found on a phantom must be within --max-nose-error of the slices
+of its nose, as a fraction of the slice count. On a regression or a missed nose the exit status is 1.
+The ApplierLogicWithMask stages are timed on the array backend, which runs the same pipeline without
+the Segment Editor.
+
+Usage: python scripts/benchmarkSuite.py [--sizes 120x160x160 200x256x256 --history benchmarkHistory.jsonl]
+   or: Slicer --no-main-window --python-script scripts/benchmarkSuite.py --sizes 300x512x512
+"""
+import argparse
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'septum_analysis'))
+
+from septum_analysisLib.ArraySegmentation import ArrayApplierLogic
+from septum_analysisLib.FaceCurvature import NOSE_NOT_FOUND, analyze_face_curvature, find_nose_bounds
+from septum_analysisLib.GradientVolume import compute_gradient_volume
+from septum_analysisLib.Phantoms import make_head_phantom
+from septum_analysisLib.PipelineProfiler import PipelineProfiler
+from septum_analysisLib.VolumeAccessor import VolumeAccessor, normalize_slices_to_uint8
+
+DEFAULT_HISTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkHistory.jsonl')
+SINUS_THRESHOLD = -400
+# On the phantoms the bounds are within 0.15 of the slices of the nose, the smoothed signal widens the nose
+DEFAULT_MAX_NOSE_ERROR = 0.2
+
+
+def parse_size(text: str):
+    return tuple(int(value) for value in text.lower().split('x'))
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure(function, repeat: int):
+    """Best wall time of repeat calls and the peak of NumPy and Python allocations of one more call."""
+    seconds = []
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        function()
+        seconds.append(time.perf_counter() - startTime)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(seconds), peak
+
+
+def stage_result(seconds: float, shape, peakTracedBytes=None) -> dict:
+    return {
+        'seconds': seconds,
+        'slicesPerSecond': shape[0] / seconds if seconds else None,
+        'voxelsPerSecond': int(np.prod(shape)) / seconds if seconds else None,
+        'peakTracedBytes': peakTracedBytes,
+    }
+
+
+def nose_bounds_error(bounds, noseSlices):
+    """
+    Largest distance of the found bounds to the first and the last slice of the nose, in slices,
+    None when a bound is not found or the found slices miss the nose.
+    """
+    low, high = bounds
+    if NOSE_NOT_FOUND in bounds or high < noseSlices[0] or low > noseSlices[1]:
+        return None
+    return max(abs(low - noseSlices[0]), abs(high - noseSlices[1]))
+
+
+def benchmark_phantom(shape, repeat: int, workers: int = None) -> dict:
+    phantom = make_head_phantom(shape)
+    volume = VolumeAccessor(phantom.array, phantom.ijkToRAS)
+    images = normalize_slices_to_uint8(phantom.array)
+
+    stages = {
+        'normalize_slices': lambda: normalize_slices_to_uint8(phantom.array),
+        'face_curvature': lambda: analyze_face_curvature(images, workers),
+        'find_nose': lambda: find_nose_bounds(images, workers),
+        'sobel': lambda: compute_gradient_volume(phantom.array),
+    }
+    results = {}
+    for name, function in stages.items():
+        seconds, peak = measure(function, repeat)
+        results[name] = stage_result(seconds, shape, peakTracedBytes=peak)
+
+    noseBounds = find_nose_bounds(images, workers)
+    results['find_nose']['noseBounds'] = list(noseBounds)
+    results['find_nose']['noseSlices'] = list(phantom.noseSlices)
+    results['find_nose']['noseBoundsErrorSlices'] = nose_bounds_error(noseBounds, phantom.noseSlices)
+
+    # A new logic per run, so the mask cache of the previous run does not skip the mask stages.
+    # The last run traces the memory and is not timed.
+    profiles = []
+    for index in range(repeat + 1):
+        logic = ArrayApplierLogic()
+        profiler = PipelineProfiler(ArrayApplierLogic.countLabelmapVoxels, keepRuns=1, traceMemory=index == repeat)
+        profiler.attachTo(logic.pipeline)
+        logic.apply(volume, SINUS_THRESHOLD, phantom.sinusSeedsKJI)
+        profiles.append(profiler.lastRun)
+    tracedProfile = profiles.pop()
+    for actions, tracedAction in zip(zip(*(profile.actions for profile in profiles)), tracedProfile.actions):
+        best = min(actions, key=lambda action: action.wallSeconds)
+        results[f'pipeline.{best.name}'] = stage_result(best.wallSeconds, shape,
+                                                        peakTracedBytes=tracedAction.peakTracedBytes)
+    best = min(profiles, key=lambda profile: profile.wallSeconds)
+    results['pipeline'] = stage_result(best.wallSeconds, shape)
+    return results
+
+
+def find_regressions(history, record: dict, maxSlowdown: float, baselineRuns: int, minSeconds: float,
+                     maxMemoryGrowth: float, minMemoryBytes: int):
+    """
+    (size, stage, metric, value, baseline value) of the stages slower than their baseline by more than
+    maxSlowdown, or with a peak memory over its baseline by more than maxMemoryGrowth. Every metric is
+    compared only with the same metric of the previous runs. Slowdowns under minSeconds are timer noise of
+    the short stages and growths under minMemoryBytes allocator noise, both are ignored.
+    """
+    checks = [('seconds', maxSlowdown, minSeconds), ('peakTracedBytes', maxMemoryGrowth, minMemoryBytes)]
+    regressions = []
+    for size, results in record['results'].items():
+        previous = [entry['results'][size] for entry in history if size in entry.get('results', {})][-baselineRuns:]
+        for stage, result in results.items():
+            for metric, maxIncrease, minIncrease in checks:
+                if result.get(metric) is None:
+                    continue
+                baselineValues = [entry[stage][metric] for entry in previous
+                                  if entry.get(stage, {}).get(metric) is not None]
+                if not baselineValues:
+                    continue
+                baseline = statistics.median(baselineValues)
+                if result[metric] > baseline * (1 + maxIncrease) and result[metric] - baseline > minIncrease:
+                    regressions.append((size, stage, metric, result[metric], baseline))
+    return regressions
+
+
+def find_missed_noses(record: dict, maxNoseError: float):
+    """(size, found bounds, nose slices) of the phantoms whose nose bounds are off by more than maxNoseError."""
+    missed = []
+    for size, results in record['results'].items():
+        result = results['find_nose']
+        error = result['noseBoundsErrorSlices']
+        if error is None or error > maxNoseError * parse_size(size)[0]:
+            missed.append((size, tuple(result['noseBounds']), tuple(result['noseSlices'])))
+    return missed
+
+
+def format_metric(metric: str, value) -> str:
+    return f'{value:.3f} s' if metric == 'seconds' else f'{value / 2 ** 20:.1f} MB'
+
+
+def read_history(path: str):
+    if not os.path.exists(path):
+        return []
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['120x160x160'], help='phantom sizes, slices x rows x columns')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--history', default=DEFAULT_HISTORY)
+    parser.add_argument('--baseline-runs', type=int, default=5, help='previous runs the median baseline is taken of')
+    parser.add_argument('--max-slowdown', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    parser.add_argument('--min-seconds', type=float, default=0.01, help='smaller slowdowns are ignored')
+    parser.add_argument('--max-memory-growth', type=float, default=0.25, help='allowed memory growth, 0.25 is 25%%')
+    parser.add_argument('--min-memory-mb', type=float, default=1.0, help='smaller memory growths are ignored')
+    parser.add_argument('--max-nose-error', type=float, default=DEFAULT_MAX_NOSE_ERROR,
+                        help='allowed distance of the nose bounds to the phantom nose, as a fraction of the slices')
+    parser.add_argument('--no-record', action='store_true', help='check without appending to the history')
+    args = parser.parse_args(argv)
+
+    record = {
+        'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__,
+        'cpus': os.cpu_count(),
+        'results': {},
+    }
+    for size in args.sizes:
+        shape = parse_size(size)
+        results = benchmark_phantom(shape, args.repeat, args.workers)
+        record['results'][size] = results
+        for stage, result in results.items():
+            memory = ''
+            if result['peakTracedBytes'] is not None:
+                memory += f", traced peak {result['peakTracedBytes'] / 2 ** 20:.1f} MB"
+            print(f"{size} {stage}: {result['seconds']:.3f} s, {result['slicesPerSecond'] or 0:.1f} slices/s,"
+                  f" {(result['voxelsPerSecond'] or 0) / 1e6:.1f} Mvoxels/s{memory}")
+        print(f"{size} nose bounds: {tuple(results['find_nose']['noseBounds'])},"
+              f" phantom nose {tuple(results['find_nose']['noseSlices'])}")
+
+    regressions = find_regressions(read_history(args.history), record, args.max_slowdown, args.baseline_runs,
+                                   args.min_seconds, args.max_memory_growth, int(args.min_memory_mb * 2 ** 20))
+    for size, stage, metric, value, baseline in regressions:
+        print(f'Regression: {size} {stage} {metric} {format_metric(metric, value)}, '
+              f'baseline {format_metric(metric, baseline)}')
+    missedNoses = find_missed_noses(record, args.max_nose_error)
+    for size, bounds, noseSlices in missedNoses:
+        print(f'Nose missed: {size} bounds {bounds}, phantom nose {noseSlices}')
+
+    if not args.no_record:
+        with open(args.history, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+    sys.exit(1 if regressions or missedNoses else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,16 @@
-import sys
-
-CT_PATH_FILE = sys.argv[1]
-CT_SLICES_DIR = sys.argv[2]
+"""
+Exports the slices of a scan as exact-pixel 8/16-bit PNG files or as one compressed NPZ/Zarr stack.
 
-if not os.path.exists(CT_SLICES_DIR):
-  os.mkdir(CT_SLICES_DIR)
-
-nii_path = CT_PATH_FILE
+Usage: python scripts/niiGzToSliceImages.py scan.nii.gz slices/ [--window ct-bone --bits 16 --workers 8]
+   or: python scripts/niiGzToSliceImages.py scan.nii.gz slices.npz --format npz --axis coronal --start 100 --stop 200
+"""
+import os
+import sys
 
-nii_img = nib.load(nii_path)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'septum_analysis'))
 
-nii_data = nii_img.get_fdata()
+from septum_analysisLib.SliceExport import main
 
-output_dir = CT_SLICES_DIR
-if not os.path.exists(output_dir):
-    os.makedirs(output_dir)
 
-for i in range(nii_data.shape[2]):
-    plt.imshow(nii_data[:, :, i], cmap="gray")
-    plt.axis("off")
-    plt.savefig(os.path.join(output_dir, f"slice_{i}.png"), bbox_inches="tight", pad_inches=0)
-    plt.clf()
\ No newline at end of file
+if __name__ == '__main__':
+    sys.exit(main())
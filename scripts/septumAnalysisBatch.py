@@ -0,0 +1,16 @@
+"""
+Batch nasal septum analysis of a manifest of scans.
+
+Usage: python scripts/septumAnalysisBatch.py manifest.csv results.csv [--workers 8]
+   or: Slicer --no-main-window --python-script scripts/septumAnalysisBatch.py manifest.csv results.csv --workers 1
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'septum_analysis'))
+
+from septum_analysisLib.BatchAnalysis import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
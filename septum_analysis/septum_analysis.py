@@ -1,7 +1,13 @@
+import logging
 import os
 from typing import Annotated, Optional
 
-from septum_analysisLib import *
+# NumPy is bundled with Slicer. OpenCV, SciPy and nibabel are imported, and installed if missing,
+# by the septum_analysisLib submodules on first use, so that loading this module stays cheap.
+import numpy as np
+import vtk
+
+import slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 from slicer.parameterNodeWrapper import (
@@ -9,30 +15,9 @@ from slicer.parameterNodeWrapper import (
     WithinRange,
 )
 
-from slicer.util import pip_install
-
-
-try:
-    import cv2
-except:
-    pip_install('opencv-python')
-    import cv2
-
-try:
-    import numpy as np
-except:
-    pip_install('numpy')
-    import numpy as np
-
-try:
-    import nibabel as nib
-except:
-    pip_install('nibabel')
-    import nibabel as nib
-
 # from septum_detector import *
 
-from slicer import vtkMRMLScalarVolumeNode
+from slicer import vtkMRMLScalarVolumeNode, vtkMRMLLabelMapVolumeNode
 
 
 #
@@ -143,6 +128,9 @@ class septum_analysisWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.logic = None
         self._parameterNode = None
         self._parameterNodeGuiTag = None
+        self.downloadRunner = None
+        # Imported here, it loads the Segment Editor effects
+        from septum_analysisLib import CalculatorVolumeWidget
         self.calculatorVolumeWidget = CalculatorVolumeWidget()
 
     def setup(self) -> None:
@@ -212,6 +200,9 @@ class septum_analysisWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         """
         self.removeObservers()
         self.calculatorVolumeWidget.cleanup()
+        if self.downloadRunner is not None:
+            self.downloadRunner.cancel()
+        self.logic.cleanup()
 
     def enter(self) -> None:
         """
@@ -303,56 +294,61 @@ class septum_analysisWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 self.logic.process(self.ui.inputSelector.currentNode(), self.ui.invertedOutputSelector.currentNode(),
                                    self.ui.imageThresholdSliderWidget.value, not self.ui.invertOutputCheckBox.checked, showResult=False)
 
-    
-    '''
-    Downloads models if it was not already downloaded.
-    Returns true if successful.
-    '''
-    def downloadModels(self) -> bool:
-        import requests
-
-        MODELS_LINK = 'https://github.com/lucanchling/AMASSS_CBCT/releases/download/v1.0.2/AMASSS_Models.zip'
-        FILE_NAME = 'AMASSS_Models.zip'
-        FOLDER_PATH = 'AMASSS_Models'
-        
-        modelsPath = os.path.join(os.path.dirname(__file__), 'Resources', FILE_NAME)
-        modelsFolderPath = os.path.join(os.path.dirname(__file__), 'Resources', FOLDER_PATH)
-
-        if os.path.exists(modelsFolderPath):
-            return True
-
-        with open(modelsPath, 'wb') as modelsFile:
-            response = requests.get(MODELS_LINK, allow_redirects=True, stream=True)
-            total_length = int(response.headers.get('content-length'))
-            progress = slicer.util.createProgressDialog(value=0, maximum=total_length)
-
-            downloaded = 0
-            for data in response.iter_content(chunk_size=1024*1024):
-                downloaded += len(data)
-                modelsFile.write(data)
-                if progress.wasCanceled:
-                    return False
-                slicer.app.processEvents()
-                progress.setValue(downloaded)
-
-        import zipfile
-        with zipfile.ZipFile(modelsPath, 'r') as zip_ref:
-            zip_ref.extractall(modelsFolderPath)
-
-        os.remove(modelsPath)
-        return True
+    def getModelsDirectory(self) -> str:
+        return os.path.join(os.path.dirname(__file__), 'Resources', 'AMASSS_Models')
 
     def onDownloadModelButton(self) -> None:
-        with slicer.util.tryWithErrorDisplay("Unable to download!", waitCursor=True):
-            self.ui.downloadModelButton.enabled = not self.downloadModels()
-            if not self.ui.downloadModelButton.enabled:
-                self.ui.downloadModelButton.text = "Model downloaded!"
-               
+        """
+        Downloads the models in a background thread, an interrupted download is resumed on the next click.
+        """
+        from septum_analysisLib import (
+            BackgroundRunner, ModelDownloader, AMASSS_MODELS_URL, AMASSS_MODELS_SHA256, AMASSS_MODEL_PATTERNS,
+        )
+
+        downloader = ModelDownloader(AMASSS_MODELS_URL, self.getModelsDirectory(), AMASSS_MODELS_SHA256,
+                                     AMASSS_MODEL_PATTERNS)
+        if downloader.isDownloaded:
+            self.onModelsDownloaded()
+            return
+        if self.downloadRunner is None:
+            self.downloadRunner = BackgroundRunner()
+        runner = self.downloadRunner
+
+        progressDialog = slicer.util.createProgressDialog(labelText="Downloading models...", value=0, maximum=100)
+        progressDialog.connect('canceled()', runner.cancel)
+        self.ui.downloadModelButton.enabled = False
+        lastProgress = [None]
+
+        def onProgress(stage, done, total):
+            # Called from the worker thread for every chunk, the dialog is updated once per percent
+            percent = int(done * 100 / total) if total else 0
+            if lastProgress[0] == (stage, percent):
+                return
+            lastProgress[0] = (stage, percent)
+            label = "Downloading models..." if stage == 'download' else "Extracting models..."
+            runner.callInMainThread(lambda: (progressDialog.setLabelText(label), progressDialog.setValue(percent)))
+
+        def onFinished():
+            progressDialog.close()
+            self.ui.downloadModelButton.enabled = True
+
+        def onDone(directory):
+            onFinished()
+            self.onModelsDownloaded()
+
+        def onError(error):
+            onFinished()
+            slicer.util.errorDisplay(f"Unable to download!\n{error}")
+
+        runner.submit(lambda cancelEvent: downloader.run(onProgress, cancelEvent), onDone, onError, onFinished)
+
+    def onModelsDownloaded(self) -> None:
+        self.ui.downloadModelButton.enabled = False
+        self.ui.downloadModelButton.text = "Model downloaded!"
 
     def onProcessButton(self) -> None:
         inputVolume = str(self.ui.FileButton.currentPath)
-        FOLDER_PATH = 'AMASSS_Models'
-        modelDirectory = str(os.path.join(os.path.dirname(__file__), 'Resources', FOLDER_PATH))
+        modelDirectory = str(self.getModelsDirectory())
 
         import tempfile
 
@@ -393,89 +389,24 @@ class septum_analysisWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         temporaryDirectoryObject.cleanup()
 
     def onFindNoseButton(self) -> None:
-        plane1 = vtk.vtkPlaneSource()
-        plane2 = vtk.vtkPlaneSource()
-
-        min_coord = -100
-        max_coord = 100
-
         input_volume = str(self.ui.FileButton.currentPath)
 
-        nii_img = nib.load(input_volume)
-        data = nii_img.get_fdata()
-        images = []
+        volume = self.logic.getVolumeAccessor(input_volume)
 
-        for i in range(data.shape[2]):
-            d = data[:,:,i]
-            d_min = np.min(d)
-            d_max = np.max(d)
-            if d_max!=d_min:
-                d = (d-d_min)/(d_max-d_min)*255
-            else:
-                d = d*0
-            images.append(d.astype(np.uint8))
-
-        images=np.array(images)
-
-        low, high = self.logic.find_nose(images)
-
-        print(low, high)
-
-        low = (low / 240) * 200 - 100
-        high = (high / 240) * 200 - 100
-
-        plane1.SetOrigin(max_coord, max_coord, low)
-        plane1.SetPoint1(min_coord, max_coord, low)
-        plane1.SetPoint2(max_coord, min_coord, low)
-
-        plane2.SetOrigin(max_coord, max_coord, high)
-        plane2.SetPoint1(min_coord, max_coord, high)
-        plane2.SetPoint2(max_coord, min_coord, high)
-
-        boxNode = slicer.modules.models.logic().AddModel(plane1.GetOutputPort())
-        boxNode.GetDisplayNode().SetColor(1, 0, 0)
-        boxNode.GetDisplayNode().SetOpacity(0.8)
+        low, high = self.logic.find_nose(volume.normalizedSlices())
 
-        boxNode = slicer.modules.models.logic().AddModel(plane2.GetOutputPort())
-        boxNode.GetDisplayNode().SetColor(0, 1, 0)
-        boxNode.GetDisplayNode().SetOpacity(0.8)
+        logging.info(f'Nose bounds: slices {low} and {high}')
+        if low < 0 or high < 0:
+            slicer.util.warningDisplay("Nose bounds are not found in the scan")
+            return
 
+        self.logic.showNoseBounds(volume.ijkToRAS, volume.shape, [low], [high])
 
     def onApplySobielButton(self) -> None:
         input_volume = str(self.ui.FileButton.currentPath)
 
-        nii_img = nib.load(input_volume)
-        data = nii_img.get_fdata()
-
-        images = []
-
-        scale = 1
-        delta = 0
-        ddepth = cv2.CV_16S
-
-        for i in range(data.shape[2]):
-            image = data[:,:,i]
-            
-            image_gray = cv2.GaussianBlur(image, (3, 3), 0)
-            grad_x = cv2.Sobel(image_gray, ddepth, 1, 0, ksize=3, scale=scale, delta=delta, borderType=cv2.BORDER_DEFAULT)
-            grad_y = cv2.Sobel(image_gray, ddepth, 0, 1, ksize=3, scale=scale, delta=delta, borderType=cv2.BORDER_DEFAULT)
-            abs_grad_x = cv2.convertScaleAbs(grad_x)
-            abs_grad_y = cv2.convertScaleAbs(grad_y)
-            grad = cv2.addWeighted(abs_grad_x, 0.5, abs_grad_y, 0.5, 0)
-
-            images.append(grad.astype(np.uint8))
-
-        images=np.array(images)
-
-        img = nib.Nifti1Image(images, np.eye(4))
-
-        img.header.get_xyzt_units()
-
-        output_filename = os.path.join(os.path.split(input_volume)[0], "sobiel.nii.gz")
-
-        img.to_filename(output_filename) 
-
-        slicer.util.loadVolume(output_filename)
+        volume = self.logic.getVolumeAccessor(input_volume)
+        self.logic.createGradientVolume(volume.array, volume.ijkToRAS, "sobiel")
 
 #
 # septum_analysisLogic
@@ -496,10 +427,20 @@ class septum_analysisLogic(ScriptedLoadableModuleLogic):
         Called when the logic class is instantiated. Can be used for initializing member variables.
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        self.volumeNodeAccessor = None
+        self.sliceStackStore = None
 
     def getParameterNode(self):
         return septum_analysisParameterNode(super().getParameterNode())
 
+    def cleanup(self) -> None:
+        """Releases the decoded scans and drops the pending conversions of the slice stack store."""
+        from septum_analysisLib import clear_cached_volumes
+        clear_cached_volumes()
+        self.volumeNodeAccessor = None
+        if self.sliceStackStore is not None:
+            self.sliceStackStore.close()
+
     def process(self,
                 inputVolume: vtkMRMLScalarVolumeNode,
                 outputVolume: vtkMRMLScalarVolumeNode,
@@ -538,17 +479,111 @@ class septum_analysisLogic(ScriptedLoadableModuleLogic):
         logging.info(f'Processing completed in {stopTime-startTime:.2f} seconds')
 
 
-    def find_nose(self, images: cv2.Mat):
-        result, result1 = analyze_face_curvature(images)
-        tr0_0 = np.quantile(result, 0.3)
-        tr0_1 = np.quantile(result, 0.7)
-        # tr1 = np.quantile(result1, 0.5)
-        m = np.argmax(result)
-        intersections1 = np.argwhere(np.diff(np.sign(result - tr0_0))).flatten()
-        intersections2 = np.argwhere(np.diff(np.sign(result - tr0_1))).flatten()
-        place1 = np.searchsorted(intersections1, m)
-        place2 = np.searchsorted(intersections2, m)
-        return intersections1[place1 - 1], intersections2[place2]
+    def getVolumeAccessor(self, path: str) -> 'VolumeAccessor':
+        """
+        Voxels of the scan at path in their stored dtype.
+        The volume node of the scan is used if it is already loaded, otherwise the file is memory-mapped.
+        Compressed files are decoded on the first use and stored in the background,
+        later uses read them from the slice stack store.
+        """
+        from septum_analysisLib import open_volume
+        path = os.path.normcase(os.path.abspath(path))
+        for volumeNode in slicer.util.getNodesByClass("vtkMRMLScalarVolumeNode"):
+            storageNode = volumeNode.GetStorageNode()
+            if storageNode is None or not storageNode.GetFileName():
+                continue
+            if os.path.normcase(os.path.abspath(storageNode.GetFileName())) == path:
+                return self.getVolumeNodeAccessor(volumeNode)
+        return open_volume(path, self.getSliceStackStore())
+
+    def getSliceStackStore(self) -> 'SliceStackStore':
+        from septum_analysisLib import SliceStackStore
+        if self.sliceStackStore is None:
+            self.sliceStackStore = SliceStackStore()
+        return self.sliceStackStore
+
+    def getVolumeNodeAccessor(self, volumeNode: vtkMRMLScalarVolumeNode) -> 'VolumeAccessor':
+        """
+        Accessor of the volume node, reused while its voxels are not modified so that
+        derived data like normalized slices is computed once.
+        """
+        from septum_analysisLib import VolumeAccessor
+        key = (volumeNode.GetID(), volumeNode.GetImageData().GetMTime())
+        if self.volumeNodeAccessor is None or self.volumeNodeAccessor[0] != key:
+            self.volumeNodeAccessor = (key, VolumeAccessor.fromVolumeNode(volumeNode))
+        return self.volumeNodeAccessor[1]
+
+    def createGradientVolume(self, volumeArray: np.ndarray, ijkToRAS: np.ndarray, name: str,
+                             showResult: bool = True) -> vtkMRMLScalarVolumeNode:
+        """
+        Computes the Sobel gradient magnitude of every axial slice straight into the voxels of a new volume node.
+        :param volumeArray: source voxels indexed as (k, j, i)
+        :param ijkToRAS: 4x4 IJK to RAS matrix of the source volume, it is kept for the output volume
+        :param name: name of the created volume node
+        :param showResult: show output volume in slice viewers
+        """
+        from septum_analysisLib import compute_gradient_volume
+
+        outputVolume = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", name)
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(volumeArray.shape[2], volumeArray.shape[1], volumeArray.shape[0])
+        imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+        outputVolume.SetAndObserveImageData(imageData)
+        outputVolume.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(ijkToRAS))
+
+        compute_gradient_volume(volumeArray, out=slicer.util.arrayFromVolume(outputVolume))
+        slicer.util.arrayFromVolumeModified(outputVolume)
+
+        outputVolume.CreateDefaultDisplayNodes()
+        if showResult:
+            slicer.util.setSliceViewerLayers(background=outputVolume, fit=True)
+        return outputVolume
+
+    def traceSeptum(self, volume: 'VolumeAccessor', maxillaArray: np.ndarray, sliceRange: range = None,
+                    name: str = "septum", showResult: bool = True) -> vtkMRMLLabelMapVolumeNode:
+        """
+        Traces the nasal septum on the normalized axial slices by the wave propagation of the research notebook.
+        :param volume: scan to trace
+        :param maxillaArray: maxilla labelmap indexed as (k, j, i), e.g. the AMASSS prediction of the scan
+        :param sliceRange: traced axial slices, all of them by default
+        :param name: name of the created labelmap volume node
+        :param showResult: show the labelmap in slice viewers
+        """
+        from septum_analysisLib import trace_septum
+
+        labelmapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode", name)
+        slicer.util.updateVolumeFromArray(labelmapNode, trace_septum(volume.normalizedSlices(), maxillaArray, sliceRange))
+        labelmapNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(volume.ijkToRAS))
+        labelmapNode.CreateDefaultDisplayNodes()
+        if showResult:
+            slicer.util.setSliceViewerLayers(label=labelmapNode)
+        return labelmapNode
+
+    def find_nose(self, images: np.ndarray):
+        """
+        First and last slice of the nose, NOSE_NOT_FOUND for a bound that is not found.
+        The signal of a single scan is not smoothed, so the bounds stay those the module has always shown.
+        """
+        from septum_analysisLib import find_nose_bounds
+        return find_nose_bounds(images, smoothingWindow=1)
+
+    def showNoseBounds(self, ijkToRAS: np.ndarray, shape, lows, highs) -> None:
+        """
+        Places planes at the nose bound slices, the same two model nodes are updated on every call.
+        :param ijkToRAS: 4x4 IJK to RAS matrix of the scan
+        :param shape: (k, j, i) shape of the scan
+        :param lows, highs: bound slices, several of them show the bounds of a batch of results
+        """
+        from septum_analysisLib import NoseBoundPlanes
+        NoseBoundPlanes(slicer.mrmlScene).update(ijkToRAS, shape, lows, highs)
+
+    def findNoses(self, stacks) -> 'NoseBounds':
+        """
+        Nose bounds of many scans in one pass.
+        :param stacks: normalized slice stacks, or VolumeAccessor and SliceStack objects
+        """
+        from septum_analysisLib import find_nose_bounds_batch
+        return find_nose_bounds_batch(stacks)
 
 
 #
@@ -572,6 +607,31 @@ class septum_analysisTest(ScriptedLoadableModuleTest):
         """
         self.setUp()
         self.test_septum_analysis1()
+        self.test_normalize_slices_to_uint8()
+        self.test_array_segmentation_splits_thin_channel()
+        self.test_volume_histogram_thresholds()
+        self.test_slice_stack_store_round_trip()
+        self.test_slice_stack_store_converts_in_background_and_trims_disk()
+        self.test_slice_export_keeps_nifti_orientation()
+        self.test_model_downloader_resumes_and_verifies()
+        self.test_sinus_segmentation_on_phantom()
+        self.test_array_backend_matches_editor_pipeline()
+        self.test_segment_statistics_from_labelmaps()
+        self.test_results_accumulator_upserts_rows()
+        self.test_background_additive_apply_survives_cancel()
+        self.test_find_nose_bounds_batch_sentinels()
+        self.test_volume_hashes_skip_region_of_interest()
+        self.test_volume_statistics_cache_forgets_removed_nodes()
+        self.test_gradient_volume_slabs_and_errors()
+        self.test_batch_analysis_resumes_failed_scans()
+        self.test_batch_analysis_segments_phantom_sinus()
+        self.test_labelmap_cache_packs_and_evicts()
+        self.test_wave_propagation_traces_septum()
+        self.test_slice_geometry_planes()
+        self.test_background_runner_supersedes_and_cancels()
+        self.test_pipeline_profiler_traces_every_action()
+        self.test_threshold_offset_is_flushed_before_apply()
+        self.test_read_nrrd_spaces()
 
     def test_septum_analysis1(self):
         """ Ideally you should have several levels of tests.  At the lowest level
@@ -617,4 +677,912 @@ class septum_analysisTest(ScriptedLoadableModuleTest):
         self.assertEqual(outputScalarRange[0], inputScalarRange[0])
         self.assertEqual(outputScalarRange[1], inputScalarRange[1])
 
-        self.delayDisplay('Test passed')
\ No newline at end of file
+        self.delayDisplay('Test passed')
+
+    def test_normalize_slices_to_uint8(self):
+        """ Vectorized slice normalization must match the per-slice stretch it replaces,
+        including constant slices and chunk boundaries.
+        """
+        from septum_analysisLib import normalize_slices_to_uint8
+
+        volume = np.random.default_rng(0).integers(-1000, 3000, size=(70, 16, 24)).astype(np.int16)
+        volume[5] = 7
+
+        expected = []
+        for image in volume:
+            image_min = float(image.min())
+            image_max = float(image.max())
+            if image_max != image_min:
+                image = (image - image_min) / (image_max - image_min) * 255
+            else:
+                image = image * 0
+            expected.append(image.astype(np.uint8))
+
+        normalized = normalize_slices_to_uint8(volume, chunkSize=32)
+        self.assertEqual(normalized.dtype, np.uint8)
+        self.assertTrue(np.array_equal(normalized, np.array(expected)))
+        self.assertTrue(np.all(normalized[5] == 0))
+
+    def test_array_segmentation_splits_thin_channel(self):
+        """ The array backend must keep a seeded cavity and drop a neighbour joined by a channel
+        thinner than the minimum diameter.
+        """
+        from septum_analysisLib import ArrayApplierLogic, VolumeAccessor
+
+        k, j, i = np.ogrid[:60, :60, :80]
+        array = np.full((60, 60, 80), 40, dtype=np.int16)
+        leftCavity = (k - 30) ** 2 + (j - 30) ** 2 + (i - 25) ** 2 < 10 ** 2
+        rightCavity = (k - 30) ** 2 + (j - 30) ** 2 + (i - 55) ** 2 < 10 ** 2
+        array[leftCavity | rightCavity] = -900
+        array[30, 30, 25:56] = -900
+
+        logic = ArrayApplierLogic()
+        logic.minimumDiameter = 3.0
+        logic.minimumIslandSize = 100
+        labelmap = logic.apply(VolumeAccessor(array, np.eye(4)), -400, [(30, 30, 25)]).astype(bool)
+        self.assertTrue(np.all(labelmap[leftCavity]))
+        self.assertFalse(np.any(labelmap[rightCavity]))
+
+    def test_volume_histogram_thresholds(self):
+        """ The rebinned integer histogram must equal np.histogram, and the auto thresholds
+        of a two-mode volume must separate the modes.
+        """
+        from septum_analysisLib import (
+            compute_histogram, VolumeHistogram, DEFAULT_HISTOGRAM_BINS,
+            METHOD_TRIANGLE, METHOD_OTSU, METHOD_KITTLER_ILLINGWORTH,
+        )
+
+        rng = np.random.default_rng(0)
+        volume = np.concatenate([rng.normal(-800, 60, 40000), rng.normal(40, 40, 60000)])
+        volume = volume.astype(np.int16).reshape(10, 100, 100)
+
+        counts, edges = compute_histogram(volume)
+        expectedCounts, expectedEdges = np.histogram(volume, bins=DEFAULT_HISTOGRAM_BINS)
+        self.assertTrue(np.array_equal(counts, expectedCounts))
+        self.assertTrue(np.allclose(edges, expectedEdges))
+
+        histogram = VolumeHistogram(volume)
+        for method in (METHOD_OTSU, METHOD_KITTLER_ILLINGWORTH):
+            self.assertTrue(-600 < histogram.threshold(method) < -100)
+        self.assertTrue(-600 < histogram.threshold(METHOD_TRIANGLE) < 40)
+
+    def test_slice_stack_store_round_trip(self):
+        """ A stored scan must give back its voxels and normalized slices across chunk boundaries,
+        also after the in-memory chunks are dropped, and a whole scan must not be kept in memory twice.
+        """
+        import tempfile
+        from septum_analysisLib import SliceStackStore, VolumeAccessor, normalize_slices_to_uint8
+
+        array = np.random.default_rng(0).integers(-1000, 3000, size=(37, 12, 20)).astype(np.int16)
+        ijkToRAS = np.diag([0.5, 0.5, 2.0, 1.0])
+        with tempfile.TemporaryDirectory() as directory:
+            store = SliceStackStore(directory, chunkSlices=8, maxCachedBytes=3 * array[:8].nbytes)
+            store.convert(VolumeAccessor(array, ijkToRAS), 'scan')
+            store.clearMemory()
+
+            stack = store.load('scan')
+            self.assertEqual(stack.shape, array.shape)
+            self.assertTrue(np.array_equal(stack.spacing, [0.5, 0.5, 2.0]))
+            self.assertTrue(np.array_equal(stack.slab(5, 30), array[5:30]))
+            self.assertTrue(np.array_equal(stack.slice(-1), array[-1]))
+            self.assertTrue(np.array_equal(stack.slab(0, len(stack), normalized=True),
+                                           normalize_slices_to_uint8(array)))
+            self.assertLessEqual(store.cachedBytes, store.maxCachedBytes)
+
+            # The whole scan is read past the in-memory chunks
+            store.clearMemory()
+            volume = stack.toVolumeAccessor()
+            self.assertTrue(np.array_equal(volume.array, array))
+            self.assertTrue(np.array_equal(volume.normalizedSlices(), normalize_slices_to_uint8(array)))
+            self.assertEqual(store.cachedBytes, 0)
+
+    def test_slice_stack_store_converts_in_background_and_trims_disk(self):
+        """ Opening a compressed scan must not wait for its conversion, the next opening must read it
+        from the store, and the least recently used stacks must be removed above the disk budget.
+        """
+        import tempfile
+        from septum_analysisLib import (
+            SliceStackStore, VolumeAccessor, open_volume, clear_cached_volumes, require_module,
+        )
+        nib = require_module('nibabel')
+
+        array = np.random.default_rng(0).integers(-1000, 3000, size=(20, 12, 16)).astype(np.int16)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'scan.nii.gz')
+            nib.Nifti1Image(array.transpose(2, 1, 0), np.eye(4)).to_filename(path)
+            store = SliceStackStore(os.path.join(directory, 'store'), chunkSlices=8)
+            try:
+                clear_cached_volumes()
+                self.assertTrue(np.array_equal(open_volume(path, store).array, array))
+                # Conversions run one at a time, this job ends after the one of the scan
+                store.converter.submit(lambda: None).result()
+                self.assertIsNotNone(store.find(path))
+                clear_cached_volumes()
+                volume = open_volume(path, store)
+                self.assertTrue(np.array_equal(volume.array, array))
+                self.assertIsNotNone(volume._normalizedSlices)
+            finally:
+                store.close()
+                clear_cached_volumes()
+
+            stackBytes = store.storedStacks()[0][1]
+            store.maxDiskBytes = 2 * stackBytes
+            for key in ('first', 'second'):
+                store.convert(VolumeAccessor(array, np.eye(4)), key)
+            # Touching the first stack makes the second one the least recently used
+            os.utime(os.path.join(store.stackDirectory('second'), 'metadata.json'), ns=(0, 0))
+            store.load('first')
+            store.convert(VolumeAccessor(array, np.eye(4)), 'third')
+            keys = {stack[2] for stack in store.storedStacks()}
+            self.assertTrue({'first', 'third'} <= keys)
+            self.assertNotIn('second', keys)
+            self.assertLessEqual(sum(stack[1] for stack in store.storedStacks()), store.maxDiskBytes)
+
+    def test_slice_export_keeps_nifti_orientation(self):
+        """ Exported axial PNG files must have the rows and columns of nii_data[:, :, k] by default,
+        the planes of the Slicer array only with the array layout.
+        """
+        import tempfile
+        from septum_analysisLib import VolumeAccessor, export_slices, require_module, LAYOUT_ARRAY, FORMAT_NPZ
+        cv2 = require_module('cv2', 'opencv-python')
+
+        array = np.random.default_rng(0).integers(0, 256, size=(4, 6, 9)).astype(np.int16)
+        niiData = array.transpose(2, 1, 0)
+        volume = VolumeAccessor(array, np.eye(4))
+        with tempfile.TemporaryDirectory() as directory:
+            paths = export_slices(volume, os.path.join(directory, 'nifti'), indices=[2], window=(0, 255))
+            self.assertEqual(os.path.basename(paths[0]), 'slice_2.png')
+            image = cv2.imread(paths[0], cv2.IMREAD_UNCHANGED)
+            self.assertTrue(np.array_equal(image, niiData[:, :, 2]))
+
+            paths = export_slices(volume, os.path.join(directory, 'array'), indices=[2], window=(0, 255),
+                                  layout=LAYOUT_ARRAY)
+            self.assertTrue(np.array_equal(cv2.imread(paths[0], cv2.IMREAD_UNCHANGED), array[2]))
+
+            paths = export_slices(volume, os.path.join(directory, 'coronal.npz'), FORMAT_NPZ, 'coronal',
+                                  window=(0, 255))
+            with np.load(paths[0]) as stack:
+                self.assertTrue(np.array_equal(stack['slices'][3], niiData[:, 3, :]))
+                self.assertEqual(str(stack['layout']), 'nifti')
+
+            with self.assertRaises(ValueError):
+                export_slices(volume, directory, layout='radiological')
+
+    def test_gradient_volume_slabs_and_errors(self):
+        """ The gradient volume computed in parallel slabs must equal the slice by slice gradient,
+        and volumes or output buffers of a wrong shape or dtype must be rejected.
+        """
+        from septum_analysisLib import compute_gradient_volume, gradient_slice
+
+        volume = np.random.default_rng(0).integers(-1000, 3000, size=(10, 20, 24)).astype(np.int16)
+        expected = np.stack([gradient_slice(image.astype(np.float32), np.empty(image.shape, dtype=np.uint8))
+                             for image in volume])
+        out = np.empty(volume.shape, dtype=np.uint8)
+        self.assertIs(compute_gradient_volume(volume, out, slabSize=3, workers=2), out)
+        self.assertTrue(np.array_equal(out, expected))
+        self.assertTrue(np.array_equal(compute_gradient_volume(volume, workers=1), expected))
+
+        with self.assertRaises(ValueError):
+            compute_gradient_volume(volume[0])
+        with self.assertRaises(ValueError):
+            compute_gradient_volume(volume, np.empty(volume.shape, dtype=np.int16))
+        with self.assertRaises(ValueError):
+            compute_gradient_volume(volume, np.empty((9, 20, 24), dtype=np.uint8))
+
+    def test_batch_analysis_resumes_failed_scans(self):
+        """ A batch must report a missing scan as failed without stopping, a resumed batch must analyze
+        only the failed scans again, and an output with other columns must not be appended to.
+        """
+        import csv
+        import tempfile
+        from septum_analysisLib import make_head_phantom, read_manifest, run_batch, require_module, BATCH_COLUMNS
+        nib = require_module('nibabel')
+
+        phantom = make_head_phantom((40, 64, 64))
+        with tempfile.TemporaryDirectory() as directory:
+            nib.Nifti1Image(phantom.array.transpose(2, 1, 0), phantom.ijkToRAS).to_filename(
+                os.path.join(directory, 'head.nii.gz'))
+            manifestPath = os.path.join(directory, 'manifest.csv')
+            with open(manifestPath, 'w') as file:
+                file.write('id,path\nhead,head.nii.gz\nmissing,missing.nii.gz\n')
+            entries = read_manifest(manifestPath)
+            outputPath = os.path.join(directory, 'output.csv')
+
+            self.assertEqual(run_batch(entries, outputPath), 1)
+            self.assertEqual(run_batch(entries, outputPath), 1)
+            with open(outputPath, newline='') as file:
+                rows = list(csv.DictReader(file))
+            self.assertEqual([row['id'] for row in rows], ['head', 'missing', 'missing'])
+            self.assertEqual(rows[0]['status'], 'ok')
+            self.assertNotEqual(rows[0]['nose_low'], '')
+            self.assertTrue(all(row['status'] == 'failed' and row['error'] for row in rows[1:]))
+
+            with open(outputPath, 'w') as file:
+                file.write(','.join(BATCH_COLUMNS[:-1]) + '\n')
+            with self.assertRaises(ValueError):
+                run_batch(entries, outputPath)
+
+            with open(manifestPath, 'w') as file:
+                file.write('id,path\nhead,head.nii.gz\nhead,missing.nii.gz\n')
+            with self.assertRaises(ValueError):
+                read_manifest(manifestPath)
+
+    def test_batch_analysis_segments_phantom_sinus(self):
+        """ With seeds and no threshold in the manifest, the batch must grow the sinus from the automatic
+        threshold plus the offset and report the volume of the phantom sinus.
+        """
+        import csv
+        import tempfile
+        from septum_analysisLib import (
+            make_head_phantom, read_manifest, run_batch, require_module, VolumeAccessor, METHOD_TRIANGLE,
+        )
+        nib = require_module('nibabel')
+
+        phantom = make_head_phantom((80, 112, 112))
+        k, j, i = phantom.sinusSeedsKJI[0]
+        triangle = VolumeAccessor(phantom.array, phantom.ijkToRAS).statistics().thresholds[METHOD_TRIANGLE]
+        with tempfile.TemporaryDirectory() as directory:
+            nib.Nifti1Image(phantom.array.transpose(2, 1, 0), phantom.ijkToRAS).to_filename(
+                os.path.join(directory, 'head.nii.gz'))
+            manifestPath = os.path.join(directory, 'manifest.csv')
+            with open(manifestPath, 'w') as file:
+                file.write(f'id,path,seeds\nhead,head.nii.gz,{i} {j} {k}\n')
+            outputPath = os.path.join(directory, 'output.csv')
+            options = {'thresholdMethod': METHOD_TRIANGLE, 'thresholdOffset': 100.0}
+            self.assertEqual(run_batch(read_manifest(manifestPath), outputPath, options=options), 0)
+            with open(outputPath, newline='') as file:
+                row = next(csv.DictReader(file))
+
+        self.assertAlmostEqual(float(row['sinus_threshold']), triangle + 100.0)
+        sinusVoxels = int(np.count_nonzero(phantom.sinusMasks[0]))
+        self.assertAlmostEqual(int(row['sinus_voxels']), sinusVoxels, delta=0.02 * sinusVoxels)
+
+    def test_labelmap_cache_packs_and_evicts(self):
+        """ Packed labelmaps must give back their voxels, empty ones included, and the cache must find
+        labelmaps only by the volume, the parameters and the seeds, and evict them over its budget.
+        """
+        from septum_analysisLib import PackedLabelmap, LabelmapCache, array_content_hash
+
+        labelmap = np.zeros((8, 10, 12), dtype=np.uint8)
+        labelmap[2:5, 3:7, 4:9] = 1
+        labelmap[3, 4, 5] = 0
+        packed = PackedLabelmap(labelmap)
+        self.assertTrue(np.array_equal(packed.toArray(), labelmap))
+        self.assertTrue(packed.contains((2, 3, 4)))
+        self.assertFalse(packed.contains((3, 4, 5)))
+        self.assertFalse(packed.contains((0, 0, 0)))
+        empty = PackedLabelmap(np.zeros_like(labelmap))
+        self.assertFalse(empty.contains((2, 3, 4)))
+        self.assertEqual(np.count_nonzero(empty.toArray()), 0)
+
+        cache = LabelmapCache(memoryBudget=packed.nbytes)
+        cache.put('volume', ('threshold', -400), labelmap)
+        self.assertTrue(np.array_equal(cache.get('volume', ('threshold', -400)), labelmap))
+        self.assertIsNone(cache.get('other volume', ('threshold', -400)))
+        self.assertIsNone(cache.get('volume', ('threshold', -300)))
+        self.assertIsNone(cache.findContaining('volume', ('threshold', -400), [(2, 3, 4), (0, 0, 0)]))
+
+        cache.put('volume', ('threshold', -300), labelmap)
+        self.assertIsNone(cache.get('volume', ('threshold', -400)))
+        self.assertLessEqual(cache.memoryUsage, cache.memoryBudget)
+        # A labelmap over the whole budget is not cached at all
+        cache.put('volume', ('threshold', -200), np.ones_like(labelmap))
+        self.assertIsNone(cache.get('volume', ('threshold', -200)))
+        self.assertIsNotNone(cache.get('volume', ('threshold', -300)))
+
+        self.assertNotEqual(array_content_hash(labelmap), array_content_hash(labelmap.view(np.int8)))
+        self.assertNotEqual(array_content_hash(labelmap), array_content_hash(labelmap.reshape(4, 20, 12)))
+
+    def test_wave_propagation_traces_septum(self):
+        """ The septum path must run from the maxilla to the front of the nose through the tissue,
+        slices without a maxilla or without a tissue path must be left empty.
+        """
+        from septum_analysisLib import trace_septum_slice, trace_septum, find_wave_endpoints, tissue_mask
+
+        # Notebook layout: lateral rows, anterior-posterior columns
+        image = np.zeros((40, 50), dtype=np.uint8)
+        maxillaMask = np.zeros(image.shape, dtype=bool)
+        image[20, 5:40] = 200
+        image[10:31, 40:43] = 200
+        maxillaMask[10:31, 40:43] = True
+
+        self.assertEqual(find_wave_endpoints(maxillaMask, tissue_mask(image)), ((20, 42), (10, 40), (21, 40), (20, 5)))
+        septum = trace_septum_slice(image, maxillaMask)
+        self.assertTrue(septum[20, 5:43].all())
+        # In front of the maxilla only the septum itself is tissue
+        self.assertEqual(np.count_nonzero(septum[:, :40]), 35)
+
+        broken = image.copy()
+        broken[20, 20] = 0
+        self.assertIsNone(trace_septum_slice(broken, maxillaMask))
+        self.assertIsNone(trace_septum_slice(image, np.zeros_like(maxillaMask)))
+
+        volume = np.zeros((3,) + image.T.shape, dtype=np.uint8)
+        maxilla = np.zeros(volume.shape, dtype=np.uint8)
+        volume[1], maxilla[1] = image.T, maxillaMask.T
+        volume[2] = image.T
+        labelmap = trace_septum(volume, maxilla)
+        self.assertTrue(np.array_equal(labelmap[1].T != 0, septum))
+        self.assertEqual(np.count_nonzero(labelmap[[0, 2]]), 0)
+        self.assertEqual(np.count_nonzero(trace_septum(volume, maxilla, range(0, 1))), 0)
+
+    def test_slice_geometry_planes(self):
+        """ Axial planes must cover the voxel edges of their slices in RAS for flipped and scaled axes. """
+        from septum_analysisLib import ijk_to_ras_points, axial_slice_planes
+
+        ijkToRAS = np.array([
+            [-0.5, 0, 0, 10],
+            [0, -0.5, 0, 20],
+            [0, 0, 2.0, -30],
+            [0, 0, 0, 1],
+        ])
+        points = ijk_to_ras_points(ijkToRAS, np.zeros((2, 4, 3)))
+        self.assertEqual(points.shape, (2, 4, 3))
+        self.assertTrue(np.allclose(points, [10, 20, -30]))
+        self.assertTrue(np.allclose(ijk_to_ras_points(ijkToRAS, [1, 2, 3]), [9.5, 19, -24]))
+
+        planes = axial_slice_planes(ijkToRAS, (5, 4, 6), [0, 3])
+        self.assertEqual(planes.shape, (2, 3, 3))
+        self.assertTrue(np.allclose(planes[1], [[10.25, 20.25, -24], [7.25, 20.25, -24], [10.25, 18.25, -24]]))
+        self.assertTrue(np.allclose(planes[0, :, 2], -30))
+        self.assertEqual(axial_slice_planes(ijkToRAS, (5, 4, 6), []).shape, (0, 3, 3))
+
+    def test_background_runner_supersedes_and_cancels(self):
+        """ A superseded job must not call back, even with its progress, a cancelled job must call only
+        onCancelled, and a failing job must pass its exception to onError.
+        """
+        import threading
+        from septum_analysisLib import BackgroundRunner, PipelineCancelled
+
+        runner = BackgroundRunner()
+        calls = []
+        started = threading.Event()
+
+        def waitForCancel(cancelEvent):
+            started.set()
+            cancelEvent.wait(10)
+            # Progress reported after a cancel belongs to this job, it is dropped once the job is superseded
+            runner.callInMainThread(lambda: calls.append('progress'))
+            raise PipelineCancelled()
+
+        def finish():
+            runner.thread.join()
+            runner.processCallbacks()
+
+        def fail(cancelEvent):
+            raise RuntimeError('broken scan')
+
+        try:
+            runner.submit(waitForCancel, lambda result: calls.append('first done'),
+                          onCancelled=lambda: calls.append('first cancelled'))
+            self.assertTrue(started.wait(10))
+            runner.submit(lambda cancelEvent: 'second', calls.append)
+            finish()
+            self.assertEqual(calls, ['second'])
+
+            started.clear()
+            runner.submit(waitForCancel, lambda result: calls.append('third done'),
+                          onCancelled=lambda: calls.append('third cancelled'))
+            self.assertTrue(started.wait(10))
+            runner.cancel()
+            finish()
+            self.assertEqual(calls, ['second', 'progress', 'third cancelled'])
+
+            runner.submit(fail, lambda result: calls.append('fourth done'), onError=lambda e: calls.append(str(e)))
+            finish()
+            self.assertEqual(calls, ['second', 'progress', 'third cancelled', 'broken scan'])
+            self.assertFalse(runner.isRunning)
+        finally:
+            runner.cancel()
+            runner.timer.stop()
+
+    def test_model_downloader_resumes_and_verifies(self):
+        """ An interrupted download must resume with a Range request from a local server,
+        only the needed models must be extracted and a wrong checksum must be rejected.
+        """
+        import hashlib
+        import http.server
+        import io
+        import tempfile
+        import threading
+        import zipfile
+        from septum_analysisLib import ModelDownloader, ChecksumMismatch, COMPLETE_MARKER, github_release_asset_sha256
+
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zipFile:
+            zipFile.writestr('Models/MAX_model.pth', np.random.default_rng(0).bytes(300000))
+            zipFile.writestr('Models/MAND_model.pth', b'mandible')
+        content = archive.getvalue()
+        requestedRanges = []
+
+        class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                requestedRanges.append(self.headers.get('Range'))
+                start = int(self.headers['Range'][len('bytes='):-1]) if self.headers.get('Range') else 0
+                self.send_response(206 if start else 200)
+                if start:
+                    self.send_header('Content-Range', f'bytes {start}-{len(content) - 1}/{len(content)}')
+                self.send_header('Content-Length', str(len(content) - start))
+                self.end_headers()
+                self.wfile.write(content[start:])
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}/models.zip'
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                modelsDirectory = os.path.join(directory, 'Models')
+                with open(modelsDirectory + '.zip.part', 'wb') as part:
+                    part.write(content[:1000])
+                progress = []
+                downloader = ModelDownloader(url, modelsDirectory, hashlib.sha256(content).hexdigest(), ['*MAX*'])
+                downloader.run(lambda stage, done, total: progress.append((stage, done, total)))
+
+                self.assertEqual(requestedRanges, ['bytes=1000-'])
+                self.assertEqual(progress[-1], ('extract', 1, 1))
+                self.assertTrue(downloader.isDownloaded)
+                self.assertTrue(os.path.exists(os.path.join(modelsDirectory, 'Models', 'MAX_model.pth')))
+                self.assertFalse(os.path.exists(os.path.join(modelsDirectory, 'Models', 'MAND_model.pth')))
+
+                with self.assertRaises(ChecksumMismatch):
+                    ModelDownloader(url, os.path.join(directory, 'Other'), '0' * 64).run()
+                self.assertFalse(os.path.exists(os.path.join(directory, 'Other.zip.part')))
+
+                # Models extracted before the complete marker existed are not downloaded again,
+                # unlike a directory next to an interrupted download
+                legacyDirectory = os.path.join(directory, 'Legacy')
+                os.makedirs(os.path.join(legacyDirectory, 'Models'))
+                self.assertTrue(ModelDownloader(url, legacyDirectory).isDownloaded)
+                self.assertTrue(os.path.exists(os.path.join(legacyDirectory, COMPLETE_MARKER)))
+                interruptedDirectory = os.path.join(directory, 'Interrupted')
+                os.makedirs(os.path.join(interruptedDirectory, 'Models'))
+                with open(interruptedDirectory + '.zip.part', 'wb') as part:
+                    part.write(content[:1000])
+                self.assertFalse(ModelDownloader(url, interruptedDirectory).isDownloaded)
+                self.assertIsNone(github_release_asset_sha256(url))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_sinus_segmentation_on_phantom(self):
+        """ On a synthetic head the array pipeline must segment the seeded sinus exactly,
+        without leaking into the other sinus or the air around the head.
+        """
+        from septum_analysisLib import make_head_phantom, ArrayApplierLogic, VolumeAccessor
+
+        phantom = make_head_phantom((60, 100, 100))
+        leftSinus, rightSinus = phantom.sinusMasks
+        logic = ArrayApplierLogic()
+        # The sinuses of a small phantom are smaller than the default minimum island
+        logic.minimumIslandSize = 500
+        labelmap = logic.apply(VolumeAccessor(phantom.array, phantom.ijkToRAS), -400,
+                               [phantom.sinusSeedsKJI[0]]).astype(bool)
+        self.assertTrue(np.array_equal(labelmap, leftSinus))
+        self.assertFalse(np.any(labelmap & rightSinus))
+
+    def test_array_backend_matches_editor_pipeline(self):
+        """ The array backend must segment the phantom sinus like the Segment Editor pipeline. Its region
+        growing does not weigh intensities as GrowCut does, so the labelmaps must agree to a Dice coefficient
+        of 0.95 and a voxel count within 5%, without leaking into the other sinus.
+        """
+        import SegmentEditorEffects
+        from septum_analysisLib import (
+            make_head_phantom, ApplierLogicWithMask, ArrayApplierLogic, CalculatorVolume, UpdaterActionsSilent,
+            VolumeAccessor,
+        )
+
+        slicer.mrmlScene.Clear()
+        phantom = make_head_phantom((60, 100, 100))
+        leftSinus, rightSinus = phantom.sinusMasks
+        volumeNode = slicer.util.addVolumeFromArray(phantom.array, phantom.ijkToRAS)
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+        threshold = -400
+
+        editorApplierLogic = ApplierLogicWithMask(UpdaterActionsSilent())
+        editorApplierLogic.minimumIslandSize = 500
+        calculatorVolume = CalculatorVolume(editorApplierLogic, SegmentEditorEffects.METHOD_TRIANGLE, False)
+        calculatorVolume.enter()
+        try:
+            calculatorVolume.setSegmentationNode(segmentationNode)
+            calculatorVolume.setVolumeNode(volumeNode)
+            calculatorVolume.setSegmentName('Sinus')
+            segmentID = segmentationNode.GetSegmentation().AddEmptySegment('Sinus', 'Sinus')
+            calculatorVolume.segmentEditorNode.SetSelectedSegmentID(segmentID)
+            calculatorVolume.maximumThreshold = threshold
+            calculatorVolume.offsetThreshold = 0
+            ijkPoints = vtk.vtkPoints()
+            ijkPoints.InsertNextPoint(*phantom.sinusSeedsKJI[0][::-1])
+            calculatorVolume.applyTool(ijkPoints)
+            editorLabelmap = slicer.util.arrayFromSegmentBinaryLabelmap(
+                segmentationNode, segmentID, volumeNode
+            ).astype(bool)
+        finally:
+            calculatorVolume.exit()
+
+        arrayApplierLogic = ArrayApplierLogic()
+        arrayApplierLogic.minimumIslandSize = 500
+        arrayLabelmap = arrayApplierLogic.apply(VolumeAccessor(phantom.array, phantom.ijkToRAS), threshold,
+                                                [phantom.sinusSeedsKJI[0]]).astype(bool)
+
+        editorCount, arrayCount = np.count_nonzero(editorLabelmap), np.count_nonzero(arrayLabelmap)
+        self.assertGreater(editorCount, 0)
+        dice = 2 * np.count_nonzero(editorLabelmap & arrayLabelmap) / (editorCount + arrayCount)
+        self.assertGreaterEqual(dice, 0.95)
+        self.assertLessEqual(abs(arrayCount - editorCount), 0.05 * editorCount)
+        self.assertFalse(np.any(editorLabelmap & rightSinus))
+        self.assertFalse(np.any(arrayLabelmap & rightSinus))
+
+    def test_segment_statistics_from_labelmaps(self):
+        """ Voxel counts and volumes must be read from the labelmaps with the spacing,
+        and a new measurement must follow a modified segment.
+        """
+        from septum_analysisLib import make_head_phantom, SegmentStatisticsCalculator
+
+        slicer.mrmlScene.Clear()
+        phantom = make_head_phantom((60, 100, 100), spacing=(0.5, 0.5, 2.0), noise=0)
+        volumeNode = slicer.util.addVolumeFromArray(phantom.array, phantom.ijkToRAS)
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+        segmentIDs = []
+        for name, mask in zip(('Left sinus', 'Right sinus'), phantom.sinusMasks):
+            segmentID = segmentationNode.GetSegmentation().AddEmptySegment(name, name)
+            slicer.util.updateSegmentBinaryLabelmapFromArray(mask.astype(np.uint8), segmentationNode, segmentID,
+                                                             volumeNode)
+            segmentIDs.append(segmentID)
+
+        calculator = SegmentStatisticsCalculator()
+        measurements = calculator.measure(segmentationNode)
+        for measurement, mask in zip(measurements, phantom.sinusMasks):
+            self.assertEqual(measurement.voxelCount, np.count_nonzero(mask))
+            self.assertAlmostEqual(measurement.volumeMm3, np.count_nonzero(mask) * 0.5)
+            self.assertAlmostEqual(measurement.volumeCm3, measurement.volumeMm3 / 1000)
+            self.assertIsNone(measurement.surfaceAreaMm2)
+
+        smallerMask = phantom.sinusMasks[0].copy()
+        smallerMask[:30] = False
+        slicer.util.updateSegmentBinaryLabelmapFromArray(smallerMask.astype(np.uint8), segmentationNode,
+                                                         segmentIDs[0], volumeNode)
+        measurements = calculator.measure(segmentationNode, computeSurfaceArea=True)
+        self.assertEqual(measurements[0].voxelCount, np.count_nonzero(smallerMask))
+        self.assertEqual(measurements[1].voxelCount, np.count_nonzero(phantom.sinusMasks[1]))
+        self.assertTrue(all(measurement.surfaceAreaMm2 > 0 for measurement in measurements))
+
+    def test_results_accumulator_upserts_rows(self):
+        """ Saving the same volume again must update its rows in place, also after the volume is renamed,
+        a new volume must append rows, and the files must get only the changed rows.
+        Files written with other columns must not be appended to.
+        """
+        import csv
+        import sqlite3
+        import tempfile
+        from septum_analysisLib import (
+            ResultsAccumulator, SegmentMeasurement, results_sink, SQLITE_TABLE_NAME, VOLUME_COLUMN,
+        )
+
+        tableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
+        with tempfile.TemporaryDirectory() as directory:
+            for fileName in ('results.csv', 'results.db'):
+                accumulator = ResultsAccumulator(results_sink(os.path.join(directory, fileName)))
+                accumulator.setTableNode(tableNode)
+                left, right = SegmentMeasurement('1', 'Left', 100, 0.5), SegmentMeasurement('2', 'Right', 200, 0.5)
+                self.assertEqual(len(accumulator.upsert('/scans/patient1.nrrd', [left, right], 'CT')), 2)
+                right = SegmentMeasurement('2', 'Right', 210, 0.5)
+                self.assertEqual(len(accumulator.upsert('/scans/patient1.nrrd', [left, right], 'CT')), 1)
+                self.assertEqual(len(accumulator.upsert('/scans/patient2.nrrd', [left], 'CT')), 1)
+                # Renaming the volume changes only the name shown in its rows
+                self.assertEqual(len(accumulator.upsert('/scans/patient2.nrrd', [left], 'CT patient2')), 1)
+                accumulator.close()
+
+                self.assertEqual(tableNode.GetNumberOfRows(), 3)
+                self.assertEqual(tableNode.GetTable().GetColumnByName('Number of voxels').GetValue(1), 210)
+                self.assertEqual(tableNode.GetTable().GetColumnByName(VOLUME_COLUMN).GetValue(2), 'CT patient2')
+                tableNode.RemoveAllColumns()
+
+            with open(os.path.join(directory, 'results.csv')) as file:
+                self.assertEqual(len(list(csv.DictReader(file))), 5)
+            connection = sqlite3.connect(os.path.join(directory, 'results.db'))
+            rows = connection.execute(f'SELECT "Number of voxels" FROM {SQLITE_TABLE_NAME}').fetchall()
+            connection.close()
+            self.assertEqual(sorted(rows), [(100,), (100,), (210,)])
+
+            oldPath = os.path.join(directory, 'old.csv')
+            with open(oldPath, 'w') as file:
+                file.write('Volume,Segment,Number of voxels\nCT,Left,100\n')
+            with self.assertRaises(ValueError):
+                results_sink(oldPath).write([('/scans/patient1.nrrd', 'Left', 'CT', 100, 0.5, 0.0005, None)])
+            oldPath = os.path.join(directory, 'old.db')
+            connection = sqlite3.connect(oldPath)
+            connection.execute(f'CREATE TABLE {SQLITE_TABLE_NAME} ("Volume", "Segment")')
+            connection.close()
+            with self.assertRaises(ValueError):
+                results_sink(oldPath)
+
+    def test_background_additive_apply_survives_cancel(self):
+        """ In the additive state a cancelled background job must leave the segment as it was,
+        and the next click must unite its region with the segment of before the cancelled click.
+        """
+        import threading
+        import SegmentEditorEffects
+        from septum_analysisLib import make_head_phantom, ApplierLogicOnArrays, BackgroundRunner, CalculatorVolume
+
+        slicer.mrmlScene.Clear()
+        phantom = make_head_phantom((60, 100, 100))
+        leftSinus, rightSinus = phantom.sinusMasks
+        volumeNode = slicer.util.addVolumeFromArray(phantom.array, phantom.ijkToRAS)
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+
+        runner = BackgroundRunner()
+        applierLogic = ApplierLogicOnArrays(runner=runner)
+        applierLogic.arrayApplierLogic.minimumIslandSize = 500
+        calculatorVolume = CalculatorVolume(applierLogic, SegmentEditorEffects.METHOD_TRIANGLE, False)
+        calculatorVolume.enter()
+        calculatorVolume.setSegmentationNode(segmentationNode)
+        calculatorVolume.setVolumeNode(volumeNode)
+        calculatorVolume.setSegmentName('Sinus')
+        segmentID = segmentationNode.GetSegmentation().AddEmptySegment('Sinus', 'Sinus')
+        calculatorVolume.segmentEditorNode.SetSelectedSegmentID(segmentID)
+        calculatorVolume.maximumThreshold = -400
+
+        def click(seedKJI):
+            ijkPoints = vtk.vtkPoints()
+            ijkPoints.InsertNextPoint(*seedKJI[::-1])
+            calculatorVolume.applyTool(ijkPoints)
+
+        def waitForJob():
+            runner.thread.join()
+            runner.processCallbacks()
+
+        def segmentArray():
+            return slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentID, volumeNode).astype(bool)
+
+        try:
+            click(phantom.sinusSeedsKJI[0])
+            waitForJob()
+            self.assertTrue(np.array_equal(segmentArray(), leftSinus))
+
+            calculatorVolume.setIsAdditiveState(True)
+            # The blocking job holds the worker, so the cancel surely comes before the click's job starts
+            release = threading.Event()
+            runner.submit(lambda cancelEvent: release.wait(), lambda _: None)
+            click(phantom.sinusSeedsKJI[1])
+            self.assertTrue(np.array_equal(segmentArray(), leftSinus))
+            runner.cancel()
+            release.set()
+            waitForJob()
+            self.assertTrue(np.array_equal(segmentArray(), leftSinus))
+
+            click(phantom.sinusSeedsKJI[1])
+            waitForJob()
+            self.assertTrue(np.array_equal(segmentArray(), leftSinus | rightSinus))
+        finally:
+            runner.cancel()
+            calculatorVolume.exit()
+
+    def test_find_nose_bounds_batch_sentinels(self):
+        """ Failed and empty stacks must get NOSE_NOT_FOUND bounds and an error instead of raising,
+        also when every stack of the batch fails, while the good stacks keep their bounds.
+        The module must find the bounds of a single scan without smoothing its signal.
+        """
+        from septum_analysisLib import (
+            make_head_phantom, normalize_slices_to_uint8, find_nose_bounds, find_nose_bounds_batch, NOSE_NOT_FOUND
+        )
+
+        images = normalize_slices_to_uint8(make_head_phantom((60, 100, 100)).array)
+        notAStack = np.zeros(3, dtype=np.uint8)
+        emptyStack = np.zeros((0, 4, 4), dtype=np.uint8)
+
+        bounds = find_nose_bounds_batch([images, notAStack, emptyStack])
+        self.assertEqual((bounds.low[0], bounds.high[0]), find_nose_bounds(images))
+        self.assertTrue(bounds.found[0])
+        self.assertEqual(list(bounds.low[1:]), [NOSE_NOT_FOUND] * 2)
+        self.assertEqual(list(bounds.high[1:]), [NOSE_NOT_FOUND] * 2)
+        self.assertEqual(set(bounds.errors), {1})
+
+        for stacks in ([notAStack], [emptyStack], [notAStack, emptyStack], []):
+            bounds = find_nose_bounds_batch(stacks)
+            self.assertTrue(np.all(bounds.low == NOSE_NOT_FOUND) and np.all(bounds.high == NOSE_NOT_FOUND))
+            self.assertFalse(bounds.found.any())
+
+        # The error of the stack, not one of the crossing search
+        with self.assertRaises(ValueError) as context:
+            find_nose_bounds(notAStack)
+        self.assertNotIn('argmax', str(context.exception))
+
+        # A single scan keeps the bounds of the raw signal, the batch smooths it
+        images = normalize_slices_to_uint8(make_head_phantom((120, 160, 160)).array)
+        self.assertEqual(septum_analysisLogic().find_nose(images), (34, 44))
+        self.assertEqual(find_nose_bounds(images), (18, 52))
+
+    def test_volume_hashes_skip_region_of_interest(self):
+        """ Hashing another volume must not evict the hash of the main one, a changed volume must be hashed
+        again, and the temporary region of interest volumes of the Segment Editor pipeline are not hashed.
+        """
+        import types
+        from septum_analysisLib import ResultCache, ApplierLogicWithMask, volumeStatistics
+
+        slicer.mrmlScene.Clear()
+        ResultCache.volumeHashes.clear()
+        array = np.random.default_rng(0).integers(-1000, 1000, size=(20, 30, 40)).astype(np.int16)
+        mainNode = slicer.util.addVolumeFromArray(array)
+        otherNode = slicer.util.addVolumeFromArray(array[:10])
+        mainHash = ResultCache.volume_node_content_hash(mainNode)
+        ResultCache.volume_node_content_hash(otherNode)
+        self.assertEqual(set(ResultCache.volumeHashes), {mainNode.GetID(), otherNode.GetID()})
+        self.assertEqual(ResultCache.volume_node_content_hash(mainNode), mainHash)
+
+        array[0, 0, 0] += 1
+        slicer.util.updateVolumeFromArray(mainNode, array)
+        self.assertNotEqual(ResultCache.volume_node_content_hash(mainNode), mainHash)
+
+        # Observers of the scene, like the volume selector of the widget, must see the mark of the added node
+        markedOnAdding = []
+
+        @vtk.calldata_type(vtk.VTK_OBJECT)
+        def onNodeAdded(caller, eventId, node):
+            markedOnAdding.append(
+                node.GetHideFromEditors() and node.GetAttribute(ApplierLogicWithMask.REGION_OF_INTEREST_ATTRIBUTE)
+            )
+
+        observer = slicer.mrmlScene.AddObserver(slicer.vtkMRMLScene.NodeAddedEvent, onNodeAdded)
+        try:
+            roiNode = ApplierLogicWithMask.createRegionOfInterestNode('vtkMRMLScalarVolumeNode')
+        finally:
+            slicer.mrmlScene.RemoveObserver(observer)
+        self.assertEqual(markedOnAdding, ['1'])
+        slicer.util.updateVolumeFromArray(roiNode, array[5:10, 5:10, 5:10])
+        calculatorVolume = types.SimpleNamespace(
+            segmentEditorWidget=None, volumeNode=roiNode, maximumThreshold=0.0, offsetThreshold=0.0
+        )
+        data = ApplierLogicWithMask.Data(calculatorVolume, vtk.vtkPoints())
+        self.assertIsNone(data.volumeHash)
+        self.assertNotIn(roiNode.GetID(), ResultCache.volumeHashes)
+        # Nor are their statistics cached, the range is the one of the crop
+        self.assertNotIn(roiNode.GetID(), volumeStatistics.entries)
+        crop = array[5:10, 5:10, 5:10]
+        self.assertEqual((data.sourceVolumeMin, data.sourceVolumeMax), (crop.min(), crop.max()))
+
+    def test_volume_statistics_cache_forgets_removed_nodes(self):
+        """ A removed node must drop its statistics, and a new volume taking the ID of a volume
+        of a cleared scene must not get the statistics of the old one.
+        """
+        from septum_analysisLib import VolumeStatisticsCache
+
+        cache = VolumeStatisticsCache()
+        try:
+            slicer.mrmlScene.Clear()
+            darkNode = slicer.util.addVolumeFromArray(np.full((4, 5, 6), -1000, dtype=np.int16))
+            self.assertEqual(cache.get(darkNode).scalarRange, (-1000.0, -1000.0))
+            slicer.mrmlScene.RemoveNode(darkNode)
+            self.assertEqual(len(cache.entries), 0)
+
+            darkNode = slicer.util.addVolumeFromArray(np.full((4, 5, 6), -1000, dtype=np.int16))
+            cache.get(darkNode)
+            _, darkImageDataMTime, darkStatistics = cache.entries[darkNode.GetID()]
+            slicer.mrmlScene.Clear()
+            self.assertEqual(len(cache.entries), 0)
+
+            brightNode = slicer.util.addVolumeFromArray(np.full((4, 5, 6), 500, dtype=np.int16))
+            # As if the removal was missed and the new node reused the ID of the old one
+            cache.entries[brightNode.GetID()] = ([], darkImageDataMTime, darkStatistics)
+            self.assertEqual(cache.get(brightNode).scalarRange, (500.0, 500.0))
+        finally:
+            cache.clear()
+
+    def test_pipeline_profiler_traces_every_action(self):
+        """ Every action must get the peak of its own allocations, also when it stays under the peak
+        of an earlier action, and the tracing started by the profiler must be stopped after the run.
+        """
+        import tracemalloc
+        from septum_analysisLib import PipelineApplierLogic, PipelineProfiler, UpdaterActionsSilent
+
+        size = 16 * 2 ** 20
+
+        def allocateLarge(data):
+            data.append(np.ones(2 * size, dtype=np.uint8).sum())
+
+        def allocateSmall(data):
+            data.append(np.ones(size, dtype=np.uint8).sum())
+
+        pipeline = PipelineApplierLogic(UpdaterActionsSilent(), lambda source, points: [])
+        pipeline.addAction(allocateLarge)
+        pipeline.addAction(allocateSmall)
+        profiler = PipelineProfiler(len, traceMemory=True).attachTo(pipeline)
+        pipeline.run(None, [])
+        large, small = profiler.lastRun.actions
+        self.assertEqual((large.name, small.name), ('allocateLarge', 'allocateSmall'))
+        self.assertGreaterEqual(large.peakTracedBytes, 2 * size)
+        self.assertGreaterEqual(small.peakTracedBytes, size)
+        self.assertLess(small.peakTracedBytes, 2 * size)
+        self.assertEqual(small.voxels, 2)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIn('traced peak', profiler.lastRun.format())
+
+        profiler.traceMemory = False
+        pipeline.run(None, [])
+        self.assertIsNone(profiler.lastRun.actions[0].peakTracedBytes)
+
+    def test_threshold_offset_is_flushed_before_apply(self):
+        """ A click right after the offset slider is dragged must use the new offset, not wait for the debounce,
+        and the offset must not be set again when the timer had already fired.
+        """
+        import types
+        import qt
+        import SegmentEditorEffects
+        from septum_analysisLib import make_head_phantom, CalculatorVolume, CalculatorVolumeWidget
+
+        class RecordingApplierLogic:
+            def __init__(self):
+                self.offsets = []
+
+            def apply(self, calculatorVolume, ijkPoints, previousLabelmap=None):
+                self.offsets.append(calculatorVolume.offsetThreshold)
+
+        slicer.mrmlScene.Clear()
+        phantom = make_head_phantom((20, 32, 32))
+        volumeNode = slicer.util.addVolumeFromArray(phantom.array, phantom.ijkToRAS)
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+        applierLogic = RecordingApplierLogic()
+        calculatorVolume = CalculatorVolume(applierLogic, SegmentEditorEffects.METHOD_TRIANGLE, False)
+        widget = CalculatorVolumeWidget()
+        widget.logic = calculatorVolume
+        widget.ui = types.SimpleNamespace(thresholdOffset=types.SimpleNamespace(value=25.0))
+        widget.thresholdOffsetTimer = qt.QTimer()
+        widget.thresholdOffsetTimer.setSingleShot(True)
+        widget.thresholdOffsetTimer.setInterval(60000)
+        calculatorVolume.beforeApply = widget.flushThresholdOffset
+        calculatorVolume.enter()
+        try:
+            calculatorVolume.setSegmentationNode(segmentationNode)
+            calculatorVolume.setVolumeNode(volumeNode)
+            calculatorVolume.setSegmentName('Sinus')
+            segmentID = segmentationNode.GetSegmentation().AddEmptySegment('Sinus', 'Sinus')
+            calculatorVolume.segmentEditorNode.SetSelectedSegmentID(segmentID)
+            ijkPoints = vtk.vtkPoints()
+            ijkPoints.InsertNextPoint(*phantom.sinusSeedsKJI[0][::-1])
+
+            # The slider was dragged, the timer has not fired yet
+            widget.thresholdOffsetTimer.start()
+            calculatorVolume.applyTool(ijkPoints)
+            self.assertFalse(widget.thresholdOffsetTimer.isActive())
+            widget.ui.thresholdOffset.value = -10.0
+            calculatorVolume.applyTool(ijkPoints)
+        finally:
+            calculatorVolume.exit()
+        self.assertEqual(applierLogic.offsets, [25.0, 25.0])
+
+    def test_read_nrrd_spaces(self):
+        """ The voxels and the geometry of a NRRD file must be read in its space, LPS without a space field,
+        and a space that is not anatomical must be rejected instead of read as LPS.
+        """
+        import tempfile
+        from septum_analysisLib import read_nrrd
+
+        array = np.arange(2 * 3 * 4, dtype=np.int16).reshape(2, 3, 4)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'scan.nrrd')
+
+            def write(spaceField):
+                with open(path, 'wb') as file:
+                    file.write(f'NRRD0004\ntype: short\ndimension: 3\n{spaceField}sizes: 4 3 2\n'
+                               'space directions: (0.5,0,0) (0,0.5,0) (0,0,2)\nendian: little\nencoding: raw\n'
+                               'space origin: (10,20,30)\n\n'.encode('ascii'))
+                    file.write(array.astype('<i2').tobytes())
+
+            write('space: right-anterior-superior\n')
+            voxels, ijkToRAS = read_nrrd(path)
+            self.assertTrue(np.array_equal(voxels, array))
+            # Raw voxels are memory-mapped, the file is rewritten below
+            del voxels
+            self.assertTrue(np.allclose(ijkToRAS[:3, 3], [10, 20, 30]))
+            write('space: left-posterior-superior\n')
+            _, ijkToRAS = read_nrrd(path)
+            self.assertTrue(np.allclose(ijkToRAS[:3, :3], np.diag([-0.5, -0.5, 2])))
+            self.assertTrue(np.allclose(ijkToRAS[:3, 3], [-10, -20, 30]))
+            write('')
+            self.assertTrue(np.allclose(read_nrrd(path)[1], ijkToRAS))
+            write('space: scanner-xyz\n')
+            with self.assertRaises(ValueError):
+                read_nrrd(path)
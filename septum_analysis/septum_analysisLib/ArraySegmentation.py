@@ -0,0 +1,244 @@
+from .PipelineApplierLogic import PipelineApplierLogic, ConditionalAction, UpdaterActionsSilent
+from .ResultCache import LabelmapCache
+from .VolumeAccessor import VolumeAccessor
+from .utils import require_module, ijkPointsToKJI
+
+np = require_module('numpy')
+ndimage = require_module('scipy.ndimage', 'scipy')
+
+
+# Face connectivity, as used by vtkImageThresholdConnectivity and the Islands effect
+FACE_CONNECTIVITY = ndimage.generate_binary_structure(3, 1)
+
+
+def kernel_size_pixels(kernelSizeMm: float, spacingKJI) -> list:
+    """Kernel size in voxels rounded to the nearest odd number, as the Smoothing effect does."""
+    return [int(round((kernelSizeMm / spacing + 1) / 2) * 2 - 1) for spacing in spacingKJI]
+
+
+def ellipsoid_structure(sizeKJI) -> np.ndarray:
+    """Ellipsoidal kernel inscribed in the box, the same neighbourhood as vtkImageContinuousDilate3D."""
+    sizes = np.maximum(np.asarray(sizeKJI, dtype=int), 1)
+    grids = np.ogrid[tuple(slice(0, size) for size in sizes)]
+    distance = sum(((grid - (size - 1) * 0.5) / (size * 0.5)) ** 2 for grid, size in zip(grids, sizes))
+    return distance <= 1.0
+
+
+def threshold_mask(volume: np.ndarray, lower: float, upper: float) -> np.ndarray:
+    return (volume >= lower) & (volume <= upper)
+
+
+def morphological_closing(mask: np.ndarray, structure: np.ndarray) -> np.ndarray:
+    """
+    Dilation followed by erosion. As in VTK, the erosion ignores neighbours outside of the image,
+    so the result is not eroded at the image border.
+    """
+    if structure.size == 1:
+        return mask.copy()
+    dilated = ndimage.binary_dilation(mask, structure=structure)
+    return ndimage.binary_erosion(dilated, structure=structure, border_value=1)
+
+
+def grow_from_seeds(candidate: np.ndarray, seedsKJI, structure: np.ndarray) -> np.ndarray:
+    """
+    Region of the candidate voxels grown from the seeds, the counterpart of the GrowCut mode of Local Threshold.
+    The candidate is eroded by the minimum diameter kernel to cut thin connections. The eroded islands
+    hit by the seeds are foreground and the other islands are background. Both then compete for the voxels
+    removed by the erosion, growing by one voxel layer at a time, ties go to the background.
+    Unlike GrowCut the competition does not weigh intensity differences, so the result is not bit-identical
+    to the Segment Editor pipeline, test_array_backend_matches_editor_pipeline bounds the difference.
+    """
+    eroded = ndimage.binary_erosion(candidate, structure=structure) if structure.size > 1 else candidate
+    islands, _ = ndimage.label(eroded, structure=FACE_CONNECTIVITY)
+    seedLabels = [islands[seed] for seed in seedsKJI if islands[seed] != 0]
+    if not seedLabels:
+        return np.zeros(candidate.shape, dtype=bool)
+
+    foreground = np.isin(islands, seedLabels)
+    background = eroded & ~foreground
+    del islands
+    unassigned = candidate & ~eroded
+    while unassigned.any():
+        grownForeground = ndimage.binary_dilation(foreground, structure=FACE_CONNECTIVITY, mask=unassigned)
+        grownBackground = ndimage.binary_dilation(background, structure=FACE_CONNECTIVITY, mask=unassigned)
+        grownForeground &= ~grownBackground
+        if not grownForeground.any() and not grownBackground.any():
+            break
+        foreground |= grownForeground
+        background |= grownBackground
+        unassigned &= ~(grownForeground | grownBackground)
+    return foreground
+
+
+def remove_small_islands(labelmap: np.ndarray, minimumSize: int) -> np.ndarray:
+    """Removes face-connected islands of less than minimumSize voxels, as the Islands effect does."""
+    islands, count = ndimage.label(labelmap, structure=FACE_CONNECTIVITY)
+    if count == 0:
+        return labelmap
+    sizes = np.bincount(islands.ravel())
+    keep = sizes >= minimumSize
+    keep[0] = False
+    return keep[islands]
+
+
+class ArrayApplierLogic:
+    """
+    The ApplierLogicWithMask pipeline on NumPy arrays, without Segment Editor widgets:
+    threshold, closing and invert of the air mask, region growing from the seeds inside the mask,
+    small island removal and final closing.
+    """
+    DEFAULT_MINIMUM_DIAMETER = 1.0
+    DEFAULT_CLOSING_SMOOTHING_SIZE = 1.5
+    DEFAULT_CLOSING_SMOOTHING_SIZE_FOR_END = 1.5
+    DEFAULT_MINIMUM_ISLAND_SIZE = 3000
+
+    class Data:
+        def __init__(self, volume: VolumeAccessor, threshold: float, seedsKJI):
+            self.volumeAccessor = volume
+            self.volume = volume.array
+            self.spacingKJI = volume.spacing[::-1]
+            self.seedsKJI = [tuple(seed) for seed in seedsKJI]
+            self.threshold = threshold
+            # Computed once per accessor, the runs on the same accessor take them without touching the voxels
+            self.sourceVolumeMin, self.sourceVolumeMax = volume.statistics().scalarRange
+
+            self.isMaskRestored = False
+            self.mask = None
+            self.labelmap = None
+
+        @property
+        def volumeHash(self) -> str:
+            return self.volumeAccessor.contentHash()
+
+    def __init__(self, updaterActions=None):
+        self.minimumDiameter = self.DEFAULT_MINIMUM_DIAMETER
+        self.closingSmoothingSize = self.DEFAULT_CLOSING_SMOOTHING_SIZE
+        self.closingSmoothingSizeForEnd = self.DEFAULT_CLOSING_SMOOTHING_SIZE_FOR_END
+        self.minimumIslandSize = self.DEFAULT_MINIMUM_ISLAND_SIZE
+        # Without the cache no content hash of the volume is computed, for volumes segmented once
+        self.isMaskCacheEnabled = True
+        self.resultCache = LabelmapCache()
+        self.pipeline = PipelineApplierLogic(
+            updaterActions or UpdaterActionsSilent(),
+            lambda source, seedsKJI: ArrayApplierLogic.Data(*source, seedsKJI)
+        )
+
+        def restoreMask(data: ArrayApplierLogic.Data):
+            # The mask depends only on the volume, the threshold and the kernel size, not on the seeds
+            if not self.isMaskCacheEnabled:
+                return
+            mask = self.resultCache.get(data.volumeHash, self.getMaskParameters(data))
+            data.isMaskRestored = mask is not None
+            if data.isMaskRestored:
+                data.mask = mask.view(bool)
+
+        def isMaskNotRestored(data: ArrayApplierLogic.Data):
+            return not data.isMaskRestored
+
+        def thresholdVolume(data: ArrayApplierLogic.Data):
+            data.mask = threshold_mask(data.volume, data.threshold, data.sourceVolumeMax)
+
+        def closeMask(data: ArrayApplierLogic.Data):
+            structure = ellipsoid_structure(kernel_size_pixels(self.closingSmoothingSize, data.spacingKJI))
+            data.mask = morphological_closing(data.mask, structure)
+
+        def invertAndStoreMask(data: ArrayApplierLogic.Data):
+            np.logical_not(data.mask, out=data.mask)
+            if self.isMaskCacheEnabled:
+                self.resultCache.put(data.volumeHash, self.getMaskParameters(data), data.mask)
+
+        def growFromSeeds(data: ArrayApplierLogic.Data):
+            # Like Local Threshold in the editor, the region grows in the intensity range and is clipped by the mask
+            candidate = threshold_mask(data.volume, data.sourceVolumeMin, data.threshold)
+            structure = ellipsoid_structure(kernel_size_pixels(self.minimumDiameter, data.spacingKJI))
+            data.labelmap = grow_from_seeds(candidate, data.seedsKJI, structure) & data.mask
+
+        def removeSmallIslands(data: ArrayApplierLogic.Data):
+            data.labelmap = remove_small_islands(data.labelmap, self.minimumIslandSize)
+
+        def closeLabelmap(data: ArrayApplierLogic.Data):
+            structure = ellipsoid_structure(kernel_size_pixels(self.closingSmoothingSizeForEnd, data.spacingKJI))
+            data.labelmap = morphological_closing(data.labelmap, structure)
+
+        self.pipeline.addAction(restoreMask)
+        self.pipeline.addAction(ConditionalAction(isMaskNotRestored, thresholdVolume))
+        self.pipeline.addAction(ConditionalAction(isMaskNotRestored, closeMask))
+        self.pipeline.addAction(ConditionalAction(isMaskNotRestored, invertAndStoreMask))
+        self.pipeline.addAction(growFromSeeds)
+        self.pipeline.addAction(removeSmallIslands)
+        self.pipeline.addAction(closeLabelmap)
+
+    def getMaskParameters(self, data: Data) -> tuple:
+        return 'mask', data.threshold, self.closingSmoothingSize
+
+    @staticmethod
+    def countLabelmapVoxels(data: Data):
+        """Voxel counter for PipelineProfiler: the region once it is grown, the mask before."""
+        labelmap = data.labelmap if data.labelmap is not None else data.mask
+        return None if labelmap is None else int(np.count_nonzero(labelmap))
+
+    def apply(self, volume: VolumeAccessor, threshold: float, seedsKJI, cancelEvent=None) -> np.ndarray:
+        """
+        Returns the uint8 labelmap of the region grown from the (k, j, i) seeds.
+        Raises PipelineCancelled if cancelEvent is set before the last stage.
+        """
+        data = self.pipeline.run((volume, threshold), seedsKJI, cancelEvent)
+        return data.labelmap.astype(np.uint8)
+
+
+class ApplierLogicOnArrays:
+    """
+    Backend for CalculatorVolume running ArrayApplierLogic on the voxels of the volume node
+    instead of the Segment Editor effects. With a BackgroundRunner the pipeline runs in its worker thread
+    and the segment is updated in the main thread when it is done, so the click returns at once.
+    """
+
+    def __init__(self, updaterActions=None, runner=None):
+        self.runner = runner
+        if runner is not None and updaterActions is not None:
+            from .BackgroundRunner import UpdaterActionsInMainThread
+            updaterActions = UpdaterActionsInMainThread(updaterActions, runner)
+        self.arrayApplierLogic = ArrayApplierLogic(updaterActions)
+        self.volumeAccessor = None
+        self.volumeAccessorKey = None
+
+    def getVolumeAccessor(self, volumeNode) -> VolumeAccessor:
+        """
+        Accessor of the node, kept while its voxels and geometry are unchanged, so its content hash
+        is computed once. The scalar range comes from the statistics cached for the auto thresholds.
+        """
+        from .VolumeHistogram import volumeStatistics
+        key = (volumeNode.GetID(), volumeNode.GetImageData().GetMTime(), volumeNode.GetMTime())
+        if key != self.volumeAccessorKey:
+            self.volumeAccessor = VolumeAccessor.fromVolumeNode(volumeNode, volumeStatistics.get(volumeNode))
+            self.volumeAccessorKey = key
+        return self.volumeAccessor
+
+    def apply(self, calculatorVolume, ijkPoints, previousLabelmap=None):
+        """
+        The segment is written only when the result arrives, a cancelled or superseded job leaves it as it was.
+        previousLabelmap is the segment at the click, in the additive state the result is united with it.
+        """
+        volumeNode = calculatorVolume.volumeNode
+        segmentationNode = calculatorVolume.segmentationNode
+        segmentID = calculatorVolume.segmentEditorNode.GetSelectedSegmentID()
+        threshold = calculatorVolume.maximumThreshold + calculatorVolume.offsetThreshold
+        # The worker reads the voxels of the node, it must not be modified until the job is done
+        volume = self.getVolumeAccessor(volumeNode)
+        seedsKJI = ijkPointsToKJI(ijkPoints)
+
+        def updateSegment(labelmap):
+            # The nodes may have been switched or the segment removed while the job was running
+            if (calculatorVolume.volumeNode is not volumeNode
+                    or calculatorVolume.segmentationNode is not segmentationNode
+                    or segmentationNode.GetSegmentation().GetSegment(segmentID) is None):
+                return
+            calculatorVolume.writeResultLabelmap(labelmap, segmentID, previousLabelmap)
+
+        if self.runner is None:
+            updateSegment(self.arrayApplierLogic.apply(volume, threshold, seedsKJI))
+        else:
+            self.runner.submit(
+                lambda cancelEvent: self.arrayApplierLogic.apply(volume, threshold, seedsKJI, cancelEvent),
+                updateSegment
+            )
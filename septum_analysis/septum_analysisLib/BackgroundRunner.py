@@ -0,0 +1,114 @@
+import logging
+import queue
+import threading
+
+import qt
+
+from .PipelineApplierLogic import PipelineCancelled
+
+
+class BackgroundRunner:
+    """
+    Runs one job at a time in a worker thread. MRML and Qt must only be touched from the main thread,
+    so the worker posts callbacks into a queue that a timer of the main thread executes.
+    Submitting a job while another one is running cancels the running one: its results and
+    pending callbacks are dropped, and the new job starts once the old thread has stopped.
+    """
+    POLL_INTERVAL_MS = 50
+
+    def __init__(self):
+        self.generation = 0
+        self.cancelEvent = None
+        self.thread = None
+        self.callbacks = queue.Queue()
+        # Generation of the job run by the current worker thread
+        self.workerState = threading.local()
+        self.timer = qt.QTimer()
+        self.timer.setInterval(self.POLL_INTERVAL_MS)
+        self.timer.connect('timeout()', self.processCallbacks)
+
+    @property
+    def isRunning(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def submit(self, job, onDone, onError=None, onCancelled=None):
+        """
+        Runs job(cancelEvent) in the worker thread, then onDone(result) in the main thread.
+        A job stops early by raising PipelineCancelled once cancelEvent is set.
+        """
+        self.cancel()
+        self.generation += 1
+        generation = self.generation
+        cancelEvent = threading.Event()
+        previousThread = self.thread
+
+        def work():
+            self.workerState.generation = generation
+            # Jobs share caches of the logic, so they never overlap
+            if previousThread is not None:
+                previousThread.join()
+            try:
+                if cancelEvent.is_set():
+                    raise PipelineCancelled()
+                result = job(cancelEvent)
+                self.callInMainThread(lambda: onDone(result), generation)
+            except PipelineCancelled:
+                if onCancelled is not None:
+                    self.callInMainThread(onCancelled, generation)
+            except Exception as e:
+                logging.exception("Background job failed")
+                if onError is not None:
+                    # The name of the exception is unbound after the except block
+                    self.callInMainThread(lambda error=e: onError(error), generation)
+
+        self.cancelEvent = cancelEvent
+        self.thread = threading.Thread(target=work, daemon=True)
+        self.thread.start()
+        self.timer.start()
+
+    def cancel(self) -> None:
+        if self.cancelEvent is not None:
+            self.cancelEvent.set()
+
+    def jobGeneration(self) -> int:
+        """Generation of the job calling from its worker thread, the latest generation in other threads."""
+        return getattr(self.workerState, 'generation', self.generation)
+
+    def callInMainThread(self, callback, generation=None) -> None:
+        """
+        Queues a callback, it is dropped if another job was submitted after the job of the generation.
+        Without a generation the callback belongs to the job of the calling worker thread, so the calls of
+        a superseded job that is still running are dropped too.
+        """
+        self.callbacks.put((self.jobGeneration() if generation is None else generation, callback))
+
+    def processCallbacks(self) -> None:
+        while True:
+            try:
+                generation, callback = self.callbacks.get_nowait()
+            except queue.Empty:
+                break
+            if generation == self.generation:
+                callback()
+        if not self.isRunning and self.callbacks.empty():
+            self.timer.stop()
+
+
+class UpdaterActionsInMainThread:
+    """
+    Passes the progress of a pipeline running in the worker thread to an updater of the main thread.
+    The progress of a superseded job is dropped, so it cannot hide the progress bar of the next one.
+    """
+
+    def __init__(self, updaterActions, runner: BackgroundRunner):
+        self.updaterActions = updaterActions
+        self.runner = runner
+
+    def start(self, data=None):
+        self.runner.callInMainThread(lambda: self.updaterActions.start(), self.runner.jobGeneration())
+
+    def update(self, i, size, data=None):
+        self.runner.callInMainThread(lambda: self.updaterActions.update(i, size), self.runner.jobGeneration())
+
+    def finish(self, data=None):
+        self.runner.callInMainThread(lambda: self.updaterActions.finish(), self.runner.jobGeneration())
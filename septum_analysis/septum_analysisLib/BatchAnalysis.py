@@ -0,0 +1,217 @@
+"""
+Headless nasal septum analysis of many scans.
+
+The manifest is a CSV file with a "path" column and an optional "id" column, or a text file with one scan
+path per line. A CSV manifest may also give "seeds" ("i j k" voxel indices separated by ";") and "threshold"
+columns, then the sinus region grown from the seeds is segmented and its volume is reported. Without a threshold
+the automatic one of --threshold-method plus --threshold-offset is used, like the Threshold Offset slider of the
+module. Every scan produces one row of the output table, rows are appended as soon as a scan is done, so
+an interrupted run is resumed by starting it again with the same output: scans with an "ok" row are skipped
+and failed ones are retried.
+"""
+import argparse
+import csv
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from .ArraySegmentation import ArrayApplierLogic
+from .FaceCurvature import find_nose_bounds, NOSE_NOT_FOUND
+from .GradientVolume import compute_gradient_volume
+from .VolumeAccessor import VolumeAccessor
+from .VolumeHistogram import AUTO_THRESHOLD_METHODS, METHOD_TRIANGLE
+from .utils import require_module
+
+
+BATCH_COLUMNS = [
+    'id', 'path', 'status', 'error', 'seconds', 'load_seconds', 'nose_seconds',
+    'slices', 'rows', 'columns', 'dtype', 'spacing_i', 'spacing_j', 'spacing_k',
+    'intensity_min', 'intensity_max', 'intensity_mean',
+    'nose_low', 'nose_high', 'nose_low_s', 'nose_high_s',
+    'threshold_triangle', 'threshold_otsu', 'threshold_kittler_illingworth',
+    'sinus_threshold', 'sinus_voxels', 'sinus_mm3', 'sinus_seconds',
+]
+
+
+def read_manifest(path: str):
+    """Returns the scans of a manifest as a list of {'id', 'path'} dictionaries."""
+    baseDirectory = os.path.dirname(os.path.abspath(path))
+    with open(path, newline='') as file:
+        if path.lower().endswith('.csv'):
+            reader = csv.DictReader(file)
+            if 'path' not in (reader.fieldnames or []):
+                raise ValueError(f"Manifest {path} has no 'path' column")
+            entries = [dict(row) for row in reader]
+        else:
+            entries = [{'path': line.strip()} for line in file if line.strip() and not line.startswith('#')]
+
+    for entry in entries:
+        entry['path'] = os.path.join(baseDirectory, entry['path'])
+        if not entry.get('id'):
+            entry['id'] = os.path.basename(entry['path'])
+    ids = [entry['id'] for entry in entries]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Scan ids in the manifest must be unique")
+    return entries
+
+
+def parse_seeds(text: str):
+    """(k, j, i) indices of the "i j k; i j k" seeds of a manifest."""
+    seeds = []
+    for seed in text.split(';'):
+        i, j, k = (int(value) for value in seed.split())
+        seeds.append((k, j, i))
+    return seeds
+
+
+def analyze_scan(entry: dict, options: dict) -> dict:
+    """Analyses one scan, never raises: failures are reported in the 'status' and 'error' columns."""
+    row = {'id': entry['id'], 'path': entry['path']}
+    startTime = time.perf_counter()
+    try:
+        volume = VolumeAccessor.fromFile(entry['path'])
+        array = volume.array
+        row['slices'], row['rows'], row['columns'] = array.shape
+        row['dtype'] = str(array.dtype)
+        row['spacing_i'], row['spacing_j'], row['spacing_k'] = volume.spacing
+        row['intensity_min'] = array.min()
+        row['intensity_max'] = array.max()
+        row['intensity_mean'] = array.mean(dtype=np.float64)
+        statistics = volume.statistics()
+        for method, threshold in statistics.thresholds.items():
+            row[f'threshold_{method.lower()}'] = threshold
+        row['load_seconds'] = time.perf_counter() - startTime
+
+        noseStartTime = time.perf_counter()
+        low, high = find_nose_bounds(volume.normalizedSlices(), workers=options.get('threads'))
+        row['nose_low'], row['nose_high'] = low, high
+        # Superior RAS coordinate of the bound slices, empty for NOSE_NOT_FOUND
+        if low != NOSE_NOT_FOUND:
+            row['nose_low_s'] = (volume.ijkToRAS @ [0, 0, low, 1])[2]
+        if high != NOSE_NOT_FOUND:
+            row['nose_high_s'] = (volume.ijkToRAS @ [0, 0, high, 1])[2]
+        row['nose_seconds'] = time.perf_counter() - noseStartTime
+
+        if entry.get('seeds'):
+            sinusStartTime = time.perf_counter()
+            if entry.get('threshold'):
+                row['sinus_threshold'] = float(entry['threshold'])
+            else:
+                method = options.get('thresholdMethod', METHOD_TRIANGLE)
+                row['sinus_threshold'] = statistics.thresholds[method] + options.get('thresholdOffset', 0.0)
+            applierLogic = ArrayApplierLogic()
+            # Every scan is segmented once, a cached mask would never be reused
+            applierLogic.isMaskCacheEnabled = False
+            labelmap = applierLogic.apply(volume, row['sinus_threshold'], parse_seeds(entry['seeds']))
+            row['sinus_voxels'] = int(np.count_nonzero(labelmap))
+            row['sinus_mm3'] = row['sinus_voxels'] * float(np.prod(volume.spacing))
+            row['sinus_seconds'] = time.perf_counter() - sinusStartTime
+
+        if options.get('gradientDirectory'):
+            save_gradient_volume(volume, os.path.join(options['gradientDirectory'], f"{entry['id']}_sobel.nii.gz"))
+
+        row['status'] = 'ok'
+    except Exception as e:
+        row['status'] = 'failed'
+        row['error'] = f'{type(e).__name__}: {e}'
+    row['seconds'] = time.perf_counter() - startTime
+    return row
+
+
+def save_gradient_volume(volume: VolumeAccessor, path: str) -> None:
+    nib = require_module('nibabel')
+    gradient = compute_gradient_volume(volume.array)
+    nib.Nifti1Image(gradient.transpose(2, 1, 0), volume.ijkToRAS).to_filename(path)
+
+
+def read_finished_ids(outputPath: str):
+    """Ids of the scans whose last row in an existing output is successful."""
+    if not os.path.exists(outputPath):
+        return set()
+    with open(outputPath, newline='') as file:
+        reader = csv.DictReader(file)
+        if reader.fieldnames != BATCH_COLUMNS:
+            raise ValueError(f"{outputPath} was written with other columns, choose a new output file")
+        lastStatus = {row['id']: row['status'] for row in reader}
+    return {scanId for scanId, status in lastStatus.items() if status == 'ok'}
+
+
+def run_batch(entries, outputPath: str, workers: int = 1, options: dict = None, resume: bool = True):
+    """
+    Analyses the scans in a process pool and appends a row per scan to the outputPath CSV file.
+    Returns the number of failed scans.
+    """
+    options = options or {}
+    finishedIds = read_finished_ids(outputPath) if resume else set()
+    pending = [entry for entry in entries if entry['id'] not in finishedIds]
+    logging.info(f'{len(entries) - len(pending)} scans already done, {len(pending)} to analyze')
+
+    isNewFile = not resume or not os.path.exists(outputPath)
+    failedCount = 0
+    with open(outputPath, 'w' if isNewFile else 'a', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=BATCH_COLUMNS)
+        if isNewFile:
+            writer.writeheader()
+
+        def writeRow(row):
+            writer.writerow(row)
+            file.flush()
+            logging.info(f"{row['id']}: {row['status']} in {row['seconds']:.1f} s {row.get('error') or ''}")
+            return row['status'] != 'ok'
+
+        if workers <= 1:
+            for entry in pending:
+                failedCount += writeRow(analyze_scan(entry, options))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(analyze_scan, entry, options) for entry in pending]
+                for future in as_completed(futures):
+                    failedCount += writeRow(future.result())
+    return failedCount
+
+
+def convert_to_parquet(csvPath: str, parquetPath: str) -> None:
+    """Writes the last row of every scan to a Parquet table, requires pandas with pyarrow."""
+    import pandas as pd
+    table = pd.read_csv(csvPath)
+    table.drop_duplicates('id', keep='last').to_parquet(parquetPath, index=False)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('manifest', help='CSV with a "path" column or a text file with a scan path per line')
+    parser.add_argument('output', help='output table, .csv or .parquet')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='scans analyzed in parallel, use 1 inside Slicer')
+    parser.add_argument('--threads', type=int, default=1, help='threads per scan')
+    parser.add_argument('--no-resume', action='store_true', help='analyze all scans again')
+    parser.add_argument('--gradient-dir', help='also save Sobel gradient volumes into this directory')
+    parser.add_argument('--threshold-method', default=METHOD_TRIANGLE, choices=list(AUTO_THRESHOLD_METHODS),
+                        help='automatic sinus threshold for scans without one in the manifest')
+    parser.add_argument('--threshold-offset', type=float, default=0.0,
+                        help='added to the automatic threshold, the raw one leaves out the sinus air near tissue')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    isParquet = args.output.lower().endswith('.parquet')
+    csvPath = args.output + '.csv' if isParquet else args.output
+    if isParquet:
+        # Fail before hours of processing, not after them
+        import pandas  # noqa: F401
+    if args.gradient_dir:
+        os.makedirs(args.gradient_dir, exist_ok=True)
+
+    options = {
+        'threads': args.threads,
+        'gradientDirectory': args.gradient_dir,
+        'thresholdMethod': args.threshold_method,
+        'thresholdOffset': args.threshold_offset,
+    }
+    failedCount = run_batch(read_manifest(args.manifest), csvPath, args.workers, options, not args.no_resume)
+    if isParquet:
+        convert_to_parquet(csvPath, args.output)
+    return 1 if failedCount else 0
@@ -1,10 +1,10 @@
 import logging
 
+import numpy as np
 import vtk
 import slicer
 from typing import List
 
-import SegmentStatistics
 import inspect
 from MRMLCorePython import vtkMRMLTableNode
 from SegmentEditor import SegmentEditorWidget
@@ -30,8 +30,18 @@ from SegmentEditorEffects import (
 )
 import SegmentEditorEffects
 
+from .LabelmapStatistics import SegmentStatisticsCalculator
+from .ResultsAccumulator import ResultsAccumulator, results_sink
+from .VolumeHistogram import volumeStatistics
+
 
 class CalculatorVolume:
+    EFFECT_NAME = 'Selecting Closed Surface'
+    # Set by the DICOM module on the nodes of a loaded series
+    DICOM_INSTANCE_UIDS_ATTRIBUTE = 'DICOM.instanceUIDs'
+    DICOM_PATIENT_ID_TAG = '0010,0020'
+    DICOM_SERIES_UID_TAG = '0020,000E'
+
     def __init__(self, applierLogic, defaultAutothresholdMethod, defaultPreviewState: bool):
         self.isPreviewState = defaultPreviewState
         self.segmentEditorWidget = None
@@ -43,6 +53,14 @@ class CalculatorVolume:
         self.segmentName = None
         self.volumeNode = None
         self.segmentationNode = None
+        # In the additive state a click adds its region to the segment instead of replacing it
+        self.isAdditiveState = False
+        # Keeps the statistics of the segments, a save measures only the segments modified since the previous one
+        self.statisticsCalculator = SegmentStatisticsCalculator()
+        # Rows of all the volumes saved in the session, a save upserts only the changed ones
+        self.resultsAccumulator = ResultsAccumulator()
+        # Called before a click is applied, so the parameters still waiting in the widget are used
+        self.beforeApply = None
 
     def enter(self):
         self.segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
@@ -59,8 +77,11 @@ class CalculatorVolume:
         self.segmentEditorWidget = None
 
     def setIsPreviewState(self, newState):
-        self.isPreviewState = newState
-        self.tryChangeStateTool()
+        # Nothing to update when the preview stays on, the effect is already set up
+        self.changeParameter('isPreviewState', newState, lambda: None)
+
+    def setIsAdditiveState(self, newState):
+        self.isAdditiveState = newState
 
     def setOffsetThreshold(self, offsetThreshold: float):
         self.offsetThreshold = offsetThreshold
@@ -77,17 +98,15 @@ class CalculatorVolume:
         self.changeParameter('segmentName', segmentName, self.updateSegment)
 
     def setVolumeNode(self, volumeNode: vtkMRMLScalarVolumeNode) -> None:
-        self.volumeNode = volumeNode
+        if volumeNode is self.volumeNode:
+            return
         if self.segmentationNode is not None:
             self.segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
-
-        # I do this in order to completely refresh the entire view, since I’m not sure that it will work otherwise
-        self.turnOffEffect()
-        self.tryChangeStateTool()
+        self.changeParameter('volumeNode', volumeNode, self.updateVolumeNode)
 
     def setSegmentationNode(self, segmentationNode: vtkMRMLSegmentationNode) -> None:
-        self.segmentationNode = segmentationNode
-        if self.segmentationNode is not None:
+        volumeNode = self.volumeNode
+        if segmentationNode is not None:
             volumeNodeRefWithSegmentationNode = segmentationNode.GetNodeReference(
                 segmentationNode.GetReferenceImageGeometryReferenceRole()
             )
@@ -95,15 +114,25 @@ class CalculatorVolume:
                 if self.volumeNode is not None:
                     segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(self.volumeNode)
             else:
-                self.volumeNode = volumeNodeRefWithSegmentationNode
+                volumeNode = volumeNodeRefWithSegmentationNode
 
-        # I do this in order to completely refresh the entire view, since I’m not sure that it will work otherwise
-        self.turnOffEffect()
-        self.tryChangeStateTool()
+        if segmentationNode is self.segmentationNode and volumeNode is self.volumeNode:
+            return
+        self.changeParameters(
+            {'segmentationNode': segmentationNode, 'volumeNode': volumeNode}, self.updateSegmentationNode
+        )
 
     def changeParameter(self, attributeName, value, callbackChangeFromTrueToTrueStateEffect) -> None:
+        self.changeParameters({attributeName: value}, callbackChangeFromTrueToTrueStateEffect)
+
+    def changeParameters(self, values: dict, callbackChangeFromTrueToTrueStateEffect) -> None:
+        """
+        Sets the attributes and applies the minimal transition of the effect: activation, turning off,
+        or, when the effect stays active, only the callback updating what the attributes affect.
+        """
         oldStateEffect = self.isActiveEffect()
-        setattr(self, attributeName, value)
+        for attributeName, value in values.items():
+            setattr(self, attributeName, value)
         newStateEffect = self.isActiveEffect()
 
         if oldStateEffect:
@@ -129,27 +158,105 @@ class CalculatorVolume:
         self.setCustomEditorEffect()
         self.updateEffect()
 
-        def applyTool(ijkPoints):
-            self.segmentEditorWidget.setActiveEffectByName(None)
+    def updateVolumeNode(self):
+        self.segmentEditorWidget.setSourceVolumeNode(self.volumeNode)
+        self.ensureCustomEditorEffect()
+        # The thresholds are of the new volume
+        self.updateEffect()
+
+    def updateSegmentationNode(self):
+        self.segmentEditorWidget.setSegmentationNode(self.segmentationNode)
+        self.segmentEditorWidget.setSourceVolumeNode(self.volumeNode)
+        self.updateSegment()
+        self.ensureCustomEditorEffect()
+        self.updateEffect()
 
-            currentSegmentID = self.segmentEditorNode.GetSelectedSegmentID()
-            segmentation: vtkSegmentation = self.segmentationNode.GetSegmentation()
-            currentSegment: vtkSegment = segmentation.GetSegment(currentSegmentID)
+    def applyTool(self, ijkPoints):
+        if self.beforeApply is not None:
+            self.beforeApply()
+        currentSegmentID = self.segmentEditorNode.GetSelectedSegmentID()
+        # Belongs to this click only, a later click while a background job runs takes its own
+        previousLabelmap = None
+        if self.isAdditiveState:
+            ijkPoints = self.getSeedsOutsideSegment(ijkPoints, currentSegmentID)
+            if ijkPoints.GetNumberOfPoints() == 0:
+                return
+            # The pipelines compute the region alone, it is united with the segment as it is now
+            previousLabelmap = slicer.util.arrayFromSegmentBinaryLabelmap(
+                self.segmentationNode, currentSegmentID, self.volumeNode
+            )
+            if previousLabelmap is not None and not np.any(previousLabelmap):
+                previousLabelmap = None
 
-            # It seems there is no other way
-            segmentColor = currentSegment.GetColor()
-            segmentation.RemoveSegment(currentSegmentID)
-            segmentation.AddEmptySegment(currentSegmentID, self.segmentName, segmentColor)
-            self.segmentEditorNode.SetSelectedSegmentID(currentSegmentID)
+        self.segmentEditorWidget.setActiveEffectByName(None)
 
-            self.applierLogic.apply(self, ijkPoints)
-            self.tryChangeStateTool()
+        self.applierLogic.apply(self, ijkPoints, previousLabelmap)
+        # The pipelines switch effects and segments, only these need to be restored
+        if self.isActiveEffect():
+            self.updateSegment()
+            self.setCustomEditorEffect()
+            self.updateEffect()
+        else:
+            self.turnOffEffect()
 
-        effect = self.segmentEditorWidget.activeEffect()
-        effect.self().setApplyLogic(applyTool)
+    def clearSegment(self, segmentID):
+        """Empties the segment, for the pipelines of the editor effects that paint into it."""
+        segmentation: vtkSegmentation = self.segmentationNode.GetSegmentation()
+        segment: vtkSegment = segmentation.GetSegment(segmentID)
+
+        # It seems there is no other way
+        segmentColor = segment.GetColor()
+        segmentation.RemoveSegment(segmentID)
+        segmentation.AddEmptySegment(segmentID, self.segmentName, segmentColor)
+        self.segmentEditorNode.SetSelectedSegmentID(segmentID)
+
+    def getSeedsOutsideSegment(self, ijkPoints, segmentID):
+        """
+        The points that are not inside the segment yet. Looks up the voxels of the internal labelmap
+        of the segment, so nothing is exported.
+        """
+        segment: vtkSegment = self.segmentationNode.GetSegmentation().GetSegment(segmentID)
+        segmentLabelmap = None if segment is None else segment.GetRepresentation(
+            slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName()
+        )
+        outsidePoints = vtk.vtkPoints()
+        if segmentLabelmap is None:
+            outsidePoints.DeepCopy(ijkPoints)
+            return outsidePoints
+
+        ijkToRAS = vtk.vtkMatrix4x4()
+        self.volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        worldToSegmentIjk = vtk.vtkMatrix4x4()
+        segmentLabelmap.GetWorldToImageMatrix(worldToSegmentIjk)
+        ijkToSegmentIjk = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Multiply4x4(worldToSegmentIjk, ijkToRAS, ijkToSegmentIjk)
+
+        extent = segmentLabelmap.GetExtent()
+        for index in range(ijkPoints.GetNumberOfPoints()):
+            point = ijkPoints.GetPoint(index)
+            segmentIjk = [int(round(c)) for c in ijkToSegmentIjk.MultiplyPoint([*point, 1.0])[:3]]
+            isInExtent = all(extent[2 * axis] <= segmentIjk[axis] <= extent[2 * axis + 1] for axis in range(3))
+            isInSegment = isInExtent and \
+                segmentLabelmap.GetScalarComponentAsDouble(*segmentIjk, 0) == segment.GetLabelValue()
+            if not isInSegment:
+                outsidePoints.InsertNextPoint(point)
+        return outsidePoints
+
+    def writeResultLabelmap(self, labelmap, segmentID, previousLabelmap=None) -> None:
+        """Writes a result of the applier logic into the segment, united with previousLabelmap in the additive state."""
+        if previousLabelmap is not None:
+            labelmap = np.maximum(labelmap, previousLabelmap)
+        slicer.util.updateSegmentBinaryLabelmapFromArray(labelmap, self.segmentationNode, segmentID, self.volumeNode)
 
     def setCustomEditorEffect(self):
-        self.segmentEditorWidget.setActiveEffectByName('Selecting Closed Surface')
+        self.segmentEditorWidget.setActiveEffectByName(self.EFFECT_NAME)
+        self.segmentEditorWidget.activeEffect().self().setApplyLogic(self.applyTool)
+
+    def ensureCustomEditorEffect(self):
+        # The editor widget may deactivate the effect when its nodes change
+        effect = self.segmentEditorWidget.activeEffect()
+        if effect is None or effect.name != self.EFFECT_NAME:
+            self.setCustomEditorEffect()
 
     def updateSegment(self):
         segmentation: vtkSegmentation = self.segmentationNode.GetSegmentation()
@@ -161,9 +268,11 @@ class CalculatorVolume:
         self.segmentEditorNode.Modified()
 
     def updateEffect(self):
+        # Same as autoThreshold of the effect with MODE_SET_MIN_UPPER, but from statistics computed once per volume
+        statistics = volumeStatistics.get(self.volumeNode)
         effect = self.segmentEditorWidget.activeEffect()
-        effect.self().autoThreshold(self.autoThresholdMethod, SegmentEditorEffects.MODE_SET_MIN_UPPER)
-        self.maximumThreshold = effect.doubleParameter("MaximumThreshold")
+        effect.setParameter("MinimumThreshold", statistics.scalarRange[0])
+        self.maximumThreshold = statistics.thresholds[self.autoThresholdMethod]
         self.updateEffectParameters()
 
     def updateEffectParameters(self):
@@ -182,7 +291,7 @@ class CalculatorVolume:
         self.segmentEditorWidget.setSegmentationNode(None)
         self.segmentEditorWidget.setSourceVolumeNode(None)
 
-    def saveResultsToTable(self, tableNode: vtkMRMLTableNode):
+    def saveResultsToTable(self, tableNode: vtkMRMLTableNode, computeSurfaceArea: bool = False):
         if self.segmentationNode is None:
             raise ValueError("Segmentation node not selected")
         if tableNode is None:
@@ -190,7 +299,30 @@ class CalculatorVolume:
         if self.segmentationNode.GetSegmentation().GetNumberOfSegments() == 0:
             raise ValueError("Segmentation node has zero number of segments")
 
-        statisticsLogic: SegmentStatisticsLogic = SegmentStatistics.SegmentStatisticsLogic()
-        statisticsLogic.getParameterNode().SetParameter("Segmentation", self.segmentationNode.GetID())
-        statisticsLogic.computeStatistics()
-        statisticsLogic.exportToTable(tableNode, nonEmptyKeysOnly=True)
+        measurements = self.statisticsCalculator.measure(self.segmentationNode, computeSurfaceArea)
+        self.resultsAccumulator.setTableNode(tableNode)
+        node = self.volumeNode or self.segmentationNode
+        return self.resultsAccumulator.upsert(self.resultsVolumeID(node), measurements, node.GetName())
+
+    @staticmethod
+    def resultsVolumeID(node) -> str:
+        """
+        Identifier of the scan of the node in the results, the same after renaming the node or loading
+        the scan again: the DICOM patient and series of a loaded series, otherwise the file the node is
+        stored in. Only a node never saved to a file is identified by its name.
+        """
+        instanceUIDs = (node.GetAttribute(CalculatorVolume.DICOM_INSTANCE_UIDS_ATTRIBUTE) or '').split()
+        dicomDatabase = getattr(slicer, 'dicomDatabase', None)
+        if instanceUIDs and dicomDatabase is not None:
+            seriesUID = dicomDatabase.instanceValue(instanceUIDs[0], CalculatorVolume.DICOM_SERIES_UID_TAG)
+            if seriesUID:
+                patientID = dicomDatabase.instanceValue(instanceUIDs[0], CalculatorVolume.DICOM_PATIENT_ID_TAG)
+                return f'{patientID}/{seriesUID}'
+        storageNode = node.GetStorageNode()
+        if storageNode is not None and storageNode.GetFileName():
+            return storageNode.GetFileName()
+        return node.GetName()
+
+    def setResultsPath(self, path: str):
+        """Also writes the saved rows to a CSV file, or to a SQLite database for .db and .sqlite paths."""
+        self.resultsAccumulator.setSink(results_sink(path))
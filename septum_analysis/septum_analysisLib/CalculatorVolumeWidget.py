@@ -7,9 +7,15 @@ from .CalculatorVolume import *
 from .SelectingClosedSurfaceEditorEffect import *
 from .utils import registerEditorEffect
 from .PipelineApplierLogic import UpdaterActionsOnProgressBar
+from .PipelineProfiler import PipelineProfiler
+from .ArraySegmentation import ApplierLogicOnArrays
+from .BackgroundRunner import BackgroundRunner
 
 
 class CalculatorVolumeWidget:
+    # Dragging the offset slider only updates the preview once it pauses for this long
+    THRESHOLD_OFFSET_DEBOUNCE_MS = 150
+
     def __init__(self) -> None:
         self.isEntered = False
         self.logic = None
@@ -17,6 +23,12 @@ class CalculatorVolumeWidget:
         self.crosshairNode = None
         self.ui = None
         self.getterSegmentName = None
+        self.profiler = None
+        self.runner = None
+        self.editorApplierLogic = None
+        self.backgroundApplierLogic = None
+        self.thresholdOffsetTimer = None
+        self.isResultsTableShown = False
 
     def setup(self, uiCalculaterVolumeCategory) -> None:
         registerEditorEffect(__file__, 'SelectingClosedSurfaceEditorEffect.py')
@@ -25,13 +37,23 @@ class CalculatorVolumeWidget:
 
         self.ui = uiCalculaterVolumeCategory
         self.ui.progressBarForCalculatorVolume.hide()
-
-        applierLogic = ApplierLogicWithMask(UpdaterActionsOnProgressBar(self.ui))
+        self.ui.cancelCalculatorVolumeButton.hide()
+
+        self.editorApplierLogic = ApplierLogicWithMask(UpdaterActionsOnProgressBar(self.ui))
+        # Timings of the last clicks are logged and kept in self.profiler.runs,
+        # pass ApplierLogicWithMask.countSelectedSegmentVoxels as voxelCounter to also count voxels
+        self.profiler = PipelineProfiler(logRuns=True).attachTo(self.editorApplierLogic.pipeline)
+        self.runner = BackgroundRunner()
+        self.backgroundApplierLogic = ApplierLogicOnArrays(
+            UpdaterActionsOnProgressBar(self.ui, isCancellable=True), self.runner
+        )
         self.logic = CalculatorVolume(
-            applierLogic,
+            self.backgroundApplierLogic if self.ui.isBackgroundCheckBox.checked else self.editorApplierLogic,
             SegmentEditorEffects.METHOD_TRIANGLE,
             self.ui.isPreviewCheckBox.checked
         )
+        self.logic.setIsAdditiveState(self.ui.isAdditiveCheckBox.checked)
+        self.logic.beforeApply = self.flushThresholdOffset
 
         self.ui.volumeNodeForCalculateVolume.connect(
             "currentNodeChanged(vtkMRMLNode*)", self.onVolumeChanged
@@ -40,8 +62,19 @@ class CalculatorVolumeWidget:
             "currentNodeChanged(vtkMRMLNode*)", self.onSegmentationChanged
         )
 
-        self.ui.thresholdOffset.connect("valueChanged(double)", lambda value: self.logic.setOffsetThreshold(value))
+        self.thresholdOffsetTimer = qt.QTimer()
+        self.thresholdOffsetTimer.setSingleShot(True)
+        self.thresholdOffsetTimer.setInterval(self.THRESHOLD_OFFSET_DEBOUNCE_MS)
+        self.thresholdOffsetTimer.connect(
+            "timeout()", lambda: self.logic.setOffsetThreshold(self.ui.thresholdOffset.value)
+        )
+        self.ui.thresholdOffset.connect("valueChanged(double)", lambda _: self.thresholdOffsetTimer.start())
         self.ui.isPreviewCheckBox.connect("clicked(bool)", lambda value: self.logic.setIsPreviewState(value))
+        self.ui.isAdditiveCheckBox.connect("clicked(bool)", lambda value: self.logic.setIsAdditiveState(value))
+        self.ui.isBackgroundCheckBox.connect("clicked(bool)", self.onBackgroundChanged)
+        self.ui.roiMarginMm.connect("valueChanged(double)", self.onRoiMarginChanged)
+        self.onRoiMarginChanged(self.ui.roiMarginMm.value)
+        self.ui.cancelCalculatorVolumeButton.connect("clicked(bool)", lambda: self.runner.cancel())
 
         self.ui.autothresholdMethod.addItem("Triangle", SegmentEditorEffects.METHOD_TRIANGLE)
         self.ui.autothresholdMethod.addItem("Kittler Illingworth", SegmentEditorEffects.METHOD_KITTLER_ILLINGWORTH)
@@ -59,10 +92,14 @@ class CalculatorVolumeWidget:
         )
 
         self.ui.saveInTableButton.connect('clicked(bool)', self.onSaveInTable)
+        self.ui.resultsFilePath.connect('currentPathChanged(QString)', self.onResultsPathChanged)
 
         self.enter()
 
     def cleanup(self):
+        self.thresholdOffsetTimer.stop()
+        self.runner.cancel()
+        self.logic.resultsAccumulator.close()
         self.exit()
 
     def enter(self) -> None:
@@ -91,6 +128,21 @@ class CalculatorVolumeWidget:
 
         self.logic.setSegmentName(getterSegmentName.get())
 
+    def onBackgroundChanged(self, isBackground: bool):
+        if not isBackground:
+            self.runner.cancel()
+        self.logic.applierLogic = self.backgroundApplierLogic if isBackground else self.editorApplierLogic
+
+    def flushThresholdOffset(self):
+        """Sets an offset still waiting for the debounce timer, so a click or a save right after a drag uses it."""
+        if self.thresholdOffsetTimer.isActive():
+            self.thresholdOffsetTimer.stop()
+            self.logic.setOffsetThreshold(self.ui.thresholdOffset.value)
+
+    def onRoiMarginChanged(self, marginMm: float):
+        # Only the Segment Editor pipeline crops, the array backend is fast enough on the whole volume
+        self.editorApplierLogic.roiMarginMm = marginMm if marginMm > 0 else None
+
     def onAutoThresholdChanged(self, changedIndex: int):
         autoThresholdMethod = self.ui.autothresholdMethod.itemData(changedIndex)
         self.logic.setAutoThresholdMethod(autoThresholdMethod)
@@ -99,6 +151,9 @@ class CalculatorVolumeWidget:
     def onNodeAddedOnScene(self, caller, eventId, callData):
         if not callData.IsA("vtkMRMLScalarVolumeNode"):
             return
+        # Temporary crops of a click must not replace the volume of the click
+        if callData.GetAttribute(ApplierLogicWithMask.REGION_OF_INTEREST_ATTRIBUTE) is not None:
+            return
 
         # I would like to change only when the background change from there,
         # but slicer.mrmlScene.GetNthNodeByClass(i, "vtkMRMLSliceCompositeNode").GetBackgroundVolumeID()
@@ -149,20 +204,23 @@ class CalculatorVolumeWidget:
 
     def onSaveInTable(self):
         tableNode: vtkMRMLTableNode = self.ui.tableNodeForCalculateVolume.currentNode()
+        self.flushThresholdOffset()
 
         with slicer.util.tryWithErrorDisplay("Failed to save results", waitCursor=True):
-            isNeedSwitch3D = not self.ui.segmentationShow3DButton.checked
-            if isNeedSwitch3D:
-                self.ui.segmentationShow3DButton.clicked(True)
-
-            self.logic.saveResultsToTable(tableNode)
-
-            if isNeedSwitch3D:
-                self.ui.segmentationShow3DButton.clicked(False)
-
-            slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView)
-            slicer.app.applicationLogic().GetSelectionNode().SetReferenceActiveTableID(tableNode.GetID())
-            slicer.app.applicationLogic().PropagateTableSelection()
+            self.logic.saveResultsToTable(tableNode, self.ui.isSurfaceAreaCheckBox.checked)
+
+            # The layout is switched by the first save only, later saves keep the layout chosen by the user
+            if not self.isResultsTableShown:
+                slicer.app.layoutManager().setLayout(slicer.vtkMRMLLayoutNode.SlicerLayoutFourUpTableView)
+                self.isResultsTableShown = True
+            selectionNode = slicer.app.applicationLogic().GetSelectionNode()
+            if selectionNode.GetActiveTableID() != tableNode.GetID():
+                selectionNode.SetReferenceActiveTableID(tableNode.GetID())
+                slicer.app.applicationLogic().PropagateTableSelection()
+
+    def onResultsPathChanged(self, path: str):
+        with slicer.util.tryWithErrorDisplay("Failed to open the results file"):
+            self.logic.setResultsPath(path)
 
 
 class ConstGetterNameSegment:
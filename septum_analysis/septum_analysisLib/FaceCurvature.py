@@ -1,47 +1,235 @@
-from slicer.util import pip_install
+import os
+from concurrent.futures import ThreadPoolExecutor
 
+from .utils import require_module
 
-try:
-    import cv2
-except:
-    pip_install('opencv-python')
-    import cv2
+cv2 = require_module('cv2', 'opencv-python')
+np = require_module('numpy')
 
-try:
-    import numpy as np
-except:
-    pip_install('numpy')
-    import numpy as np
 
+class FaceCurvatureResult:
+    """
+    Per-slice face curvature metrics of a (N, H, W) stack.
 
-def analyze_face_curvature(images: cv2.Mat):
-    result = []
-    result1 = []
-    for data in images:
+    defectsDepth - sum of convexity defect depths of the largest contour.
+    hullAreaGap - area between the convex hull and the largest contour.
+    failed - slices whose contour analysis raised, their metrics are zero.
+    errors - error message by slice index for the failed slices.
+    """
+
+    def __init__(self, defectsDepth, hullAreaGap, failed, errors):
+        self.defectsDepth = defectsDepth
+        self.hullAreaGap = hullAreaGap
+        self.failed = failed
+        self.errors = errors
+
+
+def preprocess_face_slice(image: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """Bilateral filter the slice and zero everything not brighter than its mean."""
+    filtered = cv2.bilateralFilter(np.ascontiguousarray(image, dtype=np.uint8), 3, 75, 75, dst=out)
+    # Like the former loop, cv2.threshold floors the mean of 8-bit images
+    return cv2.threshold(filtered, cv2.mean(filtered)[0], 255, cv2.THRESH_TOZERO, dst=filtered)[1]
+
+
+def preprocess_face_slices(images: np.ndarray, out: np.ndarray = None, executor=None) -> np.ndarray:
+    """preprocess_face_slice of every slice of a (N, H, W) stack, in the executor if there is one."""
+    images = np.asarray(images, dtype=np.uint8)
+    if out is None:
+        out = np.empty(images.shape, dtype=np.uint8)
+
+    def preprocessSlice(index):
+        preprocess_face_slice(images[index], out[index])
+
+    if executor is None:
+        for index in range(images.shape[0]):
+            preprocessSlice(index)
+    else:
+        list(executor.map(preprocessSlice, range(images.shape[0])))
+    return out
+
+
+def analyze_slice_curvature(thresh: np.ndarray):
+    """
+    Returns the sum of convexity defect depths and the hull area gap of the largest contour
+    of an already preprocessed slice, zeros if the slice has no contours.
+    """
+    cont, _ = cv2.findContours(thresh, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
+    if len(cont) == 0:
+        return 0, 0.0
+
+    maxc = max(cont, key=cv2.contourArea)
+    ch = cv2.convexHull(maxc, returnPoints=False)
+    ch_ = cv2.convexHull(maxc)
+
+    defects = cv2.convexityDefects(maxc, ch)
+    t1 = 0 if defects is None else int(defects.reshape(-1, 4)[:, 3].sum())
+    t2 = cv2.contourArea(ch_) - cv2.contourArea(maxc)
+    return t1, t2
+
+
+def analyze_face_curvature_batch(images: np.ndarray, workers: int = None) -> FaceCurvatureResult:
+    """
+    Computes face curvature metrics for every slice of a (N, H, W) uint8 stack.
+    Every slice is preprocessed and analysed in one task of a thread pool, OpenCV releases the GIL for these calls.
+    """
+    images = np.asarray(images, dtype=np.uint8)
+    if images.ndim != 3:
+        raise ValueError(f'Expected a (N, H, W) stack of slices, got an array of shape {images.shape}')
+    count = len(images)
+    defectsDepth = np.zeros(count, dtype=np.int64)
+    hullAreaGap = np.zeros(count, dtype=np.float64)
+    failed = np.zeros(count, dtype=bool)
+    errors = {}
+
+    def analyzeSlice(index):
+        # The slice is filtered and thresholded right before its contours, while it is still in the cache
+        thresh = preprocess_face_slice(images[index])
         try:
-            data = cv2.bilateralFilter(data, 3, 75, 75)
-            _, thresh = cv2.threshold(data, data.mean(), 255, cv2.THRESH_TOZERO)
-            cont, _ = cv2.findContours(thresh, mode=cv2.RETR_EXTERNAL, method=cv2.CHAIN_APPROX_SIMPLE)
+            defectsDepth[index], hullAreaGap[index] = analyze_slice_curvature(thresh)
+        except cv2.error as e:
+            failed[index] = True
+            errors[index] = str(e)
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for index in range(count):
+            analyzeSlice(index)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(analyzeSlice, range(count)))
+
+    return FaceCurvatureResult(defectsDepth, hullAreaGap, failed, errors)
+
 
-            if len(cont)==0:
-                result.append(0)
-                result1.append(0)
-                continue
+def analyze_face_curvature(images: np.ndarray, workers: int = None):
+    """
+    Returns both metric arrays for every slice. Failed slices repeat the metrics of the previous slice.
+    """
+    curvature = analyze_face_curvature_batch(images, workers)
+    result = curvature.defectsDepth
+    result1 = curvature.hullAreaGap
+    if curvature.failed.any():
+        # index of the last successful slice for every slice, failed leading slices stay zero
+        lastValid = np.where(~curvature.failed, np.arange(len(result)), 0)
+        np.maximum.accumulate(lastValid, out=lastValid)
+        result = result[lastValid]
+        result1 = result1[lastValid]
+    return result, result1
 
-            maxc = max(enumerate(cont), key=lambda x: cv2.contourArea(x[1]))[0]
 
-            ch = cv2.convexHull(cont[maxc], returnPoints=False)
-            ch_ = cv2.convexHull(cont[maxc])
+NOSE_LOW_QUANTILE = 0.3
+NOSE_HIGH_QUANTILE = 0.7
+DEFAULT_SMOOTHING_WINDOW = 5
+# Bound of a signal without a quantile crossing on that side of its maximum
+NOSE_NOT_FOUND = -1
 
-            t1 = sum(map(lambda x: x[0][3], cv2.convexityDefects(cont[maxc], ch)))
-            t2 = cv2.contourArea(ch_) - cv2.contourArea(cont[maxc])
-            result.append(t1)
-            result1.append(t2)
+
+class NoseBounds:
+    """
+    Nose bounds of several stacks.
+
+    low, high - first and last slice of the nose per stack, NOSE_NOT_FOUND where there is no crossing.
+    signals - smoothed convexity defects signals, one row per stack, NaN after the end of shorter stacks.
+    errors - error message by stack index for the stacks whose analysis raised, their bounds are not found.
+    """
+
+    def __init__(self, low, high, signals, errors):
+        self.low = low
+        self.high = high
+        self.signals = signals
+        self.errors = errors
+
+    @property
+    def found(self) -> np.ndarray:
+        return (self.low != NOSE_NOT_FOUND) & (self.high != NOSE_NOT_FOUND)
+
+
+def smooth_signals(signals: np.ndarray, window: int = DEFAULT_SMOOTHING_WINDOW) -> np.ndarray:
+    """
+    Centred moving average of every row, NaN samples are skipped and stay NaN.
+    The window shrinks at the ends, so the first and the last samples are not pulled towards zero.
+    """
+    signals = np.asarray(signals, dtype=np.float64)
+    if window <= 1:
+        return signals.copy()
+    valid = np.isfinite(signals)
+    length = signals.shape[1]
+    sums = np.pad(np.cumsum(np.where(valid, signals, 0), axis=1), ((0, 0), (1, 0)))
+    counts = np.pad(np.cumsum(valid, axis=1), ((0, 0), (1, 0)))
+    indices = np.arange(length)
+    low = np.clip(indices - window // 2, 0, length)
+    high = np.clip(indices + (window - 1) // 2 + 1, 0, length)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        smoothed = (sums[:, high] - sums[:, low]) / (counts[:, high] - counts[:, low])
+    smoothed[~valid] = np.nan
+    return smoothed
+
+
+def quantile_crossing_bounds(signals: np.ndarray, lowQuantile: float = NOSE_LOW_QUANTILE,
+                             highQuantile: float = NOSE_HIGH_QUANTILE):
+    """
+    For every row, the last crossing of the lowQuantile level before the maximum and the first crossing
+    of the highQuantile level from the maximum on, NOSE_NOT_FOUND where there is none.
+    A crossing at index t is a sign change between the samples t and t + 1.
+    """
+    count, length = signals.shape
+    low = np.full(count, NOSE_NOT_FOUND, dtype=np.int64)
+    high = np.full(count, NOSE_NOT_FOUND, dtype=np.int64)
+    valid = np.isfinite(signals)
+    # Rows without samples, of failed or empty stacks, have no crossings and no maximum
+    rows = np.flatnonzero(valid.any(axis=1)) if length >= 2 else np.empty(0, dtype=np.int64)
+    if len(rows) == 0:
+        return low, high
+    signals, valid = signals[rows], valid[rows]
+
+    levels = np.nanquantile(signals, [lowQuantile, highQuantile], axis=1).T
+    peaks = np.where(valid, signals, -np.inf).argmax(axis=1)[:, None]
+
+    indices = np.arange(length - 1)
+    bothValid = valid[:, :-1] & valid[:, 1:]
+    lowCrossings = bothValid & (np.diff(np.sign(signals - levels[:, :1]), axis=1) != 0)
+    highCrossings = bothValid & (np.diff(np.sign(signals - levels[:, 1:]), axis=1) != 0)
+    low[rows] = np.where(lowCrossings & (indices < peaks), indices, NOSE_NOT_FOUND).max(axis=1,
+                                                                                        initial=NOSE_NOT_FOUND)
+    rowsHigh = np.where(highCrossings & (indices >= peaks), indices, length).min(axis=1, initial=length)
+    rowsHigh[rowsHigh == length] = NOSE_NOT_FOUND
+    high[rows] = rowsHigh
+    return low, high
+
+
+def find_nose_bounds_batch(stacks, workers: int = None,
+                           smoothingWindow: int = DEFAULT_SMOOTHING_WINDOW) -> NoseBounds:
+    """
+    Nose bounds of many (N, H, W) uint8 stacks of normalized slices, or objects with normalizedSlices()
+    such as VolumeAccessor. The curvature is analysed stack by stack, the signals are then smoothed
+    and their crossings found for all stacks at once. Never raises for a single stack.
+    """
+    signals = []
+    errors = {}
+    for index, stack in enumerate(stacks):
+        try:
+            images = stack.normalizedSlices() if hasattr(stack, 'normalizedSlices') else stack
+            signals.append(analyze_face_curvature(images, workers)[0].astype(np.float64))
         except Exception as e:
-            print(e)
-            if len(result)==0:
-                result.append(0)
-                result1.append(0)
-            result.append(result[-1])
-            result1.append(result1[-1])
-    return result, result1
\ No newline at end of file
+            errors[index] = f'{type(e).__name__}: {e}'
+            signals.append(np.empty(0))
+
+    padded = np.full((len(signals), max((len(signal) for signal in signals), default=0)), np.nan)
+    for index, signal in enumerate(signals):
+        padded[index, :len(signal)] = signal
+    padded = smooth_signals(padded, smoothingWindow)
+    low, high = quantile_crossing_bounds(padded)
+    return NoseBounds(low, high, padded, errors)
+
+
+def find_nose_bounds(images: np.ndarray, workers: int = None, smoothingWindow: int = DEFAULT_SMOOTHING_WINDOW):
+    """
+    Returns the first and the last slice of the nose: crossings of the 0.3 and 0.7 quantiles
+    of the smoothed convexity defects signal around its maximum. A bound without a crossing
+    is NOSE_NOT_FOUND, smoothingWindow 1 keeps the raw signal.
+    """
+    bounds = find_nose_bounds_batch([images], workers, smoothingWindow)
+    if 0 in bounds.errors:
+        raise ValueError(bounds.errors[0])
+    return int(bounds.low[0]), int(bounds.high[0])
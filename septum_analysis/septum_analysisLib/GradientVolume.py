@@ -0,0 +1,51 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import require_module
+
+cv2 = require_module('cv2', 'opencv-python')
+np = require_module('numpy')
+
+
+DEFAULT_SLAB_SIZE = 16
+
+
+def gradient_slice(image: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    Gaussian blur followed by the mean of absolute Sobel derivatives, saturated to uint8.
+    """
+    blurred = cv2.GaussianBlur(image, (3, 3), 0)
+    gradX = cv2.convertScaleAbs(cv2.Sobel(blurred, cv2.CV_32F, 1, 0, ksize=3, borderType=cv2.BORDER_DEFAULT))
+    gradY = cv2.convertScaleAbs(cv2.Sobel(blurred, cv2.CV_32F, 0, 1, ksize=3, borderType=cv2.BORDER_DEFAULT))
+    return cv2.addWeighted(gradX, 0.5, gradY, 0.5, 0, dst=out)
+
+
+def compute_gradient_volume(volume: np.ndarray, out: np.ndarray = None,
+                            slabSize: int = DEFAULT_SLAB_SIZE, workers: int = None) -> np.ndarray:
+    """
+    Computes the Sobel gradient magnitude of every slice of a (N, H, W) volume into a uint8 volume.
+    The volume is processed in slabs of slabSize slices in parallel, only the slabs in flight are
+    converted to float32, so the peak memory is bounded by workers * slabSize slices.
+    """
+    if volume.ndim != 3:
+        raise ValueError("Volume must be a (slices, rows, columns) array")
+    if out is None:
+        out = np.empty(volume.shape, dtype=np.uint8)
+    elif out.shape != volume.shape or out.dtype != np.uint8:
+        raise ValueError("Output buffer must be a uint8 array of the volume shape")
+
+    def processSlab(start):
+        slab = volume[start:start + slabSize].astype(np.float32)
+        for index in range(slab.shape[0]):
+            gradient_slice(slab[index], out[start + index])
+
+    starts = range(0, volume.shape[0], slabSize)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for start in starts:
+            processSlab(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(processSlab, starts))
+    return out
@@ -0,0 +1,152 @@
+from .utils import require_module
+
+np = require_module('numpy')
+
+
+MM3_PER_CM3 = 1000.0
+
+STATISTICS_COLUMNS = ('Segment', 'Number of voxels', 'Volume [mm3]', 'Volume [cm3]')
+SURFACE_AREA_COLUMN = 'Surface area [mm2]'
+
+
+def label_voxel_counts(labelmap: np.ndarray, labelValues) -> np.ndarray:
+    """Voxel counts of every label value of labelValues in one pass over the labelmap."""
+    labelValues = np.asarray(labelValues, dtype=np.int64)
+    if labelValues.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    values = labelmap.ravel()
+    if values.dtype.kind == 'b' or (values.dtype.kind == 'u' and values.dtype.itemsize <= 2):
+        # Segmentation layers are uint8, a histogram of them is cheaper than comparing once per label
+        counts = np.bincount(values, minlength=int(labelValues.max()) + 1)
+        return counts[labelValues].astype(np.int64)
+    return np.array([np.count_nonzero(values == labelValue) for labelValue in labelValues], dtype=np.int64)
+
+
+def voxel_volume_mm3(spacing) -> float:
+    return float(np.prod(np.asarray(spacing, dtype=np.float64)))
+
+
+class SegmentMeasurement:
+    """
+    Statistics of one segment, volumes in mm3 and cm3 from the voxel count and the labelmap spacing.
+    surfaceAreaMm2 is None unless it was requested.
+    """
+
+    def __init__(self, segmentID: str, name: str, voxelCount: int, voxelVolumeMm3: float,
+                 surfaceAreaMm2: float = None):
+        self.segmentID = segmentID
+        self.name = name
+        self.voxelCount = int(voxelCount)
+        self.volumeMm3 = self.voxelCount * voxelVolumeMm3
+        self.surfaceAreaMm2 = surfaceAreaMm2
+
+    @property
+    def volumeCm3(self) -> float:
+        return self.volumeMm3 / MM3_PER_CM3
+
+
+class SegmentStatisticsCalculator:
+    """
+    Lean replacement of SegmentStatisticsLogic for the volumes of the sinuses. Voxel counts are read
+    straight from the internal binary labelmaps of the segmentation, the segments sharing a layer are
+    counted in one pass. Surface area is taken from the closed surface representation, which is only
+    created when it is requested. Results are cached by the modification time of the labelmaps and
+    surfaces, so a new save only measures the segments modified since the previous one.
+    """
+
+    def __init__(self):
+        # (segmentation node ID, segment ID) -> (labelmap key, voxel count, voxel volume)
+        self.voxelCounts = {}
+        # (segmentation node ID, segment ID) -> (surface key, area)
+        self.surfaceAreas = {}
+
+    def measure(self, segmentationNode, computeSurfaceArea: bool = False) -> list:
+        """SegmentMeasurement of every segment of the node, in the order of the segmentation."""
+        import slicer
+
+        segmentation = segmentationNode.GetSegmentation()
+        nodeID = segmentationNode.GetID()
+        segmentIDs = [segmentation.GetNthSegmentID(index) for index in range(segmentation.GetNumberOfSegments())]
+        self.forget(nodeID, keep=segmentIDs)
+
+        labelmapName = slicer.vtkSegmentationConverter.GetBinaryLabelmapRepresentationName()
+        if not segmentation.ContainsRepresentation(labelmapName):
+            segmentation.CreateRepresentation(labelmapName)
+
+        # Segments of the same layer share one vtkOrientedImageData
+        staleLayers = {}
+        for segmentID in segmentIDs:
+            segment = segmentation.GetSegment(segmentID)
+            labelmap = segment.GetRepresentation(labelmapName)
+            key = self.labelmapKey(segment, labelmap)
+            cached = self.voxelCounts.get((nodeID, segmentID))
+            if cached is None or cached[0] != key:
+                staleLayers.setdefault(id(labelmap), (labelmap, []))[1].append((segmentID, segment, key))
+
+        for labelmap, segments in staleLayers.values():
+            if labelmap is None or labelmap.IsEmpty():
+                counts = np.zeros(len(segments), dtype=np.int64)
+                voxelVolume = 0.0
+            else:
+                counts = label_voxel_counts(self.labelmapArray(labelmap),
+                                            [segment.GetLabelValue() for _, segment, _ in segments])
+                voxelVolume = voxel_volume_mm3(labelmap.GetSpacing())
+            for (segmentID, _, key), count in zip(segments, counts):
+                self.voxelCounts[(nodeID, segmentID)] = (key, int(count), voxelVolume)
+
+        if computeSurfaceArea:
+            self.updateSurfaceAreas(segmentationNode, segmentIDs)
+
+        measurements = []
+        for segmentID in segmentIDs:
+            _, count, voxelVolume = self.voxelCounts[(nodeID, segmentID)]
+            surfaceArea = self.surfaceAreas[(nodeID, segmentID)][1] if computeSurfaceArea else None
+            measurements.append(SegmentMeasurement(
+                segmentID, segmentation.GetSegment(segmentID).GetName(), count, voxelVolume, surfaceArea
+            ))
+        return measurements
+
+    def updateSurfaceAreas(self, segmentationNode, segmentIDs):
+        import slicer
+        import vtk
+
+        segmentation = segmentationNode.GetSegmentation()
+        nodeID = segmentationNode.GetID()
+        surfaceName = slicer.vtkSegmentationConverter.GetClosedSurfaceRepresentationName()
+        # Unlike showing the segmentation in 3D this changes no display node
+        if not segmentation.ContainsRepresentation(surfaceName):
+            segmentationNode.CreateClosedSurfaceRepresentation()
+
+        for segmentID in segmentIDs:
+            surface = segmentation.GetSegment(segmentID).GetRepresentation(surfaceName)
+            key = None if surface is None else surface.GetMTime()
+            cached = self.surfaceAreas.get((nodeID, segmentID))
+            if cached is not None and cached[0] == key:
+                continue
+            area = 0.0
+            if surface is not None and surface.GetNumberOfPoints() > 0:
+                triangles = vtk.vtkTriangleFilter()
+                triangles.SetInputData(surface)
+                properties = vtk.vtkMassProperties()
+                properties.SetInputConnection(triangles.GetOutputPort())
+                properties.Update()
+                area = properties.GetSurfaceArea()
+            self.surfaceAreas[(nodeID, segmentID)] = (key, area)
+
+    @staticmethod
+    def labelmapKey(segment, labelmap):
+        # The label value is part of the key, moving a segment to another layer keeps the image unmodified
+        return None if labelmap is None else (labelmap.GetMTime(), segment.GetLabelValue())
+
+    @staticmethod
+    def labelmapArray(labelmap) -> np.ndarray:
+        from vtk.util import numpy_support
+        return numpy_support.vtk_to_numpy(labelmap.GetPointData().GetScalars())
+
+    def forget(self, nodeID: str, keep=()):
+        """Drops the cached results of the node, except those of the segments in keep."""
+        keep = set(keep)
+        for cache in (self.voxelCounts, self.surfaceAreas):
+            for key in [key for key in cache if key[0] == nodeID and key[1] not in keep]:
+                del cache[key]
+
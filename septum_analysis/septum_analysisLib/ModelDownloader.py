@@ -0,0 +1,237 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from .PipelineApplierLogic import PipelineCancelled
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+DEFAULT_TIMEOUT_SECONDS = 30
+PART_SUFFIX = '.part'
+# Written after a successful extraction, a directory without it is extracted again
+COMPLETE_MARKER = '.complete'
+
+AMASSS_MODELS_URL = 'https://github.com/lucanchling/AMASSS_CBCT/releases/download/v1.0.2/AMASSS_Models.zip'
+# SHA256 of the release archive. While it is None the digest GitHub publishes for the release asset is used
+AMASSS_MODELS_SHA256 = None
+# Release assets, the digests of their archives are published by the releases API
+GITHUB_RELEASE_ASSET_URL = re.compile(r'https://github\.com/([^/]+)/([^/]+)/releases/download/([^/]+)/([^/]+)$')
+# Models of the maxilla segmentation (skull structure "MAX") used by the module
+AMASSS_MODEL_PATTERNS = ('*MAX*',)
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def sha256_file(path: str, chunkSize: int = DEFAULT_CHUNK_SIZE) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for data in iter(lambda: file.read(chunkSize), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def github_release_asset_sha256(url: str, timeout: float = DEFAULT_TIMEOUT_SECONDS):
+    """
+    SHA256 of a GitHub release asset from the "digest" of the asset in the releases API.
+    None for other URLs, for assets without a published digest, or when the API cannot be reached.
+    """
+    match = GITHUB_RELEASE_ASSET_URL.match(url)
+    if match is None:
+        return None
+    owner, repository, tag, assetName = match.groups()
+    request = urllib.request.Request(f'https://api.github.com/repos/{owner}/{repository}/releases/tags/{tag}',
+                                     headers={'Accept': 'application/vnd.github+json'})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            release = json.load(response)
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        logging.warning(f"Cannot read the release of {url}: {e}")
+        return None
+    for asset in release.get('assets', []):
+        digest = asset.get('digest') or ''
+        if asset.get('name') == assetName and digest.startswith('sha256:'):
+            return digest[len('sha256:'):]
+    return None
+
+
+def parse_content_range_total(value: str):
+    """Total size from a Content-Range header like "bytes 100-199/1000", None if it is unknown."""
+    match = re.match(r'bytes\s+(\d+-\d+|\*)/(\d+)', value or '')
+    return int(match.group(2)) if match else None
+
+
+def download_file(url: str, path: str, sha256: str = None, progress=None, cancelEvent: threading.Event = None,
+                  chunkSize: int = DEFAULT_CHUNK_SIZE, timeout: float = DEFAULT_TIMEOUT_SECONDS) -> str:
+    """
+    Streams url into path. The data goes into path + ".part" first, an interrupted download is resumed
+    from its end with an HTTP Range request, or restarted when the server ignores the range.
+    The SHA256 is computed while downloading; on a mismatch the file is removed and ChecksumMismatch is raised.
+    progress(downloadedBytes, totalBytes or None) is called after every chunk.
+    Raises PipelineCancelled when cancelEvent is set.
+    """
+    if os.path.exists(path) and (sha256 is None or sha256_file(path, chunkSize) == sha256.lower()):
+        return path
+
+    partPath = path + PART_SUFFIX
+    offset = os.path.getsize(partPath) if os.path.exists(partPath) else 0
+    request = urllib.request.Request(url, headers={'Range': f'bytes={offset}-'} if offset else {})
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if not offset or e.code != 416:
+            raise
+        # The part is already complete
+        response = None
+
+    digest = hashlib.sha256()
+    if response is not None and offset and response.status != 206:
+        # The server ignores the range
+        offset = 0
+    if offset:
+        with open(partPath, 'rb') as file:
+            for data in iter(lambda: file.read(chunkSize), b''):
+                digest.update(data)
+
+    if response is not None:
+        with response, open(partPath, 'ab' if offset else 'wb') as file:
+            total = parse_content_range_total(response.headers.get('Content-Range'))
+            if total is None and response.headers.get('Content-Length'):
+                total = offset + int(response.headers['Content-Length'])
+            downloaded = offset
+            for data in iter(lambda: response.read(chunkSize), b''):
+                if cancelEvent is not None and cancelEvent.is_set():
+                    # The part is kept for resuming
+                    raise PipelineCancelled()
+                file.write(data)
+                digest.update(data)
+                downloaded += len(data)
+                if progress is not None:
+                    progress(downloaded, total)
+
+    if sha256 is not None and digest.hexdigest() != sha256.lower():
+        os.remove(partPath)
+        raise ChecksumMismatch(f"SHA256 of {url} is {digest.hexdigest()}, expected {sha256}")
+    os.replace(partPath, path)
+    return path
+
+
+def select_members(names, patterns=None):
+    """
+    Names matching any of the glob patterns, all of them without patterns or when nothing matches,
+    so a changed archive layout still extracts.
+    """
+    names = [name for name in names if not name.endswith('/')]
+    if not patterns:
+        return names
+    selected = [name for name in names if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)]
+    return selected or names
+
+
+def extract_zip(zipPath: str, directory: str, patterns=None, workers: int = None, progress=None,
+                cancelEvent: threading.Event = None):
+    """
+    Extracts the members selected by select_members in a thread pool, every thread reads through its own
+    ZipFile since they are not thread safe. Returns the extracted paths.
+    progress(extractedCount, totalCount) is called after every member.
+    """
+    with zipfile.ZipFile(zipPath) as archive:
+        names = select_members(archive.namelist(), patterns)
+
+    root = os.path.realpath(directory)
+    local = threading.local()
+    lock = threading.Lock()
+    archives = []
+    extracted = []
+
+    def extract(name):
+        if cancelEvent is not None and cancelEvent.is_set():
+            raise PipelineCancelled()
+        target = os.path.realpath(os.path.join(root, name))
+        if os.path.commonpath([root, target]) != root:
+            raise ValueError(f"Archive member {name} is outside of the target directory")
+        if not hasattr(local, 'archive'):
+            local.archive = zipfile.ZipFile(zipPath)
+            with lock:
+                archives.append(local.archive)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with local.archive.open(name) as source, open(target, 'wb') as destination:
+            shutil.copyfileobj(source, destination, DEFAULT_CHUNK_SIZE)
+        with lock:
+            extracted.append(target)
+            if progress is not None:
+                progress(len(extracted), len(names))
+        return target
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(extract, names))
+    finally:
+        for archive in archives:
+            archive.close()
+
+
+class ModelDownloader:
+    """
+    Downloads a zip archive of models and extracts the needed files into directory. Both steps can be
+    interrupted: the download resumes from the kept part and the extraction starts again.
+    Without sha256 the archive of a GitHub release is verified with the digest published for it.
+    """
+
+    def __init__(self, url: str, directory: str, sha256: str = None, patterns=None, workers: int = None):
+        self.url = url
+        self.directory = directory
+        self.sha256 = sha256
+        self.patterns = patterns
+        self.workers = workers
+
+    @property
+    def zipPath(self) -> str:
+        return self.directory + '.zip'
+
+    @property
+    def isDownloaded(self) -> bool:
+        markerPath = os.path.join(self.directory, COMPLETE_MARKER)
+        if os.path.exists(markerPath):
+            return True
+        # Directories extracted before the marker was introduced have no archive or part next to them,
+        # an interrupted download or extraction always has one
+        isExtracted = os.path.isdir(self.directory) and len(os.listdir(self.directory)) > 0
+        if not isExtracted or os.path.exists(self.zipPath) or os.path.exists(self.zipPath + PART_SUFFIX):
+            return False
+        try:
+            with open(markerPath, 'w'):
+                pass
+        except OSError:
+            pass
+        return True
+
+    def run(self, progress=None, cancelEvent: threading.Event = None) -> str:
+        """
+        Returns the model directory. progress(stage, done, total) reports the "download" and "extract" stages.
+        """
+        if self.isDownloaded:
+            return self.directory
+
+        sha256 = self.sha256 or github_release_asset_sha256(self.url)
+        if sha256 is None:
+            logging.warning(f"No SHA256 is known for {self.url}, the archive is not verified")
+        downloadProgress = None if progress is None else lambda done, total: progress('download', done, total)
+        download_file(self.url, self.zipPath, sha256, downloadProgress, cancelEvent)
+
+        extractProgress = None if progress is None else lambda done, total: progress('extract', done, total)
+        extract_zip(self.zipPath, self.directory, self.patterns, self.workers, extractProgress, cancelEvent)
+        with open(os.path.join(self.directory, COMPLETE_MARKER), 'w'):
+            pass
+        os.remove(self.zipPath)
+        return self.directory
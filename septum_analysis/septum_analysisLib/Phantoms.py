@@ -0,0 +1,78 @@
+from .utils import require_module
+
+np = require_module('numpy')
+
+
+AIR_HU = -1000
+SINUS_AIR_HU = -950
+SOFT_TISSUE_HU = 40
+BONE_HU = 1000
+
+
+class HeadPhantom:
+    """
+    Synthetic head CT indexed as (k, j, i): k goes up, small j is anterior.
+
+    array - int16 Hounsfield units.
+    ijkToRAS - 4x4 matrix of the voxel spacing.
+    sinusMasks - masks of the left and right sinuses.
+    sinusSeedsKJI - a voxel in the middle of each sinus.
+    noseSlices - first and last axial slice of the nose.
+    """
+
+    def __init__(self, array, ijkToRAS, sinusMasks, sinusSeedsKJI, noseSlices):
+        self.array = array
+        self.ijkToRAS = ijkToRAS
+        self.sinusMasks = sinusMasks
+        self.sinusSeedsKJI = sinusSeedsKJI
+        self.noseSlices = noseSlices
+
+
+def ellipsoid_mask(shape, center, radii) -> np.ndarray:
+    k, j, i = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    return ((k - center[0]) / radii[0]) ** 2 + ((j - center[1]) / radii[1]) ** 2 \
+        + ((i - center[2]) / radii[2]) ** 2 <= 1
+
+
+def make_head_phantom(shape=(120, 160, 160), spacing=(1.0, 1.0, 1.0), noise: float = 20.0,
+                      seed: int = 0) -> HeadPhantom:
+    """
+    Head of soft tissue in air with a skull shell, two air-filled sinuses and a nose on the face
+    over the middle third of the slices. spacing is along i, j, k in millimetres.
+    """
+    slices, rows, columns = shape
+    center = np.array([slices / 2, rows / 2, columns / 2])
+    # Like a head CT the head is cut by the first and the last slices
+    radii = np.array([0.7 * slices, 0.4 * rows, 0.35 * columns])
+
+    array = np.full(shape, AIR_HU, dtype=np.int16)
+    array[ellipsoid_mask(shape, center, radii)] = SOFT_TISSUE_HU
+    skull = ellipsoid_mask(shape, center, radii * 0.9) & ~ellipsoid_mask(shape, center, radii * 0.82)
+    array[skull] = BONE_HU
+
+    # Nose: a wedge on the face, growing from the nasion at the top down to the tip
+    noseSlices = int(0.3 * slices), int(0.55 * slices)
+    k, j, i = np.ogrid[:slices, :rows, :columns]
+    faceFront = center[1] - radii[1] * np.sqrt(np.clip(1 - ((k - center[0]) / radii[0]) ** 2, 0, None))
+    relativeK = (noseSlices[1] - k) / max(noseSlices[1] - noseSlices[0], 1)
+    height = np.where((relativeK >= 0) & (relativeK <= 1), 0.15 * rows * np.minimum(0.2 + relativeK, 1), 0)
+    protrusion = faceFront - j
+    nose = (height > 0) & (protrusion >= -2) & (protrusion <= height) \
+        & (np.abs(i - center[2]) < 0.1 * columns * (1 - protrusion / np.maximum(height, 1)))
+    array[nose & (array == AIR_HU)] = SOFT_TISSUE_HU
+
+    sinusMasks = []
+    sinusSeedsKJI = []
+    for side in (-1, 1):
+        sinusCenter = (0.45 * slices, center[1] - 0.45 * radii[1], center[2] + side * 0.35 * radii[2])
+        mask = ellipsoid_mask(shape, sinusCenter, (0.1 * slices, 0.12 * rows, 0.08 * columns))
+        array[mask] = SINUS_AIR_HU
+        sinusMasks.append(mask)
+        sinusSeedsKJI.append(tuple(int(round(value)) for value in sinusCenter))
+
+    if noise:
+        noisy = array + np.random.default_rng(seed).normal(0, noise, shape)
+        array = np.clip(noisy, np.iinfo(np.int16).min, np.iinfo(np.int16).max).astype(np.int16)
+
+    ijkToRAS = np.diag([*spacing, 1.0])
+    return HeadPhantom(array, ijkToRAS, sinusMasks, sinusSeedsKJI, noseSlices)
@@ -1,24 +1,47 @@
-import qt
-from .CalculatorVolume import *
+class PipelineCancelled(Exception):
+    pass
 
 
 class PipelineApplierLogic:
     def __init__(self, updaterActions, creatorDataStorage):
         self.actions = []
-        self.updaterActions = updaterActions
+        self.updatersActions = [updaterActions]
         self.creatorDataStorage = creatorDataStorage
 
     def addAction(self, action):
         self.actions.append(action)
 
-    def run(self, calculatorVolume: CalculatorVolume, ijkPoints):
-        data = self.creatorDataStorage(calculatorVolume, ijkPoints)
+    def addUpdaterActions(self, updaterActions):
+        # Progress bars, profilers and so on, each gets start, update after every action and finish
+        self.updatersActions.append(updaterActions)
 
-        self.updaterActions.start()
+    def removeUpdaterActions(self, updaterActions):
+        self.updatersActions.remove(updaterActions)
+
+    def actionNames(self):
+        return [getActionName(action) for action in self.actions]
+
+    def run(self, source, points, cancelEvent=None):
+        """
+        Runs the actions one by one. cancelEvent is a threading.Event checked between the actions,
+        the run raises PipelineCancelled once it is set.
+        """
+        # source is a CalculatorVolume for the editor effect pipelines
+        data = self.creatorDataStorage(source, points)
+
+        for updaterActions in self.updatersActions:
+            updaterActions.start(data)
         for index, action in enumerate(self.actions):
+            if cancelEvent is not None and cancelEvent.is_set():
+                for updaterActions in self.updatersActions:
+                    updaterActions.finish(data)
+                raise PipelineCancelled()
             action(data)
-            self.updaterActions.update(index, len(self.actions))
-        self.updaterActions.finish()
+            for updaterActions in self.updatersActions:
+                updaterActions.update(index, len(self.actions), data)
+        for updaterActions in self.updatersActions:
+            updaterActions.finish(data)
+        return data
 
 
 class EditorEffectAction:
@@ -38,18 +61,53 @@ class EditorEffectAction:
         data.segmentEditorWidget.setActiveEffectByName(None)
 
 
+class ConditionalAction:
+    def __init__(self, condition, action):
+        self.condition = condition
+        self.action = action
+
+    def __call__(self, data, *args, **kwargs):
+        if self.condition(data):
+            self.action(data)
+
+
+def getActionName(action) -> str:
+    if isinstance(action, EditorEffectAction):
+        return action.effectName
+    if isinstance(action, ConditionalAction):
+        return getActionName(action.action)
+    return getattr(action, '__name__', type(action).__name__)
+
+
+class UpdaterActionsSilent:
+    def start(self, data=None):
+        pass
+
+    def update(self, i, size, data=None):
+        pass
+
+    def finish(self, data=None):
+        pass
+
+
 class UpdaterActionsOnProgressBar:
-    def __init__(self, uiContainer):
-        self.progressBar: qt.QProgressBar = uiContainer.progressBarForCalculatorVolume
+    def __init__(self, uiContainer, isCancellable: bool = False):
+        self.progressBar = uiContainer.progressBarForCalculatorVolume
+        # Only runs in a background thread can be cancelled, a synchronous run blocks the button anyway
+        self.cancelButton = getattr(uiContainer, 'cancelCalculatorVolumeButton', None) if isCancellable else None
 
-    def start(self):
+    def start(self, data=None):
         self.progressBar.setValue(0)
         self.progressBar.show()
+        if self.cancelButton is not None:
+            self.cancelButton.show()
 
-    def update(self, i, size):
+    def update(self, i, size, data=None):
         self.progressBar.setValue(float(i) / float(size) * 100)
         pass
 
-    def finish(self):
+    def finish(self, data=None):
         self.progressBar.setValue(100)
         self.progressBar.hide()
+        if self.cancelButton is not None:
+            self.cancelButton.hide()
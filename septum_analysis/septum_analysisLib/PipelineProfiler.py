@@ -0,0 +1,135 @@
+import csv
+import io
+import json
+import logging
+import time
+import tracemalloc
+from dataclasses import dataclass, field, asdict
+from typing import Callable, List, Optional
+
+
+@dataclass
+class ActionProfile:
+    index: int
+    name: str
+    wallSeconds: float
+    cpuSeconds: float
+    # Peak of the Python and NumPy allocations during the action over the allocations at its start,
+    # None when the memory is not traced. The memory VTK allocates is not traced.
+    peakTracedBytes: Optional[int] = None
+    voxels: Optional[int] = None
+
+
+@dataclass
+class RunProfile:
+    actions: List[ActionProfile] = field(default_factory=list)
+    wallSeconds: float = 0.0
+    cpuSeconds: float = 0.0
+
+    def slowest(self) -> Optional[ActionProfile]:
+        return max(self.actions, key=lambda action: action.wallSeconds, default=None)
+
+    def toDict(self) -> dict:
+        return asdict(self)
+
+    def toJson(self) -> str:
+        return json.dumps(self.toDict(), indent=2)
+
+    def toCsv(self) -> str:
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=list(ActionProfile.__dataclass_fields__))
+        writer.writeheader()
+        for action in self.actions:
+            writer.writerow(asdict(action))
+        return output.getvalue()
+
+    def format(self) -> str:
+        lines = [f'Pipeline run in {self.wallSeconds:.3f} s (CPU {self.cpuSeconds:.3f} s)']
+        for action in self.actions:
+            memory = '' if action.peakTracedBytes is None else \
+                f', traced peak +{action.peakTracedBytes / 2 ** 20:.1f} MB'
+            voxels = '' if action.voxels is None else f', {action.voxels} voxels'
+            lines.append(f'  {action.index}. {action.name}: {action.wallSeconds:.3f} s'
+                         f' (CPU {action.cpuSeconds:.3f} s){memory}{voxels}')
+        return '\n'.join(lines)
+
+
+class PipelineProfiler:
+    """
+    Updater of a PipelineApplierLogic recording the wall time, CPU time and, with a voxelCounter,
+    the voxel count after every action. The CPU time is the process time, so it includes the worker threads
+    of VTK and NumPy. Counting voxels is not included in the times.
+    With traceMemory the peak of the Python and NumPy allocations is recorded for every action with tracemalloc,
+    whose peak is reset at the start of each action. Tracing slows the allocations down, so the times of
+    a traced run are longer.
+    """
+
+    def __init__(self, voxelCounter: Callable = None, logRuns: bool = False, keepRuns: int = 10,
+                 traceMemory: bool = False):
+        self.voxelCounter = voxelCounter
+        self.logRuns = logRuns
+        self.keepRuns = keepRuns
+        self.traceMemory = traceMemory
+        self.actionNames = []
+        self.runs: List[RunProfile] = []
+        self.currentRun = None
+        self.runStartTimes = None
+        self.actionStartTimes = None
+        self.actionStartTracedMemory = None
+        self.isTracingStarted = False
+
+    def attachTo(self, pipeline) -> 'PipelineProfiler':
+        pipeline.addUpdaterActions(self)
+        self.actionNames = pipeline.actionNames()
+        return self
+
+    @property
+    def lastRun(self) -> Optional[RunProfile]:
+        return self.runs[-1] if self.runs else None
+
+    @staticmethod
+    def now():
+        return time.perf_counter(), time.process_time()
+
+    def resetTracedPeak(self):
+        if self.traceMemory:
+            tracemalloc.reset_peak()
+            self.actionStartTracedMemory = tracemalloc.get_traced_memory()[0]
+
+    def start(self, data=None):
+        # Tracing started by someone else is left running
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.isTracingStarted = True
+        self.currentRun = RunProfile()
+        self.resetTracedPeak()
+        self.runStartTimes = self.actionStartTimes = self.now()
+
+    def update(self, i, size, data=None):
+        wallTime, cpuTime = self.now()
+        peakTracedMemory = None
+        if self.traceMemory:
+            peakTracedMemory = tracemalloc.get_traced_memory()[1] - self.actionStartTracedMemory
+        name = self.actionNames[i] if i < len(self.actionNames) else f'action {i}'
+        voxels = None
+        if self.voxelCounter is not None and data is not None:
+            voxels = self.voxelCounter(data)
+
+        self.currentRun.actions.append(ActionProfile(
+            i, name, wallTime - self.actionStartTimes[0], cpuTime - self.actionStartTimes[1], peakTracedMemory, voxels
+        ))
+        self.resetTracedPeak()
+        self.actionStartTimes = self.now()
+
+    def finish(self, data=None):
+        wallTime, cpuTime = self.now()
+        self.currentRun.wallSeconds = wallTime - self.runStartTimes[0]
+        self.currentRun.cpuSeconds = cpuTime - self.runStartTimes[1]
+        self.runs.append(self.currentRun)
+        del self.runs[:-self.keepRuns]
+        self.currentRun = None
+        if self.isTracingStarted:
+            tracemalloc.stop()
+            self.isTracingStarted = False
+        if self.logRuns:
+            logging.info(self.lastRun.format())
@@ -0,0 +1,59 @@
+from .utils import require_module
+
+np = require_module('numpy')
+
+
+class RegionBox:
+    """
+    Axis-aligned box of array indices, start inclusive and stop exclusive, in (k, j, i) order.
+    """
+
+    def __init__(self, start, stop):
+        self.start = np.asarray(start, dtype=int)
+        self.stop = np.asarray(stop, dtype=int)
+
+    @classmethod
+    def aroundPoints(cls, pointsKJI, margin, shape):
+        """Bounding box of the points enlarged by margin voxels per axis and clipped to the array shape."""
+        points = np.asarray(pointsKJI, dtype=int).reshape(-1, 3)
+        margin = np.broadcast_to(np.asarray(margin, dtype=int), (3,))
+        start = np.maximum(points.min(axis=0) - margin, 0)
+        stop = np.minimum(points.max(axis=0) + margin + 1, shape)
+        return cls(start, stop)
+
+    @property
+    def slices(self):
+        return tuple(slice(begin, end) for begin, end in zip(self.start.tolist(), self.stop.tolist()))
+
+    @property
+    def shape(self):
+        return tuple((self.stop - self.start).tolist())
+
+    def coversShape(self, shape) -> bool:
+        return bool(np.all(self.start == 0) and np.all(self.stop == np.asarray(shape)))
+
+    def touchesBorder(self, croppedLabelmap: np.ndarray, shape) -> bool:
+        """
+        True if the labelmap of the box reaches a face of the box that is not a face of the whole array,
+        in which case the region may continue outside of the box.
+        """
+        for axis in range(3):
+            first = np.take(croppedLabelmap, 0, axis=axis)
+            last = np.take(croppedLabelmap, -1, axis=axis)
+            if self.start[axis] > 0 and first.any():
+                return True
+            if self.stop[axis] < shape[axis] and last.any():
+                return True
+        return False
+
+    def toFull(self, croppedLabelmap: np.ndarray, shape) -> np.ndarray:
+        """Pastes the labelmap of the box into an empty array of the full shape."""
+        labelmap = np.zeros(shape, dtype=croppedLabelmap.dtype)
+        labelmap[self.slices] = croppedLabelmap
+        return labelmap
+
+    def ijkToRAS(self, ijkToRAS: np.ndarray) -> np.ndarray:
+        """IJK to RAS matrix of the cropped array from the matrix of the full one."""
+        translation = np.eye(4)
+        translation[:3, 3] = self.start[::-1]
+        return np.asarray(ijkToRAS) @ translation
@@ -0,0 +1,133 @@
+import hashlib
+from collections import OrderedDict
+
+from .utils import require_module
+
+np = require_module('numpy')
+
+
+def array_content_hash(array: np.ndarray) -> str:
+    """Hash of the shape, dtype and voxels of an array, hashed slice by slice to avoid a full copy."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((array.shape, array.dtype.str)).encode())
+    for index in range(array.shape[0]):
+        digest.update(np.ascontiguousarray(array[index]).data)
+    return digest.hexdigest()
+
+
+MAX_HASHED_VOLUMES = 4
+# Node ID -> (modification times, hash), the most recently used last
+volumeHashes = OrderedDict()
+
+
+def volume_node_content_hash(volumeNode) -> str:
+    """
+    Content hash of the voxels and geometry of a volume node, recomputed only when its image data changes.
+    The hashes of the last MAX_HASHED_VOLUMES nodes are kept.
+    """
+    import slicer
+    import vtk
+    nodeID = volumeNode.GetID()
+    modificationTimes = (volumeNode.GetImageData().GetMTime(), volumeNode.GetMTime())
+    entry = volumeHashes.get(nodeID)
+    if entry is not None and entry[0] == modificationTimes:
+        volumeHashes.move_to_end(nodeID)
+        return entry[1]
+
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    geometry = slicer.util.arrayFromVTKMatrix(ijkToRAS).tobytes()
+    volumeHash = array_content_hash(slicer.util.arrayFromVolume(volumeNode)) + \
+        hashlib.blake2b(geometry, digest_size=8).hexdigest()
+    volumeHashes[nodeID] = (modificationTimes, volumeHash)
+    volumeHashes.move_to_end(nodeID)
+    while len(volumeHashes) > MAX_HASHED_VOLUMES:
+        volumeHashes.popitem(last=False)
+    return volumeHash
+
+
+class PackedLabelmap:
+    """Binary labelmap stored as bits of its bounding box."""
+
+    def __init__(self, labelmap: np.ndarray):
+        self.shape = labelmap.shape
+        nonzero = np.nonzero(labelmap.any(axis=(1, 2)))[0], \
+            np.nonzero(labelmap.any(axis=(0, 2)))[0], \
+            np.nonzero(labelmap.any(axis=(0, 1)))[0]
+        if any(len(indices) == 0 for indices in nonzero):
+            self.box = tuple(slice(0, 0) for _ in range(3))
+        else:
+            self.box = tuple(slice(indices[0], indices[-1] + 1) for indices in nonzero)
+        cropped = labelmap[self.box] != 0
+        self.boxShape = cropped.shape
+        self.bits = np.packbits(cropped, axis=None)
+
+    @property
+    def nbytes(self) -> int:
+        return self.bits.nbytes
+
+    def unpackBox(self) -> np.ndarray:
+        count = int(np.prod(self.boxShape))
+        return np.unpackbits(self.bits, count=count).reshape(self.boxShape).view(bool)
+
+    def contains(self, kji) -> bool:
+        inBox = all(axisBox.start <= index < axisBox.stop for axisBox, index in zip(self.box, kji))
+        if not inBox:
+            return False
+        flatIndex = np.ravel_multi_index([index - axisBox.start for axisBox, index in zip(self.box, kji)],
+                                         self.boxShape)
+        return bool(self.bits[flatIndex // 8] & (0x80 >> (flatIndex % 8)))
+
+    def toArray(self, dtype=np.uint8) -> np.ndarray:
+        labelmap = np.zeros(self.shape, dtype=dtype)
+        labelmap[self.box] = self.unpackBox()
+        return labelmap
+
+
+class LabelmapCache:
+    """
+    LRU cache of binary labelmaps keyed by a volume content hash and the parameters that produced them.
+    Labelmaps are kept bit-packed and cropped, the least recently used ones are evicted
+    when the total size exceeds memoryBudget bytes.
+    """
+    DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024
+
+    def __init__(self, memoryBudget: int = DEFAULT_MEMORY_BUDGET):
+        self.memoryBudget = memoryBudget
+        self.memoryUsage = 0
+        self.entries = OrderedDict()
+        self.lastEntryIndex = 0
+
+    def put(self, volumeHash: str, parameters: tuple, labelmap: np.ndarray) -> None:
+        packed = PackedLabelmap(labelmap)
+        if packed.nbytes > self.memoryBudget:
+            return
+        self.lastEntryIndex += 1
+        self.entries[(volumeHash, parameters, self.lastEntryIndex)] = packed
+        self.memoryUsage += packed.nbytes
+        while self.memoryUsage > self.memoryBudget:
+            _, evicted = self.entries.popitem(last=False)
+            self.memoryUsage -= evicted.nbytes
+
+    def get(self, volumeHash: str, parameters: tuple):
+        """The most recent labelmap computed for the volume with the parameters, None if there is none."""
+        return self.findContaining(volumeHash, parameters, [])
+
+    def findContaining(self, volumeHash: str, parameters: tuple, seedsKJI):
+        """
+        The most recent labelmap computed for the volume with the parameters that contains every seed,
+        None if there is none. A seed inside a cached result lies in the same connected region,
+        so the pipeline would produce the same labelmap for it.
+        """
+        for key in reversed(self.entries):
+            if key[0] != volumeHash or key[1] != parameters:
+                continue
+            packed = self.entries[key]
+            if all(packed.contains(seed) for seed in seedsKJI):
+                self.entries.move_to_end(key)
+                return packed.toArray()
+        return None
+
+    def clear(self) -> None:
+        self.entries.clear()
+        self.memoryUsage = 0
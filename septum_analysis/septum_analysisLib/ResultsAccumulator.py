@@ -0,0 +1,200 @@
+import csv
+import math
+import os
+import sqlite3
+
+from .LabelmapStatistics import STATISTICS_COLUMNS, SURFACE_AREA_COLUMN
+
+
+VOLUME_ID_COLUMN = 'Volume ID'
+# Name of the volume node, only shown
+VOLUME_COLUMN = 'Volume'
+RESULTS_COLUMNS = (VOLUME_ID_COLUMN, STATISTICS_COLUMNS[0], VOLUME_COLUMN) + STATISTICS_COLUMNS[1:] \
+    + (SURFACE_AREA_COLUMN,)
+# A row is identified by the volume ID and the segment name
+KEY_COLUMN_COUNT = 2
+# The key columns and the volume name
+TEXT_COLUMN_COUNT = 3
+SQLITE_EXTENSIONS = ('.db', '.sqlite', '.sqlite3')
+SQLITE_TABLE_NAME = 'segment_statistics'
+
+
+def results_row(volumeID: str, volumeName: str, measurement) -> tuple:
+    """Row of RESULTS_COLUMNS of a SegmentMeasurement, the surface area is None when it was not requested."""
+    return (volumeID, measurement.name, volumeName, measurement.voxelCount, measurement.volumeMm3,
+            measurement.volumeCm3, measurement.surfaceAreaMm2)
+
+
+def check_columns(path: str, columns) -> None:
+    if list(columns) != list(RESULTS_COLUMNS):
+        raise ValueError(f"{path} was written with other columns, choose a new results file")
+
+
+class CsvResultsSink:
+    """
+    Appends the changed rows to a CSV file, so a save costs only its changed rows. A row updated
+    later is appended again, the last row of a (volume ID, segment) key is the current one.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, rows) -> None:
+        isNewFile = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        if not isNewFile:
+            with open(self.path, newline='') as file:
+                check_columns(self.path, next(csv.reader(file), []))
+        with open(self.path, 'a', newline='') as file:
+            writer = csv.writer(file)
+            if isNewFile:
+                writer.writerow(RESULTS_COLUMNS)
+            writer.writerows(['' if value is None else value for value in row] for row in rows)
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteResultsSink:
+    """Keeps one row per (volume ID, segment) key in a SQLite table, updated rows replace the previous ones."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        columns = ', '.join(f'"{name}"' for name in RESULTS_COLUMNS)
+        keyColumns = ', '.join(f'"{name}"' for name in RESULTS_COLUMNS[:KEY_COLUMN_COUNT])
+        with self.connection:
+            self.connection.execute(
+                f'CREATE TABLE IF NOT EXISTS {SQLITE_TABLE_NAME} ({columns}, PRIMARY KEY ({keyColumns}))'
+            )
+        tableInfo = self.connection.execute(f'PRAGMA table_info({SQLITE_TABLE_NAME})').fetchall()
+        try:
+            check_columns(path, [column[1] for column in tableInfo])
+        except ValueError:
+            self.connection.close()
+            raise
+        self.insertStatement = f'INSERT OR REPLACE INTO {SQLITE_TABLE_NAME} ({columns}) ' \
+                               f'VALUES ({", ".join("?" * len(RESULTS_COLUMNS))})'
+
+    def write(self, rows) -> None:
+        with self.connection:
+            self.connection.executemany(self.insertStatement, rows)
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def results_sink(path: str):
+    """SQLite sink for the SQLITE_EXTENSIONS, CSV sink for other paths, None without a path."""
+    if not path:
+        return None
+    if os.path.splitext(path)[1].lower() in SQLITE_EXTENSIONS:
+        return SqliteResultsSink(path)
+    return CsvResultsSink(path)
+
+
+class ResultsAccumulator:
+    """
+    Statistics of a session keyed by (volume ID, segment name), the volume ID stays the same when the volume
+    node is renamed or loaded again, its name is only shown. A save upserts only the rows whose
+    values changed: they are updated in place or appended to the table node and written to the sink,
+    so a table of a cohort of patients is built without exporting every row again on every save.
+    """
+
+    def __init__(self, sink=None):
+        # (volume ID, segment name) -> row of RESULTS_COLUMNS
+        self.rows = {}
+        # (volume ID, segment name) -> row index in the table node
+        self.rowIndices = {}
+        self.tableNode = None
+        self.sink = sink
+
+    def setSink(self, sink) -> None:
+        if self.sink is not None:
+            self.sink.close()
+        self.sink = sink
+
+    def close(self) -> None:
+        self.setSink(None)
+
+    def upsert(self, volumeID: str, measurements, volumeName: str = None) -> list:
+        """Stores the measurements of the volume, returns the changed rows. volumeName defaults to volumeID."""
+        changedRows = []
+        for measurement in measurements:
+            row = results_row(volumeID, volumeID if volumeName is None else volumeName, measurement)
+            key = row[:KEY_COLUMN_COUNT]
+            if self.rows.get(key) != row:
+                self.rows[key] = row
+                changedRows.append(row)
+
+        if changedRows:
+            if self.tableNode is not None:
+                self.writeTableRows(changedRows)
+            if self.sink is not None:
+                self.sink.write(changedRows)
+        return changedRows
+
+    def setTableNode(self, tableNode) -> None:
+        """
+        Shows the accumulated rows in the table node. The rows of a node that already has the results columns,
+        for example of a loaded scene, are kept and the accumulated rows are merged into it.
+        """
+        if tableNode is self.tableNode:
+            return
+        self.tableNode = tableNode
+        self.rowIndices = {}
+        if tableNode is None:
+            return
+
+        table = tableNode.GetTable()
+        hasResultsColumns = table.GetNumberOfColumns() == len(RESULTS_COLUMNS) and all(
+            table.GetColumnName(index) == name for index, name in enumerate(RESULTS_COLUMNS)
+        )
+        if hasResultsColumns:
+            for rowIndex in range(table.GetNumberOfRows()):
+                row = self.readTableRow(rowIndex)
+                key = row[:KEY_COLUMN_COUNT]
+                self.rowIndices[key] = rowIndex
+                self.rows.setdefault(key, row)
+        else:
+            self.createTableColumns()
+
+        self.writeTableRows([row for key, row in self.rows.items()
+                             if key not in self.rowIndices or self.readTableRow(self.rowIndices[key]) != row])
+
+    def createTableColumns(self) -> None:
+        import vtk
+
+        wasModifying = self.tableNode.StartModify()
+        self.tableNode.RemoveAllColumns()
+        table = self.tableNode.GetTable()
+        for index, name in enumerate(RESULTS_COLUMNS):
+            array = vtk.vtkStringArray() if index < TEXT_COLUMN_COUNT else \
+                vtk.vtkIdTypeArray() if index == TEXT_COLUMN_COUNT else vtk.vtkDoubleArray()
+            array.SetName(name)
+            table.AddColumn(array)
+        self.tableNode.EndModify(wasModifying)
+
+    def readTableRow(self, rowIndex: int) -> tuple:
+        table = self.tableNode.GetTable()
+        row = [table.GetColumn(index).GetValue(rowIndex) for index in range(len(RESULTS_COLUMNS))]
+        # An area that was not requested is stored as NaN
+        if math.isnan(row[-1]):
+            row[-1] = None
+        return tuple(row)
+
+    def writeTableRows(self, rows) -> None:
+        if not rows:
+            return
+        table = self.tableNode.GetTable()
+        wasModifying = self.tableNode.StartModify()
+        for row in rows:
+            key = row[:KEY_COLUMN_COUNT]
+            rowIndex = self.rowIndices.get(key)
+            if rowIndex is None:
+                rowIndex = table.InsertNextBlankRow()
+                self.rowIndices[key] = rowIndex
+            for columnIndex, value in enumerate(row):
+                table.GetColumn(columnIndex).SetValue(rowIndex, math.nan if value is None else value)
+        table.Modified()
+        self.tableNode.Modified()
+        self.tableNode.EndModify(wasModifying)
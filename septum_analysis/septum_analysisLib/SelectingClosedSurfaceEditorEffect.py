@@ -1,5 +1,13 @@
+import copy
+
+import numpy as np
+
 from .CalculatorVolume import *
 from .PipelineApplierLogic import *
+from .ResultCache import LabelmapCache, volume_node_content_hash
+from .RegionOfInterest import RegionBox
+from .VolumeHistogram import volumeStatistics
+from .utils import ijkPointsToKJI
 
 
 def getLibModule():
@@ -52,6 +60,9 @@ class ApplierLogicWithMask:
     DEFAULT_MINIMUM_DIAMETER = 1.0
     DEFAULT_CLOSING_SMOOTHING_SIZE = 1.5
     DEFAULT_CLOSING_SMOOTHING_SIZE_FOR_END = 1.5
+    DEFAULT_MINIMUM_ISLAND_SIZE = 3000
+    # Marks the temporary nodes of the cropped region, their masks are neither hashed nor cached
+    REGION_OF_INTEREST_ATTRIBUTE = 'septum_analysis.RegionOfInterest'
 
     class Data:
         def __init__(self, calculatorVolume: CalculatorVolume, ijkPoints):
@@ -63,13 +74,29 @@ class ApplierLogicWithMask:
             self.ijkPoints = ijkPoints
             self.segmentEditorWidget = calculatorVolume.segmentEditorWidget
             self.volumeImageData = calculatorVolume.volumeNode.GetImageData()
-            self.sourceVolumeMin, self.sourceVolumeMax = self.volumeImageData.GetScalarRange()
             self.threshold = calculatorVolume.maximumThreshold + calculatorVolume.offsetThreshold
 
+            isRegionOfInterest = calculatorVolume.volumeNode.GetAttribute(
+                ApplierLogicWithMask.REGION_OF_INTEREST_ATTRIBUTE
+            ) is not None
+            if isRegionOfInterest:
+                # A crop lives for one click, caching its statistics would only evict the ones of real volumes.
+                # Its voxels are all within its own range, so the thresholds select what the parent range would.
+                self.sourceVolumeMin, self.sourceVolumeMax = self.volumeImageData.GetScalarRange()
+            else:
+                statistics = volumeStatistics.get(calculatorVolume.volumeNode)
+                self.sourceVolumeMin, self.sourceVolumeMax = statistics.scalarRange
+            self.volumeHash = None if isRegionOfInterest else volume_node_content_hash(calculatorVolume.volumeNode)
+            self.mask = None
+
     def __init__(self, updaterActions):
         self.minimumDiameter = self.DEFAULT_MINIMUM_DIAMETER
         self.closingSmoothingSize = self.DEFAULT_CLOSING_SMOOTHING_SIZE
         self.closingSmoothingSizeForEnd = self.DEFAULT_CLOSING_SMOOTHING_SIZE_FOR_END
+        self.minimumIslandSize = self.DEFAULT_MINIMUM_ISLAND_SIZE
+        # Margin around the seeds of the cropped region in mm, None runs the pipeline on the whole volume
+        self.roiMarginMm = None
+        self.resultCache = LabelmapCache()
         self.pipeline = PipelineApplierLogic(
             updaterActions,
             lambda calculatorVolume, ijkPoints: ApplierLogicWithMask.Data(calculatorVolume, ijkPoints)
@@ -81,18 +108,40 @@ class ApplierLogicWithMask:
             data.maskSegmentID = data.segmentation.AddEmptySegment("__Mask__", "Mask")
             data.calculatorVolume.segmentEditorNode.SetSelectedSegmentID(data.maskSegmentID)
 
+            # The mask depends only on the volume, the threshold and the kernel size, not on the clicked point
+            if data.volumeHash is not None:
+                data.mask = self.resultCache.get(data.volumeHash, self.getMaskParameters(data))
+            if data.mask is not None:
+                slicer.util.updateSegmentBinaryLabelmapFromArray(
+                    data.mask, data.calculatorVolume.segmentationNode, data.maskSegmentID,
+                    data.calculatorVolume.volumeNode
+                )
+
+        def isMaskNotComputed(data: ApplierLogicWithMask.Data):
+            return data.mask is None
+
         self.pipeline.addAction(createAndSetMaskSegment)
-        self.pipeline.addAction(EditorEffectAction('Threshold', {
+        self.pipeline.addAction(ConditionalAction(isMaskNotComputed, EditorEffectAction('Threshold', {
             'MinimumThreshold': lambda data: data.threshold,
             'MaximumThreshold': lambda data: data.sourceVolumeMax,
-        }))
-        self.pipeline.addAction(EditorEffectAction('Smoothing', {
+        })))
+        self.pipeline.addAction(ConditionalAction(isMaskNotComputed, EditorEffectAction('Smoothing', {
             'SmoothingMethod': lambda _: SegmentEditorEffects.MORPHOLOGICAL_CLOSING,
             'KernelSizeMm': lambda _: self.closingSmoothingSize,
-        }))
-        self.pipeline.addAction(EditorEffectAction('Logical operators', {
+        })))
+        self.pipeline.addAction(ConditionalAction(isMaskNotComputed, EditorEffectAction('Logical operators', {
             'Operation': lambda _: SegmentEditorEffects.LOGICAL_INVERT,
-        }))
+        })))
+
+        def storeMaskSegment(data: ApplierLogicWithMask.Data):
+            if data.volumeHash is None:
+                return
+            data.mask = slicer.util.arrayFromSegmentBinaryLabelmap(
+                data.calculatorVolume.segmentationNode, data.maskSegmentID, data.calculatorVolume.volumeNode
+            )
+            self.resultCache.put(data.volumeHash, self.getMaskParameters(data), data.mask)
+
+        self.pipeline.addAction(ConditionalAction(isMaskNotComputed, storeMaskSegment))
 
         def changeCurrentNodeAndMaskNode(data: ApplierLogicWithMask.Data):
             data.calculatorVolume.segmentEditorNode.SetSelectedSegmentID(data.prevSegmentID)
@@ -115,12 +164,132 @@ class ApplierLogicWithMask:
         self.pipeline.addAction(returnMaskNodeAndRemoveMaskSegments)
         self.pipeline.addAction(EditorEffectAction('Islands', {
             'Operation': lambda _: SegmentEditorEffects.REMOVE_SMALL_ISLANDS,
-            'MinimumSize': lambda _: 3000,
+            'MinimumSize': lambda _: self.minimumIslandSize,
         }))
         self.pipeline.addAction(EditorEffectAction('Smoothing', {
             'SmoothingMethod': lambda _: SegmentEditorEffects.MORPHOLOGICAL_CLOSING,
             'KernelSizeMm': lambda _: self.closingSmoothingSizeForEnd,
         }))
 
-    def apply(self, calculatorVolume: CalculatorVolume, ijkPoints):
-        self.pipeline.run(calculatorVolume, ijkPoints)
+    def getMaskParameters(self, data: Data) -> tuple:
+        return 'mask', data.threshold, self.closingSmoothingSize
+
+    @staticmethod
+    def countSelectedSegmentVoxels(data: Data) -> int:
+        """Voxel counter for PipelineProfiler, it exports the labelmap so it is slow on big volumes."""
+        calculatorVolume = data.calculatorVolume
+        segmentID = calculatorVolume.segmentEditorNode.GetSelectedSegmentID()
+        labelmap = slicer.util.arrayFromSegmentBinaryLabelmap(
+            calculatorVolume.segmentationNode, segmentID, calculatorVolume.volumeNode
+        )
+        return int(np.count_nonzero(labelmap))
+
+    def getResultParameters(self, calculatorVolume: CalculatorVolume) -> tuple:
+        return (
+            calculatorVolume.maximumThreshold + calculatorVolume.offsetThreshold,
+            self.closingSmoothingSize,
+            self.closingSmoothingSizeForEnd,
+            self.minimumDiameter,
+            self.minimumIslandSize,
+            self.roiMarginMm,
+        )
+
+    def apply(self, calculatorVolume: CalculatorVolume, ijkPoints, previousLabelmap=None):
+        volumeNode = calculatorVolume.volumeNode
+        segmentationNode = calculatorVolume.segmentationNode
+        segmentID = calculatorVolume.segmentEditorNode.GetSelectedSegmentID()
+        volumeHash = volume_node_content_hash(volumeNode)
+        parameters = self.getResultParameters(calculatorVolume)
+
+        # A seed inside an already computed region gives the same region again
+        labelmap = self.resultCache.findContaining(volumeHash, parameters, ijkPointsToKJI(ijkPoints))
+        if labelmap is not None:
+            calculatorVolume.writeResultLabelmap(labelmap, segmentID, previousLabelmap)
+            return
+
+        if self.roiMarginMm is None:
+            # The effects paint into the selected segment
+            calculatorVolume.clearSegment(segmentID)
+            self.pipeline.run(calculatorVolume, ijkPoints)
+            labelmap = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentID, volumeNode)
+            if previousLabelmap is not None:
+                calculatorVolume.writeResultLabelmap(labelmap, segmentID, previousLabelmap)
+        else:
+            labelmap = self.runInRegionOfInterest(calculatorVolume, ijkPoints)
+            calculatorVolume.writeResultLabelmap(labelmap, segmentID, previousLabelmap)
+        # The cache keeps the region of these seeds alone, without the previous ones
+        self.resultCache.put(volumeHash, parameters, labelmap)
+
+    def runInRegionOfInterest(self, calculatorVolume: CalculatorVolume, ijkPoints):
+        """
+        Runs the pipeline on a box around the seeds. The box margin is doubled while the result touches
+        the box border inside the volume. Returns the result pasted into a labelmap of the whole volume.
+        """
+        volumeArray = slicer.util.arrayFromVolume(calculatorVolume.volumeNode)
+        spacingKJI = np.array(calculatorVolume.volumeNode.GetSpacing())[::-1]
+        margin = np.maximum(np.ceil(self.roiMarginMm / spacingKJI), 1).astype(int)
+        seedsKJI = ijkPointsToKJI(ijkPoints)
+
+        while True:
+            box = RegionBox.aroundPoints(seedsKJI, margin, volumeArray.shape)
+            croppedLabelmap = self.runOnCroppedVolume(calculatorVolume, ijkPoints, volumeArray, box)
+            if box.coversShape(volumeArray.shape) or not box.touchesBorder(croppedLabelmap, volumeArray.shape):
+                return box.toFull(croppedLabelmap, volumeArray.shape)
+            margin *= 2
+
+    @classmethod
+    def createRegionOfInterestNode(cls, className: str):
+        """
+        Temporary node of the cropped region. It is marked before it is added to the scene,
+        so the observers of NodeAddedEvent, like the volume selector of the widget, can skip it.
+        """
+        node = slicer.mrmlScene.CreateNodeByClass(className)
+        node.UnRegister(None)
+        node.SetName("__ROI__")
+        node.SetHideFromEditors(True)
+        node.SetAttribute(cls.REGION_OF_INTEREST_ATTRIBUTE, '1')
+        return slicer.mrmlScene.AddNode(node)
+
+    def runOnCroppedVolume(self, calculatorVolume: CalculatorVolume, ijkPoints, volumeArray, box: RegionBox):
+        segmentEditorWidget = calculatorVolume.segmentEditorWidget
+        segmentEditorNode = calculatorVolume.segmentEditorNode
+        segmentID = segmentEditorNode.GetSelectedSegmentID()
+
+        ijkToRAS = vtk.vtkMatrix4x4()
+        calculatorVolume.volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        croppedVolumeNode = self.createRegionOfInterestNode("vtkMRMLScalarVolumeNode")
+        croppedSegmentationNode = self.createRegionOfInterestNode("vtkMRMLSegmentationNode")
+        try:
+            slicer.util.updateVolumeFromArray(croppedVolumeNode, volumeArray[box.slices])
+            croppedVolumeNode.SetIJKToRASMatrix(
+                slicer.util.vtkMatrixFromArray(box.ijkToRAS(slicer.util.arrayFromVTKMatrix(ijkToRAS)))
+            )
+            croppedSegmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(croppedVolumeNode)
+            croppedSegmentID = croppedSegmentationNode.GetSegmentation().AddEmptySegment(
+                segmentID, calculatorVolume.segmentName
+            )
+
+            croppedIjkPoints = vtk.vtkPoints()
+            for index in range(ijkPoints.GetNumberOfPoints()):
+                point = np.array(ijkPoints.GetPoint(index)) - box.start[::-1]
+                croppedIjkPoints.InsertNextPoint(*point)
+
+            # The pipeline works with the nodes of the calculator, give it a copy pointing to the cropped ones
+            croppedCalculatorVolume = copy.copy(calculatorVolume)
+            croppedCalculatorVolume.volumeNode = croppedVolumeNode
+            croppedCalculatorVolume.segmentationNode = croppedSegmentationNode
+            segmentEditorWidget.setSegmentationNode(croppedSegmentationNode)
+            segmentEditorWidget.setSourceVolumeNode(croppedVolumeNode)
+            segmentEditorNode.SetSelectedSegmentID(croppedSegmentID)
+
+            self.pipeline.run(croppedCalculatorVolume, croppedIjkPoints)
+            return slicer.util.arrayFromSegmentBinaryLabelmap(
+                croppedSegmentationNode, croppedSegmentID, croppedVolumeNode
+            )
+        finally:
+            segmentEditorWidget.setSegmentationNode(calculatorVolume.segmentationNode)
+            segmentEditorWidget.setSourceVolumeNode(calculatorVolume.volumeNode)
+            segmentEditorNode.SetSelectedSegmentID(segmentID)
+            slicer.mrmlScene.RemoveNode(croppedSegmentationNode)
+            slicer.mrmlScene.RemoveNode(croppedVolumeNode)
+
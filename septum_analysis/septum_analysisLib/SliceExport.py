@@ -0,0 +1,211 @@
+"""
+Export of the slices of a scan for the notebooks.
+
+The voxels are windowed straight from the array in their stored dtype and written with their exact pixel size,
+as 8 or 16-bit PNG files "slice_<index>.png" or as one compressed stack (NPZ, or Zarr when it is installed).
+An axial, coronal or sagittal slice is the (i, j), (i, k) or (j, k) plane, as nii_data[:, :, k] of the nibabel
+array, so the PNG files keep the orientation of the plt.imshow(nii_data[:, :, k]) files read by the notebooks.
+With the "array" layout the planes are written as slicer.util.arrayFromVolume gives them, (j, i) for axial slices.
+Slices are windowed and written in a thread pool, OpenCV, zlib and NumPy release the GIL meanwhile.
+"""
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .VolumeAccessor import VolumeAccessor
+from .utils import require_module
+
+np = require_module('numpy')
+
+# Window level and width of the CT presets of the Volumes module
+WINDOW_PRESETS = {
+    'ct-air': (-426, 1000),
+    'ct-abdomen': (40, 350),
+    'ct-bone': (400, 1000),
+    'ct-brain': (50, 100),
+    'ct-lung': (-500, 1400),
+}
+# Stretches [min, max] of the exported slices
+WINDOW_FULL = 'full'
+# Keeps the stored values, only for the stacks
+WINDOW_NONE = 'none'
+
+# Slicing axis of the (k, j, i) array
+SLICE_AXES = {'axial': 0, 'coronal': 1, 'sagittal': 2}
+
+# Rows and columns of the written slices
+LAYOUT_NIFTI = 'nifti'
+LAYOUT_ARRAY = 'array'
+SLICE_LAYOUTS = (LAYOUT_NIFTI, LAYOUT_ARRAY)
+
+FORMAT_PNG = 'png'
+FORMAT_NPZ = 'npz'
+FORMAT_ZARR = 'zarr'
+SLICE_FILE_NAME = 'slice_{index}.png'
+DEFAULT_PNG_COMPRESSION = 3
+
+
+def window_range(level: float, width: float):
+    return level - width / 2, level + width / 2
+
+
+def apply_window(image: np.ndarray, low: float, high: float, dtype=np.uint8) -> np.ndarray:
+    """Maps [low, high] to the full range of the unsigned dtype, values outside are clipped."""
+    maximum = np.iinfo(dtype).max
+    values = image.astype(np.float32)
+    values -= low
+    values *= maximum / (high - low) if high > low else 0
+    np.clip(values, 0, maximum, out=values)
+    return np.rint(values, out=values).astype(dtype)
+
+
+def slice_indices(size: int, start: int = None, stop: int = None, step: int = None) -> range:
+    return range(*slice(start, stop, step).indices(size))
+
+
+def slices_range(slices: np.ndarray, indices) -> tuple:
+    """Minimum and maximum of the chosen slices, read one slice at a time."""
+    low, high = np.inf, -np.inf
+    for index in indices:
+        low, high = min(low, float(slices[index].min())), max(high, float(slices[index].max()))
+    return low, high
+
+
+def export_slices(volume: VolumeAccessor, output: str, outputFormat: str = FORMAT_PNG, axis: str = 'axial',
+                  indices=None, window=WINDOW_FULL, dtype=np.uint8, workers: int = None,
+                  compression: int = DEFAULT_PNG_COMPRESSION, layout: str = LAYOUT_NIFTI):
+    """
+    Writes the slices with the given indices along axis, all of them by default, and returns the written paths.
+    window is a name of WINDOW_PRESETS, WINDOW_FULL, WINDOW_NONE or a (low, high) pair.
+    layout is LAYOUT_NIFTI for the slices of the nibabel (i, j, k) array, or LAYOUT_ARRAY for the planes
+    of the (k, j, i) array.
+    """
+    if layout not in SLICE_LAYOUTS:
+        raise ValueError(f"Unknown slice layout {layout}")
+    slices = np.moveaxis(volume.array, SLICE_AXES[axis], 0)
+    if layout == LAYOUT_NIFTI:
+        slices = slices.transpose(0, 2, 1)
+    indices = list(slice_indices(len(slices)) if indices is None else indices)
+    if window == WINDOW_NONE:
+        if outputFormat == FORMAT_PNG:
+            raise ValueError("PNG slices need a window, stored values are written only into stacks")
+        low = high = None
+        dtype = slices.dtype
+    elif window == WINDOW_FULL:
+        low, high = slices_range(slices, indices)
+    elif isinstance(window, str):
+        low, high = window_range(*WINDOW_PRESETS[window])
+    else:
+        low, high = window
+
+    def image(index):
+        if low is None:
+            return np.ascontiguousarray(slices[index])
+        # Planes of the NIfTI layout are transposed views, OpenCV writes only contiguous images
+        return np.ascontiguousarray(apply_window(slices[index], low, high, dtype))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if outputFormat == FORMAT_PNG:
+            return write_png_slices(executor, image, indices, output, compression)
+        attributes = {
+            'axis': axis,
+            'layout': layout,
+            'indices': np.asarray(indices),
+            'window': np.asarray([np.nan, np.nan] if low is None else [low, high]),
+            'ijkToRAS': volume.ijkToRAS,
+        }
+        shape = (len(indices),) + slices.shape[1:]
+        if outputFormat == FORMAT_NPZ:
+            return write_npz_stack(executor, image, indices, output, shape, dtype, attributes)
+        if outputFormat == FORMAT_ZARR:
+            return write_zarr_stack(executor, image, indices, output, shape, dtype, attributes)
+    raise ValueError(f"Unknown slice export format {outputFormat}")
+
+
+def write_png_slices(executor, image, indices, outputDirectory: str, compression: int):
+    cv2 = require_module('cv2', 'opencv-python')
+    os.makedirs(outputDirectory, exist_ok=True)
+
+    def write(index):
+        path = os.path.join(outputDirectory, SLICE_FILE_NAME.format(index=index))
+        if not cv2.imwrite(path, image(index), [cv2.IMWRITE_PNG_COMPRESSION, compression]):
+            raise OSError(f"Cannot write {path}")
+        return path
+
+    return list(executor.map(write, indices))
+
+
+def write_npz_stack(executor, image, indices, path: str, shape, dtype, attributes: dict):
+    stack = np.empty(shape, dtype=dtype)
+
+    def fill(position):
+        stack[position] = image(indices[position])
+
+    list(executor.map(fill, range(len(indices))))
+    np.savez_compressed(path, slices=stack, **attributes)
+    # np.savez_compressed appends the extension when it is missing
+    return [path if path.endswith('.npz') else path + '.npz']
+
+
+def write_zarr_stack(executor, image, indices, path: str, shape, dtype, attributes: dict):
+    # Optional, only the users of this format need it
+    import zarr
+
+    # A chunk per slice, so the threads never write into the same chunk
+    stack = zarr.open_array(path, mode='w', shape=shape, chunks=(1,) + shape[1:], dtype=dtype)
+
+    def write(position):
+        stack[position] = image(indices[position])
+
+    list(executor.map(write, range(len(indices))))
+    stack.attrs.update({key: np.asarray(value).tolist() for key, value in attributes.items()})
+    return [path]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='scan, .nii, .nii.gz, .nrrd or .nhdr')
+    parser.add_argument('output', help='directory of PNG slices, or the .npz/.zarr stack')
+    parser.add_argument('--format', default=FORMAT_PNG, choices=[FORMAT_PNG, FORMAT_NPZ, FORMAT_ZARR])
+    parser.add_argument('--bits', type=int, default=8, choices=[8, 16], help='depth of the windowed values')
+    parser.add_argument('--window', default=WINDOW_FULL, choices=[WINDOW_FULL, WINDOW_NONE] + list(WINDOW_PRESETS),
+                        help=f'"{WINDOW_NONE}" keeps the stored values of a stack')
+    parser.add_argument('--window-level', type=float, help='custom window, with --window-width')
+    parser.add_argument('--window-width', type=float)
+    parser.add_argument('--axis', default='axial', choices=list(SLICE_AXES))
+    parser.add_argument('--layout', default=LAYOUT_NIFTI, choices=SLICE_LAYOUTS,
+                        help=f'"{LAYOUT_NIFTI}": rows along the first axis of the NIfTI voxels, as the notebooks '
+                             f'read the slices, "{LAYOUT_ARRAY}": rows along the second axis of the Slicer array')
+    parser.add_argument('--start', type=int, help='first slice, negative values count from the end')
+    parser.add_argument('--stop', type=int, help='slice after the last one')
+    parser.add_argument('--step', type=int)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--compression', type=int, default=DEFAULT_PNG_COMPRESSION, choices=range(10),
+                        help='PNG compression level')
+    args = parser.parse_args(argv)
+
+    if (args.window_level is None) != (args.window_width is None):
+        parser.error('--window-level and --window-width go together')
+    if args.window == WINDOW_NONE and args.format == FORMAT_PNG:
+        parser.error(f'--window {WINDOW_NONE} is only for stacks')
+
+    if args.format == FORMAT_ZARR:
+        # Fail before reading the scan
+        import zarr  # noqa: F401
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    window = args.window
+    if args.window_level is not None:
+        window = window_range(args.window_level, args.window_width)
+    volume = VolumeAccessor.fromFile(args.input)
+    indices = slice_indices(volume.array.shape[SLICE_AXES[args.axis]], args.start, args.stop, args.step)
+
+    startTime = time.perf_counter()
+    paths = export_slices(volume, args.output, args.format, args.axis, indices, window,
+                          np.uint16 if args.bits == 16 else np.uint8, args.workers, args.compression, args.layout)
+    logging.info(f'{len(indices)} {args.axis} slices written to {args.output} ({len(paths)} files)'
+                 f' in {time.perf_counter() - startTime:.1f} s')
+    return 0
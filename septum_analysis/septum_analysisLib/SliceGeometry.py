@@ -0,0 +1,95 @@
+from .utils import require_module
+
+np = require_module('numpy')
+
+
+def ijk_to_ras_points(ijkToRAS: np.ndarray, ijkPoints: np.ndarray) -> np.ndarray:
+    """Maps (..., 3) IJK points to RAS millimetres."""
+    ijkToRAS = np.asarray(ijkToRAS, dtype=np.float64)
+    return np.asarray(ijkPoints, dtype=np.float64) @ ijkToRAS[:3, :3].T + ijkToRAS[:3, 3]
+
+
+def axial_slice_planes(ijkToRAS: np.ndarray, shape, sliceIndices) -> np.ndarray:
+    """
+    Origin, first and second corner points in RAS of the axial slices k of a (k, j, i) volume, as
+    vtkPlaneSource takes them, shape (len(sliceIndices), 3, 3). The planes cover the voxel edges of the slices.
+    """
+    _, rows, columns = shape
+    sliceIndices = np.asarray(sliceIndices, dtype=np.float64)
+    corners = np.array([[-0.5, -0.5], [columns - 0.5, -0.5], [-0.5, rows - 0.5]])
+    ijk = np.empty((len(sliceIndices), 3, 3))
+    ijk[:, :, :2] = corners
+    ijk[:, :, 2] = sliceIndices[:, None]
+    return ijk_to_ras_points(ijkToRAS, ijk)
+
+
+def planes_poly_data(planes: np.ndarray):
+    """vtkPolyData of quads from (N, 3, 3) origin and corner points."""
+    import vtk
+    from vtk.util import numpy_support
+
+    origins, firstPoints, secondPoints = planes[:, 0], planes[:, 1], planes[:, 2]
+    points = np.stack([origins, firstPoints, firstPoints + secondPoints - origins, secondPoints], axis=1)
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(points.reshape(-1, 3).copy(), deep=True))
+
+    # Every cell is [4, first point id, ..., fourth point id]
+    cells = np.hstack([np.full((len(planes), 1), 4), np.arange(4 * len(planes)).reshape(-1, 4)])
+    quads = vtk.vtkCellArray()
+    quads.SetCells(len(planes), numpy_support.numpy_to_vtkIdTypeArray(cells.ravel().astype(np.int64), deep=True))
+
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(vtkPoints)
+    polyData.SetPolys(quads)
+    return polyData
+
+
+class NoseBoundPlanes:
+    """
+    Shows nose bounds as planes in two model nodes, one for the low and one for the high bounds.
+    The nodes are found by their attribute and updated, so repeated searches do not add nodes to the scene.
+    A batch of bounds is shown as several planes in the same pair of nodes.
+    """
+    ATTRIBUTE_NAME = 'septum_analysis.NoseBound'
+    BOUNDS = (
+        ('low', 'Nose low bound', (1, 0, 0)),
+        ('high', 'Nose high bound', (0, 1, 0)),
+    )
+    OPACITY = 0.8
+
+    def __init__(self, scene=None):
+        import slicer
+        self.scene = scene or slicer.mrmlScene
+
+    def getNode(self, bound: str, name: str, color):
+        import slicer
+        for node in slicer.util.getNodesByClass('vtkMRMLModelNode', self.scene):
+            if node.GetAttribute(self.ATTRIBUTE_NAME) == bound:
+                return node
+        node = self.scene.AddNewNodeByClass('vtkMRMLModelNode', name)
+        node.SetAttribute(self.ATTRIBUTE_NAME, bound)
+        node.CreateDefaultDisplayNodes()
+        node.GetDisplayNode().SetColor(*color)
+        node.GetDisplayNode().SetOpacity(self.OPACITY)
+        return node
+
+    def update(self, ijkToRAS: np.ndarray, shape, lows, highs):
+        """
+        Places the planes of the slices lows and highs, bounds equal to NOSE_NOT_FOUND are skipped.
+        Returns the low and the high model nodes.
+        """
+        from .FaceCurvature import NOSE_NOT_FOUND
+
+        nodes = []
+        for (bound, name, color), sliceIndices in zip(self.BOUNDS, (lows, highs)):
+            sliceIndices = [index for index in np.atleast_1d(sliceIndices) if index != NOSE_NOT_FOUND]
+            node = self.getNode(bound, name, color)
+            node.SetAndObservePolyData(planes_poly_data(axial_slice_planes(ijkToRAS, shape, sliceIndices)))
+            nodes.append(node)
+        return nodes
+
+    def remove(self):
+        import slicer
+        for node in slicer.util.getNodesByClass('vtkMRMLModelNode', self.scene):
+            if node.GetAttribute(self.ATTRIBUTE_NAME) is not None:
+                self.scene.RemoveNode(node)
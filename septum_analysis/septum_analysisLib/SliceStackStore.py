@@ -0,0 +1,301 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .VolumeAccessor import VolumeAccessor, normalize_slices_to_uint8
+from .utils import require_module
+
+np = require_module('numpy')
+
+
+DEFAULT_STORE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'septum_analysis', 'slice_stacks')
+DEFAULT_CHUNK_SLICES = 16
+DEFAULT_MAX_CACHED_BYTES = 512 * 2 ** 20
+DEFAULT_MAX_DISK_BYTES = 8 * 2 ** 30
+METADATA_FILE_NAME = 'metadata.json'
+# Version 1 stored compressed .npz chunks
+STORE_VERSION = 2
+
+# Stored voxels and the slices stretched by normalize_slices_to_uint8
+VARIANT_RAW = 'raw'
+VARIANT_UINT8 = 'uint8'
+
+
+def source_key(path: str) -> str:
+    """Key of a scan file by path, modification time and size, so a modified scan is converted again."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return hashlib.blake2b(repr((path, stat.st_mtime_ns, stat.st_size)).encode(), digest_size=16).hexdigest()
+
+
+def directory_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+class SliceStack:
+    """
+    Axial slices of a converted scan. Chunks of chunkSlices slices are read on demand
+    through the in-memory LRU tier of the store, the whole scan is read straight from the chunk files.
+    The voxels are indexed as (k, j, i).
+    """
+
+    def __init__(self, store: 'SliceStackStore', directory: str, metadata: dict):
+        self.store = store
+        self.directory = directory
+        self.metadata = metadata
+        self.shape = tuple(metadata['shape'])
+        self.dtype = np.dtype(metadata['dtype'])
+        self.ijkToRAS = np.asarray(metadata['ijkToRAS'], dtype=np.float64)
+        self.spacing = np.asarray(metadata['spacing'], dtype=np.float64)
+        self.chunkSlices = metadata['chunkSlices']
+
+    def __len__(self):
+        return self.shape[0]
+
+    def chunk(self, chunkIndex: int, normalized: bool = False) -> np.ndarray:
+        variant = VARIANT_UINT8 if normalized else VARIANT_RAW
+        return self.store.readChunk(self.directory, variant, chunkIndex)
+
+    def slice(self, index: int, normalized: bool = False) -> np.ndarray:
+        index = range(len(self))[index]
+        return self.chunk(index // self.chunkSlices, normalized)[index % self.chunkSlices]
+
+    def slab(self, start: int, stop: int, normalized: bool = False) -> np.ndarray:
+        """Slices [start, stop) as a new array."""
+        start, stop, _ = slice(start, stop).indices(len(self))
+        out = np.empty((max(stop - start, 0),) + self.shape[1:], dtype=np.uint8 if normalized else self.dtype)
+        for chunkIndex in range(start // self.chunkSlices, (stop - 1) // self.chunkSlices + 1 if stop > start else 0):
+            chunkStart = chunkIndex * self.chunkSlices
+            chunk = self.chunk(chunkIndex, normalized)
+            low, high = max(start, chunkStart), min(stop, chunkStart + len(chunk))
+            out[low - start:high - start] = chunk[low - chunkStart:high - chunkStart]
+        return out
+
+    def readAll(self, normalized: bool = False) -> np.ndarray:
+        """
+        All the slices as a new array. The chunks are copied from their memory-mapped files and not kept
+        in the LRU tier, which would hold a second copy of the scan and evict the chunks of other readers.
+        """
+        variant = VARIANT_UINT8 if normalized else VARIANT_RAW
+        out = np.empty(self.shape, dtype=np.uint8 if normalized else self.dtype)
+        for chunkIndex in range((len(self) + self.chunkSlices - 1) // self.chunkSlices):
+            start = chunkIndex * self.chunkSlices
+            out[start:start + self.chunkSlices] = self.store.mapChunk(self.directory, variant, chunkIndex)
+        return out
+
+    def normalizedSlices(self) -> np.ndarray:
+        return self.readAll(normalized=True)
+
+    def toVolumeAccessor(self) -> VolumeAccessor:
+        """Accessor of the whole scan, its normalized slices are taken from the store instead of computed."""
+        return VolumeAccessor(self.readAll(), self.ijkToRAS, normalizedSlices=self.normalizedSlices())
+
+
+class SliceStackStore:
+    """
+    On-disk cache of scans converted once into uncompressed .npy chunks of axial slices, with their stored
+    voxels, the uint8 slices of normalize_slices_to_uint8 and the geometry in metadata.json.
+    Later analyses of the same scan read only the chunks they need, and recently read chunks
+    are kept in memory up to maxCachedBytes. The stacks on disk are limited to maxDiskBytes,
+    the least recently used ones are removed after a conversion, None keeps all of them.
+    """
+
+    def __init__(self, directory: str = DEFAULT_STORE_DIRECTORY, chunkSlices: int = DEFAULT_CHUNK_SLICES,
+                 maxCachedBytes: int = DEFAULT_MAX_CACHED_BYTES, workers: int = None,
+                 maxDiskBytes: int = DEFAULT_MAX_DISK_BYTES):
+        self.directory = directory
+        self.chunkSlices = chunkSlices
+        self.maxCachedBytes = maxCachedBytes
+        self.maxDiskBytes = maxDiskBytes
+        self.workers = workers
+        # (stack directory, variant, chunk index) -> chunk, the most recently used last
+        self.chunks = OrderedDict()
+        self.cachedBytes = 0
+        self.lock = threading.Lock()
+        # Background conversions run one at a time, key -> future
+        self.converter = ThreadPoolExecutor(max_workers=1)
+        self.pendingConversions = {}
+
+    def stackDirectory(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def open(self, path: str) -> SliceStack:
+        """Stack of the scan file at path, the scan is decoded and converted only if it is not stored yet."""
+        key = source_key(path)
+        stack = self.load(key)
+        if stack is None:
+            stack = self.convert(VolumeAccessor.fromFile(path), key, os.path.abspath(path))
+        return stack
+
+    def find(self, path: str):
+        """Stack of the scan file at path if it is already stored, or None. Never converts the scan."""
+        return self.load(source_key(path))
+
+    def convertInBackground(self, volume: VolumeAccessor, path: str):
+        """
+        Stores an already decoded scan in a worker thread, so the caller is not delayed by the conversion
+        and only the next opening of the scan reads it from the store. Returns the future of the stack.
+        """
+        key = source_key(path)
+        with self.lock:
+            future = self.pendingConversions.get(key)
+            if future is None:
+                future = self.converter.submit(self.convertQuietly, volume, key, os.path.abspath(path))
+                self.pendingConversions[key] = future
+        return future
+
+    def convertQuietly(self, volume: VolumeAccessor, key: str, source: str):
+        try:
+            return self.convert(volume, key, source)
+        except Exception:
+            # A scan that cannot be stored is still analyzed from its file
+            logging.exception(f"Failed to store the slices of {source}")
+            return None
+        finally:
+            with self.lock:
+                self.pendingConversions.pop(key, None)
+
+    def close(self) -> None:
+        """Drops the conversions that have not started yet."""
+        self.converter.shutdown(wait=False, cancel_futures=True)
+
+    def load(self, key: str):
+        """Stored stack with the key, or None. Marks the stack as recently used."""
+        metadataPath = os.path.join(self.stackDirectory(key), METADATA_FILE_NAME)
+        if not os.path.exists(metadataPath):
+            return None
+        with open(metadataPath) as file:
+            metadata = json.load(file)
+        if metadata.get('version') != STORE_VERSION:
+            return None
+        try:
+            # The modification time of the metadata is the last use of the stack
+            os.utime(metadataPath)
+        except OSError:
+            pass
+        return SliceStack(self, self.stackDirectory(key), metadata)
+
+    def convert(self, volume: VolumeAccessor, key: str, source: str = None) -> SliceStack:
+        """
+        Stores the volume under the key. The chunks are written in a thread pool into a temporary
+        directory that is renamed at the end, so an interrupted conversion leaves no partial stack.
+        They are not compressed, reading a scan back is then a copy of its files instead of a decompression.
+        """
+        directory = self.stackDirectory(key)
+        temporaryDirectory = f'{directory}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.rmtree(temporaryDirectory, ignore_errors=True)
+        for variant in (VARIANT_RAW, VARIANT_UINT8):
+            os.makedirs(os.path.join(temporaryDirectory, variant))
+
+        def writeChunk(chunkIndex):
+            start = chunkIndex * self.chunkSlices
+            raw = np.ascontiguousarray(volume.array[start:start + self.chunkSlices])
+            np.save(self.chunkPath(temporaryDirectory, VARIANT_RAW, chunkIndex), raw)
+            np.save(self.chunkPath(temporaryDirectory, VARIANT_UINT8, chunkIndex), normalize_slices_to_uint8(raw))
+
+        chunkCount = (len(volume) + self.chunkSlices - 1) // self.chunkSlices
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(writeChunk, range(chunkCount)))
+
+        metadata = {
+            'version': STORE_VERSION,
+            'source': source,
+            'shape': list(volume.shape),
+            'dtype': volume.dtype.str,
+            'ijkToRAS': volume.ijkToRAS.tolist(),
+            'spacing': volume.spacing.tolist(),
+            'chunkSlices': self.chunkSlices,
+            'variants': [VARIANT_RAW, VARIANT_UINT8],
+            'storedBytes': directory_size(temporaryDirectory),
+        }
+        with open(os.path.join(temporaryDirectory, METADATA_FILE_NAME), 'w') as file:
+            json.dump(metadata, file, indent=2)
+
+        self.remove(key)
+        try:
+            os.rename(temporaryDirectory, directory)
+        except OSError:
+            # Another process has stored the same scan meanwhile
+            shutil.rmtree(temporaryDirectory, ignore_errors=True)
+            return self.load(key)
+        self.trimDisk(keep=key)
+        return SliceStack(self, directory, metadata)
+
+    def storedStacks(self) -> list:
+        """(last use time, stored bytes, key) of every stack on disk."""
+        stacks = []
+        if not os.path.isdir(self.directory):
+            return stacks
+        for entry in os.scandir(self.directory):
+            # Temporary directories of running conversions are not stacks yet
+            if not entry.is_dir() or entry.name.endswith('.tmp'):
+                continue
+            metadataPath = os.path.join(entry.path, METADATA_FILE_NAME)
+            try:
+                lastUsed = os.stat(metadataPath).st_mtime_ns
+                with open(metadataPath) as file:
+                    storedBytes = json.load(file).get('storedBytes')
+            except (OSError, ValueError):
+                continue
+            if storedBytes is None:
+                storedBytes = directory_size(entry.path)
+            stacks.append((lastUsed, storedBytes, entry.name))
+        return stacks
+
+    def trimDisk(self, keep: str = None) -> None:
+        """Removes the least recently used stacks, except keep, until the stacks fit into maxDiskBytes."""
+        if self.maxDiskBytes is None:
+            return
+        stacks = sorted(self.storedStacks())
+        storedBytes = sum(stack[1] for stack in stacks)
+        for _, stackBytes, key in stacks:
+            if storedBytes <= self.maxDiskBytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            storedBytes -= stackBytes
+
+    def remove(self, key: str) -> None:
+        directory = self.stackDirectory(key)
+        with self.lock:
+            for chunkKey in [chunkKey for chunkKey in self.chunks if chunkKey[0] == directory]:
+                self.cachedBytes -= self.chunks.pop(chunkKey).nbytes
+        shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def chunkPath(directory: str, variant: str, chunkIndex: int) -> str:
+        return os.path.join(directory, variant, f'{chunkIndex:05d}.npy')
+
+    def mapChunk(self, directory: str, variant: str, chunkIndex: int) -> np.ndarray:
+        """Read-only memory map of a chunk file, bypassing the LRU tier."""
+        return np.load(self.chunkPath(directory, variant, chunkIndex), mmap_mode='r')
+
+    def readChunk(self, directory: str, variant: str, chunkIndex: int) -> np.ndarray:
+        chunkKey = (directory, variant, chunkIndex)
+        with self.lock:
+            if chunkKey in self.chunks:
+                self.chunks.move_to_end(chunkKey)
+                return self.chunks[chunkKey]
+
+        chunk = np.load(self.chunkPath(directory, variant, chunkIndex))
+        # Chunks are shared by all readers
+        chunk.flags.writeable = False
+
+        with self.lock:
+            if chunkKey not in self.chunks:
+                self.chunks[chunkKey] = chunk
+                self.cachedBytes += chunk.nbytes
+            while self.cachedBytes > self.maxCachedBytes and len(self.chunks) > 1:
+                self.cachedBytes -= self.chunks.popitem(last=False)[1].nbytes
+        return chunk
+
+    def clearMemory(self) -> None:
+        with self.lock:
+            self.chunks.clear()
+            self.cachedBytes = 0
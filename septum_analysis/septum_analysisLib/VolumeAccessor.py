@@ -0,0 +1,259 @@
+import gzip
+import hashlib
+import os
+import re
+from collections import OrderedDict
+
+from .ResultCache import array_content_hash
+from .VolumeHistogram import VolumeStatistics
+from .utils import require_module
+
+np = require_module('numpy')
+
+
+class VolumeAccessor:
+    """
+    Read-only access to the voxels of a scan in their stored dtype.
+
+    array - voxels indexed as (k, j, i), the same layout as slicer.util.arrayFromVolume.
+    ijkToRAS - 4x4 matrix mapping (i, j, k, 1) to RAS millimetres.
+    statistics - VolumeStatistics of the voxels if they are already known, otherwise computed on demand.
+    normalizedSlices - the slices of normalize_slices_to_uint8 if they are already known, the same.
+    """
+
+    def __init__(self, array: np.ndarray, ijkToRAS: np.ndarray, statistics: VolumeStatistics = None,
+                 normalizedSlices: np.ndarray = None):
+        if array.ndim != 3:
+            raise ValueError("Only 3D scalar volumes are supported")
+        self.array = array
+        self.ijkToRAS = np.asarray(ijkToRAS, dtype=np.float64)
+        self._normalizedSlices = normalizedSlices
+        self._contentHash = None
+        self._statistics = statistics
+
+    @classmethod
+    def fromVolumeNode(cls, volumeNode, statistics: VolumeStatistics = None):
+        """Zero-copy view of the voxels of a loaded vtkMRMLScalarVolumeNode."""
+        import slicer
+        import vtk
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        return cls(slicer.util.arrayFromVolume(volumeNode), slicer.util.arrayFromVTKMatrix(ijkToRAS), statistics)
+
+    @classmethod
+    def fromFile(cls, path: str):
+        """Memory-maps uncompressed NIfTI/NRRD files, compressed ones are decoded once in their stored dtype."""
+        lowerPath = path.lower()
+        if lowerPath.endswith(('.nrrd', '.nhdr')):
+            return cls(*read_nrrd(path))
+        if lowerPath.endswith(('.nii', '.nii.gz', '.hdr', '.img')):
+            return cls(*read_nifti(path))
+        raise ValueError(f"Unsupported volume file format: {path}")
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    @property
+    def spacing(self) -> np.ndarray:
+        """Voxel spacing along i, j, k in millimetres."""
+        return np.linalg.norm(self.ijkToRAS[:3, :3], axis=0)
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    def slice(self, index: int) -> np.ndarray:
+        """Axial slice k as a view, memory-mapped files read it on first access."""
+        return self.array[index]
+
+    def slices(self):
+        for index in range(len(self)):
+            yield self.array[index]
+
+    def normalizedSlices(self) -> np.ndarray:
+        """Slices stretched to uint8 by normalize_slices_to_uint8, computed on the first call."""
+        if self._normalizedSlices is None:
+            self._normalizedSlices = normalize_slices_to_uint8(self.array)
+        return self._normalizedSlices
+
+    def contentHash(self) -> str:
+        """Hash of the voxels and the geometry, computed on the first call."""
+        if self._contentHash is None:
+            geometry = hashlib.blake2b(self.ijkToRAS.tobytes(), digest_size=8).hexdigest()
+            self._contentHash = array_content_hash(self.array) + geometry
+        return self._contentHash
+
+    def statistics(self) -> VolumeStatistics:
+        """Histogram, scalar range and auto thresholds of the voxels, computed on the first call."""
+        if self._statistics is None:
+            self._statistics = VolumeStatistics(self.array)
+        return self._statistics
+
+
+DEFAULT_NORMALIZATION_CHUNK_SIZE = 32
+
+
+def normalize_slices_to_uint8(volume: np.ndarray, out: np.ndarray = None,
+                              chunkSize: int = DEFAULT_NORMALIZATION_CHUNK_SIZE) -> np.ndarray:
+    """
+    Stretches every slice of a (N, H, W) volume from its own [min, max] range to [0, 255].
+    Constant slices become zero. Slices are processed in chunks of chunkSize, so only one chunk
+    is held as float64 at a time.
+    """
+    if out is None:
+        out = np.empty(volume.shape, dtype=np.uint8)
+    for start in range(0, volume.shape[0], chunkSize):
+        chunk = volume[start:start + chunkSize].astype(np.float64)
+        minimums = chunk.min(axis=(1, 2), keepdims=True)
+        ranges = chunk.max(axis=(1, 2), keepdims=True) - minimums
+        # A constant slice is all zeros after subtracting the minimum, any non-zero range keeps it so
+        ranges[ranges == 0] = 1
+        chunk -= minimums
+        chunk /= ranges
+        chunk *= 255
+        out[start:start + chunkSize] = chunk
+    return out
+
+
+def read_nifti(path: str):
+    nib = require_module('nibabel')
+
+    image = nib.load(path, mmap=True)
+    if image.dataobj.slope == 1 and image.dataobj.inter == 0:
+        data = image.dataobj.get_unscaled()
+    else:
+        # The stored values are not the real ones, scaling cannot be avoided
+        data = np.asanyarray(image.dataobj)
+    if data.ndim == 4 and data.shape[3] == 1:
+        data = data[..., 0]
+    # (i, j, k) in Fortran order is a C-contiguous (k, j, i) view
+    return data.transpose(2, 1, 0), image.affine
+
+
+NRRD_TYPES = {
+    'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+    'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+    'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+    'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+    'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+    'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+    'longlong': 'i8', 'long long': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+    'ulonglong': 'u8', 'unsigned long long': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+    'float': 'f4', 'double': 'f8',
+}
+
+# Sign flips from the NRRD space to RAS
+NRRD_SPACES = {
+    'right-anterior-superior': (1, 1, 1), 'ras': (1, 1, 1),
+    'left-anterior-superior': (-1, 1, 1), 'las': (-1, 1, 1),
+    'left-posterior-superior': (-1, -1, 1), 'lps': (-1, -1, 1),
+}
+
+
+def read_nrrd_header(path: str):
+    fields = {}
+    with open(path, 'rb') as file:
+        magic = file.readline()
+        if not magic.startswith(b'NRRD'):
+            raise ValueError(f"Not a NRRD file: {path}")
+        for line in file:
+            line = line.decode('ascii').rstrip('\r\n')
+            if line == '':
+                break
+            if line.startswith('#') or ':=' in line:
+                continue
+            key, value = line.split(':', 1)
+            fields[key.strip().lower()] = value.strip()
+        headerSize = file.tell()
+    return fields, headerSize
+
+
+def parse_nrrd_vector(text: str):
+    return [float(value) for value in text.strip('() ').split(',')]
+
+
+def read_nrrd(path: str):
+    fields, headerSize = read_nrrd_header(path)
+    if int(fields['dimension']) != 3:
+        raise ValueError("Only 3D NRRD volumes are supported")
+
+    dtype = np.dtype(NRRD_TYPES[fields['type'].lower()])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder('>' if fields.get('endian', 'little') == 'big' else '<')
+    sizes = [int(size) for size in fields['sizes'].split()]
+    shape = tuple(reversed(sizes))
+    byteCount = int(np.prod(sizes)) * dtype.itemsize
+
+    dataPath = path
+    offset = headerSize
+    if 'data file' in fields:
+        dataPath = os.path.join(os.path.dirname(path), fields['data file'])
+        offset = 0
+    byteSkip = int(fields.get('byte skip', 0))
+
+    encoding = fields.get('encoding', 'raw').lower()
+    if encoding == 'raw':
+        offset = os.path.getsize(dataPath) - byteCount if byteSkip == -1 else offset + byteSkip
+        array = np.memmap(dataPath, dtype=dtype, mode='r', offset=offset, shape=shape)
+    elif encoding in ('gzip', 'gz'):
+        with open(dataPath, 'rb') as file:
+            file.seek(offset)
+            with gzip.GzipFile(fileobj=file) as stream:
+                stream.read(max(byteSkip, 0))
+                array = np.frombuffer(stream.read(byteCount), dtype=dtype).reshape(shape)
+    else:
+        raise ValueError(f"Unsupported NRRD encoding: {encoding}")
+
+    ijkToRAS = np.eye(4)
+    if 'space directions' in fields:
+        directions = re.findall(r'\(([^)]*)\)', fields['space directions'])
+        for axis, direction in enumerate(directions):
+            ijkToRAS[:3, axis] = parse_nrrd_vector(direction)
+    if 'space origin' in fields:
+        ijkToRAS[:3, 3] = parse_nrrd_vector(fields['space origin'])
+    # Other spaces, like scanner-xyz, cannot be placed in RAS, reading them as LPS would mirror the scan
+    space = fields.get('space', 'lps').lower()
+    if space not in NRRD_SPACES:
+        raise ValueError(f"Unsupported NRRD space: {fields['space']}")
+    ijkToRAS[:3] *= np.array(NRRD_SPACES[space])[:, None]
+    return array, ijkToRAS
+
+
+# A decoded scan can take gigabytes, only the scan analyzed last is kept
+MAX_CACHED_VOLUMES = 1
+cachedVolumes = OrderedDict()
+
+
+def open_volume(path: str, store=None) -> VolumeAccessor:
+    """
+    VolumeAccessor.fromFile cached by path and modification time, so a scan is decoded once per session.
+    With a SliceStackStore compressed scans already stored are read from their chunks. Other compressed scans
+    are decoded from the file and stored in the background, so they are decoded once at all.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key in cachedVolumes:
+        cachedVolumes.move_to_end(key)
+        return cachedVolumes[key]
+
+    useStore = store is not None and path.lower().endswith('.gz')
+    stack = store.find(path) if useStore else None
+    if stack is not None:
+        accessor = stack.toVolumeAccessor()
+    else:
+        accessor = VolumeAccessor.fromFile(path)
+        if useStore:
+            store.convertInBackground(accessor, path)
+    cachedVolumes[key] = accessor
+    while len(cachedVolumes) > MAX_CACHED_VOLUMES:
+        cachedVolumes.popitem(last=False)
+    return accessor
+
+
+def clear_cached_volumes() -> None:
+    cachedVolumes.clear()
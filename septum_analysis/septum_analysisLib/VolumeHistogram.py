@@ -0,0 +1,229 @@
+from collections import OrderedDict
+
+from .utils import require_module
+
+np = require_module('numpy')
+
+
+DEFAULT_HISTOGRAM_BINS = 256
+DEFAULT_HISTOGRAM_CHUNK_SIZE = 32
+# Above this range of integer values the exact counts take too much memory and np.histogram is used
+MAX_EXACT_INTEGER_RANGE = 1 << 20
+
+# Names of the methods as in SegmentEditorEffects, e.g. SegmentEditorEffects.METHOD_OTSU
+METHOD_TRIANGLE = 'TRIANGLE'
+METHOD_OTSU = 'OTSU'
+METHOD_KITTLER_ILLINGWORTH = 'KITTLER_ILLINGWORTH'
+
+
+def compute_histogram(volume: np.ndarray, bins: int = DEFAULT_HISTOGRAM_BINS,
+                      chunkSize: int = DEFAULT_HISTOGRAM_CHUNK_SIZE):
+    """
+    Returns (counts, edges) of a histogram of bins equal bins over [min, max] of the volume, as np.histogram does.
+    Integer volumes are counted per value with np.bincount and then rebinned, which is several times faster.
+    Slices are processed in chunks of chunkSize, so no full size temporary array is allocated.
+    """
+    minimum, maximum = volume.min(), volume.max()
+    edges = np.linspace(float(minimum), float(maximum), bins + 1)
+    if minimum == maximum:
+        counts = np.zeros(bins, dtype=np.int64)
+        counts[0] = volume.size
+        return counts, edges
+
+    valueRange = int(maximum) - int(minimum) + 1 if np.issubdtype(volume.dtype, np.integer) else None
+    if valueRange is not None and valueRange <= MAX_EXACT_INTEGER_RANGE:
+        valueCounts = np.zeros(valueRange, dtype=np.int64)
+        for start in range(0, volume.shape[0], chunkSize):
+            chunk = volume[start:start + chunkSize].astype(np.int64).ravel()
+            chunk -= int(minimum)
+            valueCounts += np.bincount(chunk, minlength=valueRange)
+        # Same bin assignment as np.histogram: the last bin is closed
+        values = np.arange(valueRange, dtype=np.float64) + float(minimum)
+        valueBins = np.minimum(((values - edges[0]) / (edges[-1] - edges[0]) * bins).astype(np.int64), bins - 1)
+        return np.bincount(valueBins, weights=valueCounts, minlength=bins).astype(np.int64), edges
+
+    counts = np.zeros(bins, dtype=np.int64)
+    for start in range(0, volume.shape[0], chunkSize):
+        counts += np.histogram(volume[start:start + chunkSize], bins=edges)[0]
+    return counts, edges
+
+
+def otsu_threshold(counts: np.ndarray, centers: np.ndarray) -> float:
+    """Bin centre maximizing the between-class variance."""
+    weights = np.cumsum(counts, dtype=np.float64)
+    sums = np.cumsum(counts * centers, dtype=np.float64)
+    total, totalSum = weights[-1], sums[-1]
+    backgroundWeights = weights[:-1]
+    foregroundWeights = total - backgroundWeights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        backgroundMeans = sums[:-1] / backgroundWeights
+        foregroundMeans = (totalSum - sums[:-1]) / foregroundWeights
+        betweenVariances = backgroundWeights * foregroundWeights * (backgroundMeans - foregroundMeans) ** 2
+    betweenVariances[~np.isfinite(betweenVariances)] = -1
+    return float(centers[int(np.argmax(betweenVariances))])
+
+
+def triangle_threshold(counts: np.ndarray, centers: np.ndarray) -> float:
+    """
+    Triangle method: the bin farthest from the line between the histogram peak and the far end of the longer
+    tail. The ends are the 1% and 99% quantiles, as in the ITK calculator.
+    """
+    cumulative = np.cumsum(counts, dtype=np.float64)
+    total = cumulative[-1]
+    low = int(np.searchsorted(cumulative, total * 0.01))
+    high = min(int(np.searchsorted(cumulative, total * 0.99)), len(counts) - 1)
+    peak = int(np.argmax(counts))
+
+    end = low if peak - low > high - peak else high
+    if end == peak:
+        return float(centers[peak])
+    begin, stop = sorted((peak, end))
+    indices = np.arange(begin, stop + 1)
+    # Distance to the line, up to a constant factor
+    slope = (float(counts[end]) - float(counts[peak])) / (end - peak)
+    lineCounts = counts[peak] + slope * (indices - peak)
+    distances = lineCounts - counts[indices]
+    return float(centers[indices[int(np.argmax(distances))]])
+
+
+def kittler_illingworth_threshold(counts: np.ndarray, centers: np.ndarray) -> float:
+    """Minimum error thresholding: the bin centre minimizing the Kittler-Illingworth criterion."""
+    counts = counts.astype(np.float64)
+    weights = np.cumsum(counts)
+    sums = np.cumsum(counts * centers)
+    squares = np.cumsum(counts * centers ** 2)
+    total = weights[-1]
+
+    backgroundWeights = weights[:-1]
+    foregroundWeights = total - backgroundWeights
+    with np.errstate(divide='ignore', invalid='ignore'):
+        backgroundMeans = sums[:-1] / backgroundWeights
+        foregroundMeans = (sums[-1] - sums[:-1]) / foregroundWeights
+        backgroundVariances = squares[:-1] / backgroundWeights - backgroundMeans ** 2
+        foregroundVariances = (squares[-1] - squares[:-1]) / foregroundWeights - foregroundMeans ** 2
+        backgroundProbabilities = backgroundWeights / total
+        foregroundProbabilities = foregroundWeights / total
+        criterion = backgroundProbabilities * np.log(backgroundVariances) \
+            + foregroundProbabilities * np.log(foregroundVariances) \
+            - 2 * (backgroundProbabilities * np.log(backgroundProbabilities)
+                   + foregroundProbabilities * np.log(foregroundProbabilities))
+    criterion[~np.isfinite(criterion)] = np.inf
+    if np.all(np.isinf(criterion)):
+        return otsu_threshold(counts, centers)
+    return float(centers[int(np.argmin(criterion))])
+
+
+AUTO_THRESHOLD_METHODS = {
+    METHOD_TRIANGLE: triangle_threshold,
+    METHOD_OTSU: otsu_threshold,
+    METHOD_KITTLER_ILLINGWORTH: kittler_illingworth_threshold,
+}
+
+
+class VolumeHistogram:
+    """
+    Histogram of a volume computed once, auto thresholds are then taken from it without touching the voxels.
+    """
+
+    def __init__(self, volume: np.ndarray, bins: int = DEFAULT_HISTOGRAM_BINS):
+        self.counts, self.edges = compute_histogram(volume, bins)
+        self.centers = (self.edges[:-1] + self.edges[1:]) / 2
+        self.minimum, self.maximum = float(self.edges[0]), float(self.edges[-1])
+        self.thresholdsByMethod = {}
+
+    def threshold(self, method: str) -> float:
+        if method not in AUTO_THRESHOLD_METHODS:
+            raise ValueError(f"Unknown auto threshold method {method}")
+        if method not in self.thresholdsByMethod:
+            self.thresholdsByMethod[method] = AUTO_THRESHOLD_METHODS[method](self.counts, self.centers)
+        return self.thresholdsByMethod[method]
+
+    def thresholds(self) -> dict:
+        return {method: self.threshold(method) for method in AUTO_THRESHOLD_METHODS}
+
+
+class VolumeStatistics:
+    """Histogram, scalar range and the auto thresholds of all methods of a volume."""
+
+    def __init__(self, volume: np.ndarray, bins: int = DEFAULT_HISTOGRAM_BINS):
+        self.histogram = VolumeHistogram(volume, bins)
+        self.scalarRange = self.histogram.minimum, self.histogram.maximum
+        self.thresholds = self.histogram.thresholds()
+
+
+class VolumeStatisticsCache:
+    """
+    Statistics of volume nodes, computed on first use. A cached entry observes its node and is dropped
+    as soon as the image data is modified or replaced, so a hit never needs to look at the voxels.
+    Entries of nodes removed from the scene are dropped too, and a hit also needs the modification time
+    of the image data the statistics were computed for, since node IDs are reused after the scene is cleared.
+    """
+    DEFAULT_MAX_VOLUMES = 4
+
+    def __init__(self, maxVolumes: int = DEFAULT_MAX_VOLUMES):
+        self.maxVolumes = maxVolumes
+        # node ID -> ([(observed object, observer tag)], image data MTime, statistics), the most recently used last
+        self.entries = OrderedDict()
+        self.scene = None
+        self.sceneObserverTags = []
+
+    def get(self, volumeNode) -> VolumeStatistics:
+        import slicer
+        import vtk
+        self.observeScene(volumeNode.GetScene())
+        nodeID = volumeNode.GetID()
+        imageData = volumeNode.GetImageData()
+        entry = self.entries.get(nodeID)
+        if entry is not None and entry[1] == imageData.GetMTime():
+            self.entries.move_to_end(nodeID)
+            return entry[-1]
+        self.invalidate(nodeID)
+
+        statistics = VolumeStatistics(slicer.util.arrayFromVolume(volumeNode))
+        invalidate = lambda caller, event: self.invalidate(nodeID)
+        observers = [
+            (volumeNode, volumeNode.AddObserver(slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, invalidate)),
+            (imageData, imageData.AddObserver(vtk.vtkCommand.ModifiedEvent, invalidate)),
+        ]
+        self.entries[nodeID] = (observers, imageData.GetMTime(), statistics)
+        while len(self.entries) > self.maxVolumes:
+            self.invalidate(next(iter(self.entries)))
+        return statistics
+
+    def observeScene(self, scene) -> None:
+        if scene is None or scene is self.scene:
+            return
+        import slicer
+        self.removeSceneObservers()
+        self.scene = scene
+        self.sceneObserverTags = [
+            scene.AddObserver(event, self.onSceneNodesRemoved)
+            for event in (slicer.vtkMRMLScene.NodeRemovedEvent, slicer.vtkMRMLScene.EndCloseEvent)
+        ]
+
+    def removeSceneObservers(self) -> None:
+        for tag in self.sceneObserverTags:
+            self.scene.RemoveObserver(tag)
+        self.sceneObserverTags = []
+        self.scene = None
+
+    def onSceneNodesRemoved(self, scene, event) -> None:
+        for nodeID in [nodeID for nodeID in self.entries if scene.GetNodeByID(nodeID) is None]:
+            self.invalidate(nodeID)
+
+    def invalidate(self, nodeID: str) -> None:
+        entry = self.entries.pop(nodeID, None)
+        if entry is None:
+            return
+        observers, _, _ = entry
+        for observed, tag in observers:
+            observed.RemoveObserver(tag)
+
+    def clear(self) -> None:
+        for nodeID in list(self.entries):
+            self.invalidate(nodeID)
+        if self.scene is not None:
+            self.removeSceneObservers()
+
+
+volumeStatistics = VolumeStatisticsCache()
@@ -0,0 +1,170 @@
+"""
+Nasal septum tracing of the waveAlgorithmsResearch notebook.
+
+On every axial slice the cheapest 8-connected path through the tissue is found from the nasal vomer,
+the maxilla pixel nearest the midline, to the front of the nose. Stepping between pixels costs more the more
+their intensities differ, so the path follows the septum. The tissue runs crossing the path are then carved
+between the left and right corners of the maxilla.
+
+The 2D functions take slices in the layout of the notebook: the first axis is lateral (i) and the second
+one anterior-posterior (j), i.e. the (j, i) slices of the (k, j, i) array transposed.
+"""
+from .utils import require_module
+
+np = require_module('numpy')
+csgraph = require_module('scipy.sparse.csgraph', 'scipy')
+sparse = require_module('scipy.sparse', 'scipy')
+
+
+DEFAULT_BLACK_BOUND = 130
+# Half of the lateral band of the front end: 75 pixels on the 350 pixel slices of the notebook
+DEFAULT_FINISH_BAND_FRACTION = 75 / 350
+DEFAULT_INTENSITY_WEIGHT = 1.0
+
+# Half of the 8-neighbourhood, the edges are undirected
+NEIGHBOUR_OFFSETS = ((0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def tissue_mask(image: np.ndarray, blackBound: float = DEFAULT_BLACK_BOUND) -> np.ndarray:
+    """Pixels that are not air, for slices or whole volumes."""
+    return image > blackBound
+
+
+def find_wave_endpoints(maxillaMask: np.ndarray, tissueMask: np.ndarray, midline: int = None,
+                        finishBandFraction: float = DEFAULT_FINISH_BAND_FRACTION):
+    """
+    Returns (start, leftCorner, rightCorner, finish) pixels, or None when the slice has no maxilla on
+    one side of the midline or no tissue in the front band.
+    start - maxilla pixel nearest the midline, the most posterior of them
+    leftCorner, rightCorner - the most anterior maxilla pixels on either side of the midline
+    finish - the most anterior tissue pixel within the band around the midline
+    """
+    if midline is None:
+        midline = maxillaMask.shape[0] // 2
+    maxilla = np.argwhere(maxillaMask)
+    if len(maxilla) == 0:
+        return None
+    # np.lexsort sorts by the last key first and keeps the row-major order of ties
+    start = maxilla[np.lexsort((-maxilla[:, 1], np.abs(maxilla[:, 0] - midline)))[0]]
+
+    left = maxilla[maxilla[:, 0] < midline]
+    right = maxilla[maxilla[:, 0] > midline]
+    halfWidth = finishBandFraction * maxillaMask.shape[0]
+    band = np.zeros_like(tissueMask)
+    band[max(int(np.ceil(midline - halfWidth)), 0):int(midline + halfWidth) + 1] = True
+    tissue = np.argwhere(tissueMask & band)
+    if len(left) == 0 or len(right) == 0 or len(tissue) == 0:
+        return None
+    leftCorner = left[np.argmin(left[:, 1])]
+    rightCorner = right[np.argmin(right[:, 1])]
+    finish = tissue[np.argmin(tissue[:, 1])]
+    return tuple(tuple(int(value) for value in pixel) for pixel in (start, leftCorner, rightCorner, finish))
+
+
+def tissue_graph(image: np.ndarray, nodeMask: np.ndarray, intensityWeight: float = DEFAULT_INTENSITY_WEIGHT):
+    """
+    Sparse graph of the 8-connected pixels of nodeMask, indexed by their flat indices. An edge
+    costs 1 + intensityWeight * |intensity difference|, the notebook found the same paths for such costs.
+    """
+    values = image.astype(np.float64)
+    rows, columns = image.shape
+    indices = np.arange(image.size).reshape(image.shape)
+    sources, targets, costs = [], [], []
+    for rowOffset, columnOffset in NEIGHBOUR_OFFSETS:
+        rowSlice = slice(0, rows - rowOffset), slice(rowOffset, rows)
+        columnSlice = (slice(max(-columnOffset, 0), columns - max(columnOffset, 0)),
+                       slice(max(columnOffset, 0), columns - max(-columnOffset, 0)))
+        first = rowSlice[0], columnSlice[0]
+        second = rowSlice[1], columnSlice[1]
+        edges = nodeMask[first] & nodeMask[second]
+        sources.append(indices[first][edges])
+        targets.append(indices[second][edges])
+        costs.append(1 + intensityWeight * np.abs(values[first][edges] - values[second][edges]))
+    return sparse.csr_matrix(
+        (np.concatenate(costs), (np.concatenate(sources), np.concatenate(targets))),
+        shape=(image.size, image.size)
+    )
+
+
+def shortest_path(image: np.ndarray, tissueMask: np.ndarray, start, finish,
+                  intensityWeight: float = DEFAULT_INTENSITY_WEIGHT):
+    """Pixels of the cheapest path from start to finish through the tissue as an (N, 2) array, None if there is none."""
+    nodeMask = tissueMask.copy()
+    # The vomer pixel itself may be darker than the bound
+    nodeMask[start] = True
+    graph = tissue_graph(image, nodeMask, intensityWeight)
+    startIndex = np.ravel_multi_index(start, image.shape)
+    finishIndex = np.ravel_multi_index(finish, image.shape)
+    distances, predecessors = csgraph.dijkstra(graph, directed=False, indices=startIndex,
+                                               return_predecessors=True)
+    if not np.isfinite(distances[finishIndex]):
+        return None
+
+    path = [finishIndex]
+    while path[-1] != startIndex:
+        path.append(predecessors[path[-1]])
+    return np.stack(np.unravel_index(np.array(path[::-1]), image.shape), axis=1)
+
+
+def tissue_run_bounds(tissueMask: np.ndarray):
+    """
+    For every pixel, the first row of the tissue run ending just above it and the last row of the run
+    starting just below it, along the first axis. A pixel without tissue above it gets its own row.
+    """
+    rows = np.arange(tissueMask.shape[0])[:, None]
+    # Last non-tissue row at or above each pixel, so rows after it up to the pixel are tissue
+    lastAir = np.maximum.accumulate(np.where(tissueMask, -1, rows), axis=0)
+    above = np.empty(tissueMask.shape, dtype=np.int64)
+    above[0] = 0
+    above[1:] = lastAir[:-1] + 1
+    firstAir = np.minimum.accumulate(np.where(tissueMask, tissueMask.shape[0], rows)[::-1], axis=0)[::-1]
+    below = np.empty(tissueMask.shape, dtype=np.int64)
+    below[-1] = tissueMask.shape[0] - 1
+    below[:-1] = firstAir[1:] - 1
+    return above, below
+
+
+def carve_septum(path: np.ndarray, tissueMask: np.ndarray, leftCorner, rightCorner) -> np.ndarray:
+    """
+    Marks the path pixels and the tissue runs going laterally from them, strictly between the rows
+    of the corners, as the answer recovery of the notebook does pixel by pixel.
+    """
+    above, below = tissue_run_bounds(tissueMask)
+    rows, columns = path[:, 0], path[:, 1]
+    low = np.minimum(rows, np.maximum(above[rows, columns], leftCorner[0] + 1))
+    high = np.maximum(rows, np.minimum(below[rows, columns], rightCorner[0] - 1))
+
+    # Row intervals are summed as +1 at their start and -1 after their end
+    counts = np.zeros((tissueMask.shape[0] + 1, tissueMask.shape[1]), dtype=np.int64)
+    np.add.at(counts, (low, columns), 1)
+    np.add.at(counts, (high + 1, columns), -1)
+    return np.cumsum(counts, axis=0)[:-1] > 0
+
+
+def trace_septum_slice(image: np.ndarray, maxillaMask: np.ndarray, blackBound: float = DEFAULT_BLACK_BOUND,
+                       midline: int = None, finishBandFraction: float = DEFAULT_FINISH_BAND_FRACTION,
+                       intensityWeight: float = DEFAULT_INTENSITY_WEIGHT):
+    """Septum mask of a slice, None if it cannot be traced on it."""
+    tissue = tissue_mask(image, blackBound)
+    endpoints = find_wave_endpoints(maxillaMask, tissue, midline, finishBandFraction)
+    if endpoints is None:
+        return None
+    start, leftCorner, rightCorner, finish = endpoints
+    path = shortest_path(image, tissue, start, finish, intensityWeight)
+    if path is None:
+        return None
+    return carve_septum(path, tissue, leftCorner, rightCorner)
+
+
+def trace_septum(volume: np.ndarray, maxilla: np.ndarray, sliceRange: range = None, **kwargs) -> np.ndarray:
+    """
+    Septum labelmap of a (k, j, i) volume, e.g. uint8 normalized slices, and the maxilla labelmap of
+    the same shape. Only the slices of sliceRange are traced, all of them by default.
+    Keyword arguments are passed to trace_septum_slice.
+    """
+    labelmap = np.zeros(volume.shape, dtype=np.uint8)
+    for k in range(volume.shape[0]) if sliceRange is None else sliceRange:
+        mask = trace_septum_slice(volume[k].T, maxilla[k].T != 0, **kwargs)
+        if mask is not None:
+            labelmap[k] = mask.T
+    return labelmap
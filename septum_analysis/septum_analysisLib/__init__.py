@@ -1,6 +1,106 @@
-from .CalculatorVolume import *
-from .CalculatorVolumeWidget import *
-from .SelectingClosedSurfaceEditorEffect import *
-from .PipelineApplierLogic import *
-from .utils import *
-from .FaceCurvature import *
+"""
+Submodules are imported on first access to one of their names, e.g. ``from septum_analysisLib import VolumeAccessor``
+imports VolumeAccessor and NumPy only. So loading the module in Slicer does not import OpenCV, SciPy or
+the Local Threshold effect until a feature needs them. ``from septum_analysisLib import *`` imports nothing,
+import the names explicitly.
+"""
+import importlib
+import sys
+import types
+
+# Submodule -> public names, the submodules needing Slicer are imported only inside it
+_SUBMODULE_NAMES = {
+    'utils': ['require_module', 'registerEditorEffect', 'ijkPointsToKJI'],
+    'FaceCurvature': [
+        'FaceCurvatureResult', 'preprocess_face_slice', 'preprocess_face_slices', 'analyze_slice_curvature',
+        'analyze_face_curvature_batch', 'analyze_face_curvature', 'NOSE_NOT_FOUND', 'NoseBounds', 'smooth_signals',
+        'quantile_crossing_bounds', 'find_nose_bounds_batch', 'find_nose_bounds',
+    ],
+    'GradientVolume': ['DEFAULT_SLAB_SIZE', 'gradient_slice', 'compute_gradient_volume'],
+    'VolumeAccessor': [
+        'VolumeAccessor', 'DEFAULT_NORMALIZATION_CHUNK_SIZE', 'normalize_slices_to_uint8', 'read_nifti', 'NRRD_TYPES',
+        'NRRD_SPACES', 'read_nrrd_header', 'parse_nrrd_vector', 'read_nrrd', 'MAX_CACHED_VOLUMES', 'open_volume',
+        'clear_cached_volumes',
+    ],
+    'VolumeHistogram': [
+        'DEFAULT_HISTOGRAM_BINS', 'METHOD_TRIANGLE', 'METHOD_OTSU', 'METHOD_KITTLER_ILLINGWORTH', 'compute_histogram',
+        'otsu_threshold', 'triangle_threshold', 'kittler_illingworth_threshold', 'AUTO_THRESHOLD_METHODS',
+        'VolumeHistogram', 'VolumeStatistics', 'VolumeStatisticsCache', 'volumeStatistics',
+    ],
+    'ResultCache': ['array_content_hash', 'volume_node_content_hash', 'PackedLabelmap', 'LabelmapCache'],
+    'RegionOfInterest': ['RegionBox'],
+    'PipelineApplierLogic': [
+        'PipelineCancelled', 'PipelineApplierLogic', 'EditorEffectAction', 'ConditionalAction', 'getActionName',
+        'UpdaterActionsSilent', 'UpdaterActionsOnProgressBar',
+    ],
+    'PipelineProfiler': ['ActionProfile', 'RunProfile', 'PipelineProfiler'],
+    'ArraySegmentation': [
+        'FACE_CONNECTIVITY', 'kernel_size_pixels', 'ellipsoid_structure', 'threshold_mask', 'morphological_closing',
+        'grow_from_seeds', 'remove_small_islands', 'ArrayApplierLogic', 'ApplierLogicOnArrays',
+    ],
+    'SliceExport': [
+        'WINDOW_PRESETS', 'WINDOW_FULL', 'WINDOW_NONE', 'SLICE_AXES', 'LAYOUT_NIFTI', 'LAYOUT_ARRAY', 'SLICE_LAYOUTS',
+        'FORMAT_PNG', 'FORMAT_NPZ', 'FORMAT_ZARR', 'window_range', 'apply_window', 'slice_indices', 'export_slices',
+    ],
+    'SliceStackStore': [
+        'DEFAULT_STORE_DIRECTORY', 'DEFAULT_MAX_DISK_BYTES', 'VARIANT_RAW', 'VARIANT_UINT8', 'source_key',
+        'directory_size', 'SliceStack', 'SliceStackStore',
+    ],
+    'WavePropagation': [
+        'tissue_mask', 'find_wave_endpoints', 'tissue_graph', 'shortest_path', 'tissue_run_bounds', 'carve_septum',
+        'trace_septum_slice', 'trace_septum',
+    ],
+    'ModelDownloader': [
+        'COMPLETE_MARKER', 'AMASSS_MODELS_URL', 'AMASSS_MODELS_SHA256', 'AMASSS_MODEL_PATTERNS', 'ChecksumMismatch',
+        'sha256_file', 'github_release_asset_sha256', 'download_file', 'select_members', 'extract_zip',
+        'ModelDownloader',
+    ],
+    'SliceGeometry': ['ijk_to_ras_points', 'axial_slice_planes', 'planes_poly_data', 'NoseBoundPlanes'],
+    'Phantoms': ['HeadPhantom', 'ellipsoid_mask', 'make_head_phantom'],
+    'LabelmapStatistics': [
+        'MM3_PER_CM3', 'STATISTICS_COLUMNS', 'SURFACE_AREA_COLUMN', 'label_voxel_counts', 'voxel_volume_mm3',
+        'SegmentMeasurement', 'SegmentStatisticsCalculator',
+    ],
+    'ResultsAccumulator': [
+        'VOLUME_ID_COLUMN', 'VOLUME_COLUMN', 'RESULTS_COLUMNS', 'SQLITE_TABLE_NAME', 'results_row', 'CsvResultsSink',
+        'SqliteResultsSink', 'results_sink', 'ResultsAccumulator',
+    ],
+    'BatchAnalysis': ['BATCH_COLUMNS', 'read_manifest', 'analyze_scan', 'run_batch'],
+    'CalculatorVolume': ['CalculatorVolume'],
+    'BackgroundRunner': ['BackgroundRunner', 'UpdaterActionsInMainThread'],
+    'CalculatorVolumeWidget': ['CalculatorVolumeWidget', 'ConstGetterNameSegment'],
+    'SelectingClosedSurfaceEditorEffect': ['SelectingClosedSurfaceEditorEffect', 'ApplierLogicWithMask'],
+}
+
+_NAME_SUBMODULES = {name: submodule for submodule, names in _SUBMODULE_NAMES.items() for name in names}
+
+
+class _LazyPackage(types.ModuleType):
+    def __getattribute__(self, name):
+        value = super().__getattribute__(name)
+        # Importing a submodule binds it to the package under its own name,
+        # which would hide the class of the same name, e.g. VolumeAccessor
+        if isinstance(value, types.ModuleType) and _NAME_SUBMODULES.get(name) == name:
+            return getattr(value, name)
+        return value
+
+
+sys.modules[__name__].__class__ = _LazyPackage
+
+# On module reload the names cached by __getattr__ would still point to the old submodules
+for _name in _NAME_SUBMODULES:
+    globals().pop(_name, None)
+
+
+def __getattr__(name):
+    submodule = _NAME_SUBMODULES.get(name)
+    if submodule is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{submodule}', __name__), name)
+    # Later lookups do not go through __getattr__
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_NAME_SUBMODULES))
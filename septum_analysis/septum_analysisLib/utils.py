@@ -1,3 +1,21 @@
+import functools
+import importlib
+
+
+@functools.lru_cache(maxsize=None)
+def require_module(moduleName: str, pipName: str = None):
+    """
+    Imports a dependency on first use, inside Slicer it is installed with pip if it is missing.
+    The result is cached, so the check runs once per process.
+    """
+    try:
+        return importlib.import_module(moduleName)
+    except ImportError:
+        from slicer.util import pip_install
+        pip_install(pipName or moduleName)
+        return importlib.import_module(moduleName)
+
+
 def registerEditorEffect(pathToDirectory: str, fileName: str) -> None:
     import os
     import qt
@@ -8,3 +26,11 @@ def registerEditorEffect(pathToDirectory: str, fileName: str) -> None:
     effectFilename = os.path.join(os.path.dirname(pathToDirectory), fileName)
     instance.setPythonSource(effectFilename.replace('\\', '/'))
     instance.self().register()
+
+
+def ijkPointsToKJI(ijkPoints) -> list:
+    """Rounds the points of vtkPoints in IJK coordinates to (k, j, i) array indices."""
+    return [
+        tuple(int(round(coordinate)) for coordinate in reversed(ijkPoints.GetPoint(index)))
+        for index in range(ijkPoints.GetNumberOfPoints())
+    ]